@@ -0,0 +1,645 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Microbenchmarks for the pyfcp client library.
+
+These run against canned FCP byte streams, so no freenet node is needed.
+
+Usage: bench.py [name ...]
+"""
+
+import os, random, socket, sys, tempfile, thread, threading, time
+
+from fcp import node, replay
+
+
+class BareNode(node.FCPNode):
+    """
+    FCPNode which reads from a given socket-like object, without
+    connecting, saying hello or starting the manager thread
+    """
+    def __init__(self, sock, verbosity=node.SILENT):
+        self.running = False
+        self.verbosity = verbosity
+        self.logfile = None
+        self.logfunc = None
+        self.jobs = node.JobRegistry()
+        self.socket = sock
+        self.reader = node.FCPReader(sock)
+
+
+def cannedProgress(n):
+    """
+    Returns a byte stream of n SimpleProgress/PersistentPut messages,
+    like a busy node sends for a full global queue
+    """
+    msgs = []
+    for i in range(n):
+        if i % 2:
+            msgs.append("SimpleProgress\n"
+                        "Identifier=freesitemgr|mysite|index.html|%d\n"
+                        "Total=%d\nRequired=%d\nFailed=0\nFatallyFailed=0\n"
+                        "Succeeded=%d\nFinalizedTotal=true\nGlobal=true\n"
+                        "EndMessage\n" % (i, 100, 80, i % 80))
+        else:
+            msgs.append("PersistentPut\n"
+                        "Identifier=freesitemgr|mysite|index.html|%d\n"
+                        "URI=CHK@\nVerbosity=1023\nPriorityClass=3\n"
+                        "UploadFrom=direct\nPersistenceType=forever\n"
+                        "Global=true\nMetadata.ContentType=text/html\n"
+                        "DataLength=12345\nMaxRetries=-1\nStarted=true\n"
+                        "EndMessage\n" % i)
+    return "".join(msgs)
+
+
+def cannedPeers(n):
+    """
+    Returns a byte stream of n Peer messages and an EndListPeers, as
+    the reply to a ListPeers with WithVolatile and WithMetadata
+    """
+    msgs = []
+    for i in range(n):
+        fields = [
+            ("identity", "%040x" % random.getrandbits(160)),
+            ("myName", "peer%d" % i),
+            ("opennet", "false"), ("testnet", "false"),
+            ("version", "Fred,0.7,1.0,1466"),
+            ("lastGoodVersion", "Fred,0.7,1.0,1465"),
+            ("physical.udp", "10.0.%d.%d:%d" % (i / 256, i % 256, 30000 + i)),
+            ("location", "%.16f" % random.random()),
+            ("ark.number", str(random.randint(1, 500))),
+            ("ark.pubURI", "SSK@%s,%s,AQACAAE/ark" % ("x" * 43, "y" * 43)),
+            ("auth.negTypes", "2;4"),
+            ("dsaGroup.p", "f" * 256), ("dsaGroup.q", "e" * 64),
+            ("dsaGroup.g", "d" * 256), ("dsaPubKey.y", "c" * 256),
+            ("metadata.routableConnectionCheckCount", str(i * 7)),
+            ("metadata.hadRoutableConnectionCount", str(i * 5)),
+            ("metadata.detected.udp", "10.0.0.%d:%d" % (i % 256, 30000 + i)),
+            ("metadata.timeLastConnected", str(1200000000000 + i)),
+            ("metadata.timeLastRoutable", str(1200000000000 + i)),
+            ]
+        for k in ["averagePingTime", "overloadProbability",
+                  "percentTimeRoutableConnection", "routingBackoffPercent",
+                  "averageOutputBandwidth", "averageInputBandwidth",
+                  "reportedUptimePercentage", "selectionRate"]:
+            fields.append(("volatile." + k, "%.6f" % random.uniform(0, 1000)))
+        for k in ["routingBackoffLength", "totalBytesIn", "totalBytesOut",
+                  "lastRoutingBackoffReason", "routingBackoff", "idle",
+                  "lastReceivedPacketTime", "messageQueueLength"]:
+            fields.append(("volatile." + k, str(random.randint(0, 10**9))))
+        fields.append(("volatile.status", "CONNECTED"))
+        msgs.append("Peer\n" + "".join(["%s=%s\n" % f for f in fields])
+                    + "EndMessage\n")
+    msgs.append("EndListPeers\nEndMessage\n")
+    return "".join(msgs)
+
+
+def dictRxMsg(reader):
+    """
+    The pre-FCPMessage parser: a dict per message, and a try at int()
+    for every field
+    """
+    items = {}
+    while True:
+        line = reader.readln().strip()
+        if line:
+            items['header'] = line
+            break
+    while True:
+        line = reader.readln().strip()
+        if line in ['End', 'EndMessage']:
+            break
+        k, v = line.split("=", 1)
+        try:
+            v = int(v)
+        except:
+            pass
+        items[k] = v
+    return items
+
+
+def feeder(raw):
+    """
+    Returns the reading end of a socketpair, with a thread writing
+    raw into the other end
+    """
+    rd, wr = socket.socketpair()
+    def run():
+        wr.sendall(raw)
+        wr.close()
+    t = threading.Thread(target=run)
+    t.setDaemon(True)
+    t.start()
+    return rd
+
+
+def inChild(func):
+    """
+    Runs func() in a forked child, returning what it returns, and the
+    growth of the child's peak RSS in MB while running it
+    """
+    import resource, marshal
+    rd, wr = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(rd)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        result = func()
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(wr, marshal.dumps((result, (after - before) / 1024.0)))
+        os._exit(0)
+    os.close(wr)
+    raw = ""
+    while True:
+        chunk = os.read(rd, 4096)
+        if not chunk:
+            break
+        raw += chunk
+    os.close(rd)
+    os.waitpid(pid, 0)
+    return marshal.loads(raw)
+
+
+def legacyRxMsg(sock, log):
+    """
+    The pre-FCPReader parser: one recv() per byte of every line
+    """
+    def readln():
+        buf = []
+        while True:
+            c = sock.recv(1)
+            if not c:
+                raise node.FCPNodeFailure("FCP socket closed by node")
+            buf.append(c)
+            if c == '\n':
+                break
+        ln = "".join(buf)
+        log(node.DETAIL, "NODE: " + ln[:-1])
+        return ln
+
+    items = {}
+    while True:
+        line = readln().strip()
+        if line:
+            items['header'] = line
+            break
+    while True:
+        line = readln().strip()
+        if line in ['End', 'EndMessage']:
+            break
+        k, v = line.split("=", 1)
+        try:
+            v = int(v)
+        except:
+            pass
+        items[k] = v
+    return items
+
+
+def drainer():
+    """
+    Returns the writing end of a socketpair, with a thread reading and
+    discarding whatever arrives at the other end
+    """
+    rd, wr = socket.socketpair()
+    def run():
+        while rd.recv(65536):
+            pass
+    t = threading.Thread(target=run)
+    t.setDaemon(True)
+    t.start()
+    return wr
+
+
+def removeRequests(n):
+    """
+    Returns a list of n RemovePersistentRequest messages as (header, kw),
+    like clearing out a site's worth of global jobs
+    """
+    return [("RemovePersistentRequest",
+             dict(Global="true", Identifier="freesitemgr|mysite|%d" % i))
+            for i in range(n)]
+
+
+class SendallNode(BareNode):
+    """
+    BareNode with the pre-FCPWriter send path: each message joined into
+    one string, and sendall() straight away
+    """
+    def _send(self, *pieces):
+        self.socket.sendall("".join(pieces))
+
+
+class MiniStub:
+    """
+    Just enough of a node on a localhost port to answer ClientHello,
+    GenerateSSK and GetNode, for round-trip timing, and ClientGet after
+    a random delay of up to 'latency' seconds, as if off the network
+    """
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(5)
+        self.port = self.listener.getsockname()[1]
+        t = threading.Thread(target=self.serve)
+        t.setDaemon(True)
+        t.start()
+
+    def serve(self):
+        while True:
+            conn, addr = self.listener.accept()
+            t = threading.Thread(target=self.handle, args=(conn,))
+            t.setDaemon(True)
+            t.start()
+
+    def handle(self, conn):
+        f = conn.makefile("rb")
+        lock = threading.Lock()
+        def send(reply):
+            lock.acquire()
+            try:
+                conn.sendall(reply)
+            finally:
+                lock.release()
+        while True:
+            hdr = f.readline().strip()
+            if not hdr:
+                return
+            msg = {}
+            for ln in iter(f.readline, "EndMessage\n"):
+                k, v = ln.strip().split("=", 1)
+                msg[k] = v
+            id = msg.get('Identifier', '__global')
+            if hdr == "ClientHello":
+                reply = "NodeHello\nFCPVersion=2.0\nVersion=Fred,0.7,1.0,1466\n" \
+                        "ConnectionIdentifier=bench\n"
+            elif hdr == "GenerateSSK":
+                reply = "SSKKeypair\nIdentifier=%s\nRequestURI=SSK@pub/\n" \
+                        "InsertURI=SSK@priv/\n" % id
+            elif hdr == "ClientGet":
+                data = msg['URI']
+                reply = "DataFound\nIdentifier=%s\nMetadata.ContentType=" \
+                        "text/plain\nDataLength=%d\nEndMessage\n" \
+                        "AllData\nIdentifier=%s\nDataLength=%d\nData\n%s" % (
+                        id, len(data), id, len(data), data)
+                t = threading.Timer(random.uniform(0, self.latency), send,
+                                    (reply,))
+                t.setDaemon(True)
+                t.start()
+                continue
+            elif hdr == "RemovePersistentRequest":
+                continue
+            else:
+                reply = "NodeData\nIdentifier=%s\nmyName=bench\n" % id
+            send(reply + "EndMessage\n")
+
+
+def timeit(label, n, func):
+    """
+    Calls func() n times, prints and returns the rate per second
+    """
+    then = time.time()
+    for i in xrange(n):
+        func()
+    elapsed = time.time() - then
+    rate = n / elapsed
+    print "%-40s %10.0f msgs/sec" % (label, rate)
+    return rate
+
+
+def bench_rxmsg(nmsgs=20000):
+    """
+    messages/second through _rxMsg, byte-at-a-time vs buffered
+    """
+    raw = cannedProgress(nmsgs)
+
+    n = BareNode(feeder(raw))
+    before = timeit("_rxMsg, recv(1) per byte", nmsgs,
+                    lambda: legacyRxMsg(n.socket, n._log))
+
+    n = BareNode(feeder(raw))
+    after = timeit("_rxMsg, FCPReader", nmsgs, n._rxMsg)
+
+    print "%-40s %10.1fx" % ("speedup", after / before)
+
+
+def bench_txmsg(nmsgs=20000):
+    """
+    messages/second through _txMsg, a sendall() each vs coalesced by FCPWriter
+    """
+    n = SendallNode(drainer())
+    msgs = iter(removeRequests(nmsgs))
+    def legacy():
+        hdr, kw = msgs.next()
+        n._txMsg(hdr, **kw)
+    before = timeit("_txMsg, sendall() per message", nmsgs, legacy)
+
+    # as the manager thread would: queue, and flush whenever a chunk's
+    # worth has built up
+    n = BareNode(drainer())
+    n.writer = node.FCPWriter(n.socket)
+    n.outCond = threading.Condition()
+    n.outBytes = 0
+    n.mgrThreadId = thread.get_ident()
+    msgs = iter(removeRequests(nmsgs))
+    def send():
+        hdr, kw = msgs.next()
+        n._txMsg(hdr, **kw)
+        if n.writer.pending() >= n.writer.chunksize:
+            n.writer.flush()
+    after = timeit("_txMsg, FCPWriter", nmsgs, send)
+    n.writer.flush()
+
+    print "%-40s %10.1fx" % ("speedup", after / before)
+
+
+def bench_alldata(mb=64):
+    """
+    time and peak memory to receive a big AllData, as a string vs get(buffer=...)
+    """
+    size = mb * 1024 * 1024
+    raw = "AllData\nIdentifier=x\nDataLength=%d\nData\n" % size
+
+    def receive(how):
+        def run():
+            # stream the payload in from a thread, as a node would
+            rd, wr = socket.socketpair()
+            def send():
+                wr.sendall(raw)
+                chunk = "x" * 65536
+                for i in xrange(size / 65536):
+                    wr.sendall(chunk)
+                wr.close()
+            t = threading.Thread(target=send)
+            t.setDaemon(True)
+            t.start()
+            n = BareNode(rd)
+            if how == "buffer":
+                buf = bytearray()
+            else:
+                buf = None
+            n.jobs['x'] = node.JobTicket(n, 'x', 'ClientGet', {}, buffer=buf)
+            then = time.time()
+            data = n._rxMsg()['Data']
+            elapsed = time.time() - then
+            assert len(data) == size
+            return elapsed
+        return inChild(run)
+
+    for label, how in [("_rxMsg, string", "string"),
+                       ("_rxMsg, get(buffer=...)", "buffer")]:
+        elapsed, rss = receive(how)
+        print "%-32s %8.0f MB/sec %8.0f MB peak RSS" % (
+            label, mb / elapsed, rss)
+
+
+def bench_peers(npeers=5000):
+    """
+    time and memory to parse and keep a big ListPeers reply, dict per message vs FCPMessage
+    """
+    raw = cannedPeers(npeers)
+
+    def receive(how):
+        def run():
+            n = BareNode(feeder(raw))
+            if how == "dict":
+                rx = lambda: dictRxMsg(n.reader)
+            else:
+                rx = n._rxMsg
+            msgs = []
+            then = time.time()
+            while True:
+                msg = rx()
+                msgs.append(msg)
+                if msg['header'] == 'EndListPeers':
+                    break
+                # as a caller looking for its peer would
+                msg.get('identity')
+            return time.time() - then
+        return inChild(run)
+
+    for label, how in [("_rxMsg, dict", "dict"),
+                       ("_rxMsg, FCPMessage", "message")]:
+        elapsed, rss = receive(how)
+        print "%-32s %8.0f msgs/sec %8.1f MB kept" % (
+            label, (npeers + 1) / elapsed, rss)
+
+
+def bench_jobs(nsites=100, nfiles=500):
+    """
+    time to find each site's jobs on a big global queue, scanning every job vs JobRegistry
+    """
+    n = BareNode(None)
+    for site in range(nsites):
+        for i in range(nfiles):
+            id = "freesitemgr|site%d|file%d.html" % (site, i)
+            n.jobs[id] = node.JobTicket(n, id, "ClientPut",
+                                        {'Global': 'true',
+                                         'PersistenceType': 'forever'})
+    print "%d jobs on the global queue" % len(n.jobs)
+
+    def scan():
+        # as freesitemgr used to: all global jobs, split every id
+        for site in range(nsites):
+            name = "site%d" % site
+            jobs = {}
+            for job in n.jobs.values():
+                if job.isGlobal:
+                    parts = job.id.split("|")
+                    if parts[0] == 'freesitemgr' and parts[1] == name:
+                        jobs[parts[2]] = job
+            assert len(jobs) == nfiles
+    def indexed():
+        for site in range(nsites):
+            prefix = "freesitemgr|site%d|" % site
+            jobs = {}
+            for job in n.getGlobalJobs(prefix=prefix):
+                jobs[job.id[len(prefix):]] = job
+            assert len(jobs) == nfiles
+
+    for label, func in [("scan all jobs per site", scan),
+                        ("getGlobalJobs(prefix=...)", indexed)]:
+        then = time.time()
+        func()
+        elapsed = time.time() - then
+        print "%-32s %8.1f ms for %d sites" % (label, elapsed * 1000, nsites)
+
+
+def bench_latency(nreqs=50):
+    """
+    genkey()/refstats() round trip latency against a localhost stub node
+    """
+    stub = MiniStub()
+    namesitefile = tempfile.mktemp()
+    n = node.FCPNode(port=stub.port, verbosity=node.SILENT,
+                     namesitefile=namesitefile)
+    try:
+        def genkey(**kw):
+            # genkey() itself always waits, so go underneath it
+            id = n._getUniqueId()
+            return n._submitCmd(id, "GenerateSSK", Identifier=id, **kw)
+        for label, func in [("genkey", genkey), ("refstats", n.refstats)]:
+            # time from submission to the completion callback, which
+            # is all down to the manager loop
+            times = []
+            for i in range(nreqs):
+                # let the connection go idle between requests
+                time.sleep(random.uniform(0, 0.2))
+                done = threading.Event()
+                def callback(status, value):
+                    if status != 'pending':
+                        done.set()
+                then = time.time()
+                func(async=True, callback=callback)
+                done.wait()
+                times.append(time.time() - then)
+            times.sort()
+            print "%-24s %8.2f ms median %8.2f ms max" % (
+                label + " round trip", times[len(times)/2] * 1000,
+                times[-1] * 1000)
+    finally:
+        n.shutdown()
+        os.unlink(namesitefile)
+
+
+def bench_getmany(nkeys=500, latency=0.1, concurrency=20):
+    """
+    keys/second fetched from a stub node with up to 100ms per key, one by one vs a hand-rolled loop vs getmany()
+    """
+    stub = MiniStub(latency)
+    namesitefile = tempfile.mktemp()
+    n = node.FCPNode(port=stub.port, verbosity=node.SILENT,
+                     namesitefile=namesitefile)
+    uris = ["CHK@key%d" % i for i in range(nkeys)]
+    try:
+        def onebyone():
+            for uri in uris[:nkeys / 10]:
+                n.get(uri)
+            return nkeys / 10
+
+        def handrolled():
+            # as putdir() does it
+            jobs = []
+            todo = list(uris)
+            while todo or [j for j in jobs if not j.isComplete()]:
+                running = len([j for j in jobs if not j.isComplete()])
+                if running >= concurrency or not todo:
+                    n._waitForSomeJob(jobs, 1)
+                    continue
+                jobs.append(n.get(todo.pop(0), async=True))
+            return len(jobs)
+
+        def bulk():
+            return len(list(n.getmany(uris, concurrency=concurrency)))
+
+        for label, func in [("get(), one by one", onebyone),
+                            ("get(async=True), hand-rolled", handrolled),
+                            ("getmany(concurrency=%d)" % concurrency, bulk)]:
+            then = time.time()
+            count = func()
+            print "%-32s %8.1f keys/sec" % (label, count / (time.time() - then))
+    finally:
+        n.shutdown()
+        os.unlink(namesitefile)
+
+
+def bench_hash(mb=2048, legacymb=256):
+    """
+    MB/sec and peak memory of sha256dda on a big file, whole-file read vs blocks vs mmap
+    """
+    def sparseFile(mb):
+        # sparse, so this times the hashing rather than the disk
+        fd, path = tempfile.mkstemp()
+        os.lseek(fd, mb * 1024 * 1024 - 1, 0)
+        os.write(fd, "x")
+        os.close(fd)
+        return path
+
+    def legacy(path):
+        return node.hashlib.sha256(
+            "-".join(["hello", "id", file(path, "rb").read()])).digest()
+
+    def hashed(path, func, threshold):
+        def run():
+            node.hashMmapThreshold = threshold
+            then = time.time()
+            func(path)
+            return time.time() - then
+        return inChild(run)
+
+    for label, size, func, threshold in [
+            ("whole file, %dMB" % legacymb, legacymb, legacy, None),
+            ("blocks, %dMB" % legacymb, legacymb, None, None),
+            ("blocks, %dMB" % mb, mb, None, None),
+            ("mmap, %dMB" % mb, mb, None, 0)]:
+        path = sparseFile(size)
+        try:
+            elapsed, rss = hashed(path, func or (
+                lambda path: node.sha256dda("hello", "id", path)), threshold)
+        finally:
+            os.unlink(path)
+        print "%-32s %8.0f MB/sec %8.0f MB peak RSS" % (
+            label, size / elapsed, rss)
+
+
+def bench_replay(path=None, nkeys=2000, latency=0.05):
+    """
+    messages/second and lag replaying a recorded session, at full speed and in real time
+    """
+    # a trace of your own, recorded with FCPNode(record=...), or else
+    # one of getmany() against a stub node
+    path = path or os.environ.get("FCP_RECORDING")
+    recorded = not path
+    namesitefile = tempfile.mktemp()
+    if recorded:
+        path = tempfile.mktemp()
+        stub = MiniStub(latency)
+        n = node.FCPNode(port=stub.port, verbosity=node.SILENT,
+                         namesitefile=namesitefile, record=path)
+        try:
+            list(n.getmany(["CHK@key%d" % i for i in range(nkeys)],
+                           concurrency=50))
+        finally:
+            n.shutdown()
+    try:
+        for label, speed in [("full speed", None), ("real time", 1.0)]:
+            n = replay.ReplayNode(namesitefile=namesitefile)
+            stats = n.replay(path, speed=speed)
+            n.shutdown()
+            line = "%-32s %8.0f msgs/sec" % (
+                "replay, " + label, stats['messagesIn'] / stats['seconds'])
+            if speed is not None:
+                line += " %8.2f ms max lag" % (stats['maxLag'] * 1000)
+            print line
+    finally:
+        if recorded:
+            os.unlink(path)
+        os.unlink(namesitefile)
+
+
+benchmarks = [
+    ("rxmsg", bench_rxmsg),
+    ("txmsg", bench_txmsg),
+    ("alldata", bench_alldata),
+    ("peers", bench_peers),
+    ("jobs", bench_jobs),
+    ("latency", bench_latency),
+    ("getmany", bench_getmany),
+    ("hash", bench_hash),
+    ("replay", bench_replay),
+    ]
+
+
+def main(args):
+    names = args or [name for name, func in benchmarks]
+    for name, func in benchmarks:
+        if name in names:
+            print "== %s: %s" % (name, func.__doc__.strip())
+            func()
+            print
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,6 +1,12 @@
 import sys, os
 
-from node import FCPNode, JobTicket
+from node import FCPNode, JobTicket, FCPMessage
+from cache import ContentCache, CHKCache, KeyCache
+from recorder import FCPRecorder
+from asyncnode import AsyncFCPNode
+from pool import FCPNodePool
+from replay import ReplayNode
+from stubnode import StubNode
 from node import ConnectionRefused, FCPException, FCPGetFailed, \
                  FCPPutFailed, FCPProtocolError
 
@@ -23,8 +29,12 @@ if not isDoze:
     import freenetfs
 
 
-__all__ = ['node', 'sitemgr', 'xmlrpc',
-           'FCPNode', 'JobTicket',
+__all__ = ['node', 'sitemgr', 'xmlrpc', 'asyncnode', 'pool', 'replay', 'stubnode',
+           'cache', 'recorder',
+           'FCPNode', 'AsyncFCPNode', 'FCPNodePool', 'ReplayNode', 'StubNode',
+           'JobTicket',
+           'FCPMessage', 'ContentCache', 'CHKCache', 'KeyCache',
+           'FCPRecorder',
            'ConnectionRefused', 'FCPException', 'FCPPutFailed',
            'FCPProtocolError',
            'get', 'put', 'genkey', 'invertkey', 'redirect', 'names',
@@ -0,0 +1,332 @@
+#@+leo-ver=4
+#@+node:@file asyncnode.py
+"""
+A single-threaded, event-driven variant of FCPNode
+
+AsyncFCPNode talks to the node over one non-blocking socket, driven by
+an asyncore loop instead of a manager thread. It takes the same
+arguments and offers the same primitives as FCPNode, and shares its
+message encoding (_txMsg), parser (_rxMsg) and reply handling
+(_on_rxMsg), so redirects, persistent gets and the like behave the same.
+
+Called with async=True, get(), put(), putdir(), genkey(), listpeers() and
+friends return a job ticket at once, so thousands of requests can be
+outstanding without a thread apiece. Completion is delivered through
+the usual 'callback' keyword, or by polling the tickets.
+
+The loop runs whenever you call poll() or run(), or when you wait() on a
+ticket, and synchronous calls simply run it till their job is done. To
+share a loop with other asyncore services, pass your own socket map as
+the 'map' keyword and run asyncore.loop(map=...) yourself.
+
+    node = AsyncFCPNode()
+    jobs = [node.get(uri, async=True) for uri in uris]
+    node.run(until=lambda: all(j.isComplete() for j in jobs))
+"""
+
+#@+others
+#@+node:imports
+import asyncore
+import errno
+import socket
+import sys
+import time
+import traceback
+
+from node import FCPNode, JobTicket, FCPNodeFailure
+from node import ONE_YEAR, CRITICAL
+
+#@-node:imports
+#@+node:class AsyncFCPNode
+class AsyncFCPNode(FCPNode):
+    """
+    FCPNode which runs on an asyncore loop in the caller's thread
+    """
+    #@    @+others
+    #@+node:attribs
+    channel = None
+
+    #@-node:attribs
+    #@+node:__init__
+    def __init__(self, **kw):
+        """
+        Create a connection object
+
+        Keywords are as for FCPNode, plus:
+            - map - the asyncore socket map to register with, defaults to
+              a private one
+
+        The reconnect keywords are ignored - if the connection is lost,
+        all jobs fail, as they always have
+        """
+        self.map = kw.pop('map', None)
+        if self.map is None:
+            self.map = {}
+        FCPNode.__init__(self, **kw)
+
+    #@-node:__init__
+    #@+node:poll
+    def poll(self, timeout=0.0):
+        """
+        Runs one pass of the event loop, waiting at most timeout seconds
+        (or forever if None) for the node to send something
+        """
+        if not self.running:
+            raise FCPNodeFailure("node connection is shut down")
+        asyncore.loop(timeout, False, self.map, 1)
+
+    #@-node:poll
+    #@+node:run
+    def run(self, until=None, timeout=None):
+        """
+        Runs the event loop
+
+        Keywords:
+            - until - a function of no arguments, the loop stops once this
+              returns true. If not given, runs till the connection closes
+            - timeout - stop after this many seconds, regardless
+
+        Returns the final value of until(), or None
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        else:
+            deadline = None
+
+        while self.running:
+            if until and until():
+                return True
+            if deadline is None:
+                remaining = None
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+            self.poll(remaining)
+
+        return until and until()
+
+    #@-node:run
+    #@+node:shutdown
+    def shutdown(self):
+        """
+        Sends off anything still buffered, and closes the connection
+        """
+        if not self.running:
+            return
+        self.running = False
+
+        self.channel.del_channel()
+        if self.nodeIsAlive:
+            try:
+                self.socket.setblocking(1)
+                self.writer.flush()
+            except socket.error:
+                pass
+
+        if not self.noCloseSocket:
+            self.socket.close()
+
+        if self.recorder is not None:
+            self.recorder.close()
+
+        if None != self.logfile and self.logfile not in [sys.stdout, sys.stderr]:
+            self.logfile.close()
+
+    #@-node:shutdown
+    #@+node:_startManager
+    def _startManager(self):
+        """
+        Hooks the connection into the event loop, in place of starting
+        the manager thread
+        """
+        self.writer = self._newWriter()
+        self.channel = _Channel(self)
+        self.running = True
+
+    #@-node:_startManager
+    #@+node:_submitCmd
+    def _submitCmd(self, id, cmd, **kw):
+        """
+        Submits a command for execution
+
+        Arguments and keywords are as for FCPNode._submitCmd, except that
+        the command is always on its way by the time this returns, so
+        waituntilsent makes no difference
+        """
+        if not self.nodeIsAlive:
+            raise FCPNodeFailure("%s:%s: node closed connection" % (cmd, id))
+    
+        # over budget, so run the loop till the socket has taken enough
+        writer = self.writer
+        if writer.pending() > self.outboundBudget:
+            self.run(until=lambda: writer.pending() <= self.outboundBudget)
+
+        async = kw.pop('async', False)
+        kw.pop('waituntilsent', False)
+        timeout = kw.pop('timeout', ONE_YEAR)
+        job = self._newJob(id, cmd, kw)
+
+        self._on_clientReq(job)
+
+        if async:
+            return job
+        elif cmd in ['WatchGlobal', "RemovePersistentRequest"]:
+            return
+        else:
+            return job.wait(timeout)
+
+    #@-node:_submitCmd
+    #@+node:_makeJobTicket
+    def _makeJobTicket(self, id, cmd, kw, **opts):
+        """
+        Our tickets run the event loop while they wait
+        """
+        return AsyncJobTicket(self, id, cmd, kw, **opts)
+
+    #@-node:_makeJobTicket
+    #@+node:_send
+    def _send(self, *pieces):
+        """
+        Queues the pieces of a raw message for the node. The event loop
+        sends them, together with anything else queued meanwhile
+        """
+        if self.channel is None:
+            # still saying hello, socket is blocking
+            raw = "".join(pieces)
+            if self.recorder is not None:
+                self.recorder.sent(raw)
+            self.socket.sendall(raw)
+            nbytes = len(raw)
+        else:
+            nbytes = self.writer.write(pieces)
+        if self.metrics is not None:
+            self.metrics.sent(nbytes)
+
+    #@-node:_send
+    #@+node:_adjustOutbound
+    def _adjustOutbound(self, nbytes):
+        """
+        Nobody else sends for us, so the writer's own count is all we need
+        """
+        pass
+
+    #@-node:_adjustOutbound
+    #@+node:_onReadable
+    def _onReadable(self):
+        """
+        Takes what the node has sent, and handles every message that
+        has fully arrived
+        """
+        try:
+            data = self.socket.recv(self.reader.bufsize)
+        except socket.error, e:
+            if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                return
+            raise
+        if not data:
+            raise FCPNodeFailure("FCP socket closed by node")
+
+        metrics = self.metrics
+        if metrics is not None:
+            busySince = time.time()
+
+        reader = self.reader
+        reader.feed(data)
+        while self.running and reader.hasMsg():
+            msg = self._rxMsg()
+            self._on_rxMsg(msg)
+
+        if metrics is not None:
+            metrics.observe("loop", None, time.time() - busySince)
+
+    #@-node:_onReadable
+    #@+node:_onCrash
+    def _onCrash(self, e):
+        """
+        Something blew up in the event loop - fail all the jobs, as
+        the manager thread does when it crashes
+        """
+        self._log(CRITICAL, "AsyncFCPNode: event loop handler crashed")
+        self.nodeIsAlive = False
+
+        self.running = False
+        self.channel.del_channel()
+
+        for id, job in self.jobs.items():
+            job._putResult(e)
+
+    #@-node:_onCrash
+    #@-others
+
+#@-node:class AsyncFCPNode
+#@+node:class AsyncJobTicket
+class AsyncJobTicket(JobTicket):
+    """
+    Job ticket for an AsyncFCPNode. Nobody else is going to complete the
+    job while we wait for it, so waiting means running the event loop
+    """
+    #@    @+others
+    #@+node:_waitFor
+    def _waitFor(self, test, deadline=None):
+        """
+        Runs the node's event loop till test() returns true, or till time
+        'deadline' if given.
+
+        Returns the final value of test()
+        """
+        if deadline is None:
+            timeout = None
+        else:
+            timeout = max(deadline - time.time(), 0)
+        if not self.node.run(until=test, timeout=timeout):
+            if not self.node.running and not test():
+                raise FCPNodeFailure("%s:%s: node connection is shut down" % (
+                                     self.cmd, self.id))
+            return False
+        return True
+
+    #@-node:_waitFor
+    #@-others
+
+#@-node:class AsyncJobTicket
+#@+node:class _Channel
+class _Channel(asyncore.dispatcher):
+    """
+    Plugs an AsyncFCPNode's socket into the asyncore loop
+    """
+    #@    @+others
+    #@+node:__init__
+    def __init__(self, node):
+        asyncore.dispatcher.__init__(self, node.socket, node.map)
+        self.node = node
+
+    #@-node:__init__
+    #@+node:handlers
+    def readable(self):
+        return True
+
+    def writable(self):
+        return self.node.writer.pending() > 0
+
+    def handle_read(self):
+        self.node._onReadable()
+
+    def handle_write(self):
+        self.node.writer.flush()
+
+    def handle_close(self):
+        self.node._onCrash(FCPNodeFailure("FCP socket closed by node"))
+
+    def handle_error(self):
+        traceback.print_exc()
+        self.node._onCrash(sys.exc_info()[1])
+
+    #@-node:handlers
+    #@-others
+
+#@-node:class _Channel
+#@-others
+
+#@-node:@file asyncnode.py
+#@-leo
@@ -0,0 +1,672 @@
+#@+leo-ver=4
+#@+node:@file cache.py
+"""
+Caches which spare the node work it has done before
+
+ContentCache keeps the contents of keys which never change, for
+FCPNode.get() to answer from instead of fetching them again. CHKCache
+keeps the CHKs the node has worked out, for FCPNode.genchk(), and
+KeyCache the public keys, for FCPNode.invertprivate().
+"""
+
+#@+others
+#@+node:imports
+import collections
+import hashlib
+import os
+import tempfile
+import threading
+
+#@-node:imports
+#@+node:globals
+# how many bytes of key contents a ContentCache holds in memory, and
+# in its directory, if it has one
+defaultCacheBytes = 64 * 1024 * 1024
+defaultCacheDiskBytes = 1024 * 1024 * 1024
+
+#@-node:globals
+#@+node:class ContentCache
+class ContentCache:
+    """
+    A cache for the contents of keys which never change - CHKs, and SSKs
+    and USKs naming an edition - so that FCPNode.get() can answer from
+    here rather than have the node send the data all over again.
+    
+    The most recently used keys are held in memory, up to maxBytes of
+    data. Given a directory, everything is also written there, under
+    the sha256 of its contents, so data fetched under several keys is
+    stored once. When the directory grows past maxDiskBytes, the data
+    used longest ago is deleted, along with the entries of the keys which
+    had it.
+    
+    What's on disk is indexed in memory, so that a miss, or making
+    room, never has to look in the directory. The index is built when
+    the cache is created, and kept up to date as it goes. Writing to
+    the directory is left to a thread of the cache's own, so that the
+    thread putting data in - usually the manager thread - never waits
+    for the disk.
+    
+    One cache may be shared by several connections, and is safe from
+    any thread.
+    
+    >>> cache = ContentCache(maxBytes=10)
+    >>> cache.put("CHK@foo", "text/plain", "hello")
+    >>> cache.put("CHK@bar", "text/plain", "world!")
+    >>> cache.get("CHK@foo"), cache.get("freenet:CHK@bar")
+    (None, ('text/plain', 'world!'))
+    >>> stats = cache.getStats()
+    >>> stats['hits'], stats['misses'], stats['bytesSaved']
+    (1, 1, 6)
+    >>> [ContentCache.cacheable(uri) for uri in ["SSK@abc/site-5/",
+    ...      "SSK@abc/site/", "USK@abc/site/5/index.html", "USK@abc/site/-5/"]]
+    [True, False, True, False]
+    >>> dir = tempfile.mkdtemp()
+    >>> cache = ContentCache(path=dir, maxDiskBytes=5000)
+    >>> for i in range(100):
+    ...     cache.put("CHK@%d" % i, "text/plain", "%03d" % i * 100)
+    ...     cache.put("SSK@abc/site-%d" % i, "text/plain", "%03d" % i * 100)
+    >>> cache.flush()
+    >>> cache.getStats()['diskBytes'] <= 5000
+    True
+    >>> counts = [len(os.listdir(os.path.join(dir, sub))) for sub in ("uris", "data")]
+    >>> counts[0] == 2 * counts[1]
+    True
+    >>> again = ContentCache(maxBytes=0, path=dir, maxDiskBytes=5000)
+    >>> again.getStats()['diskBytes'] == cache.getStats()['diskBytes']
+    True
+    >>> again.get("SSK@abc/site-99")[1][:6], again.get("CHK@0")
+    ('099099', None)
+    >>> cache.clear()
+    """
+    #@    @+others
+    #@+node:__init__
+    def __init__(self, maxBytes=defaultCacheBytes, path=None,
+                 maxDiskBytes=defaultCacheDiskBytes):
+        """
+        Arguments:
+            - maxBytes - how many bytes of data to hold in memory,
+              default 64MB
+            - path - a directory in which to store everything too, which
+              is created if need be. Default None, memory only
+            - maxDiskBytes - how many bytes to keep in path, counting the
+              entries for the keys as well as the data, default 1GB
+        """
+        self.maxBytes = maxBytes
+        self.path = path
+        self.maxDiskBytes = maxDiskBytes
+        self.lock = threading.Lock()
+    
+        # uri -> (mimetype, data), least recently used first
+        self.memory = collections.OrderedDict()
+        self.memoryBytes = 0
+    
+        # the index of the directory: digest -> size for the data, least
+        # recently used first, entry name -> (digest, mimetype, size) for
+        # the keys, and digest -> entry names for the keys which have it
+        self.diskData = collections.OrderedDict()
+        self.diskEntries = {}
+        self.diskRefs = {}
+        self.diskBytes = 0
+    
+        # uri -> (mimetype, data) still to be written, oldest first, and
+        # whether there's a thread writing them
+        self.writing = collections.OrderedDict()
+        self.writerRunning = False
+        self.written = threading.Condition(self.lock)
+    
+        if path:
+            for sub in ("data", "uris"):
+                if not os.path.isdir(os.path.join(path, sub)):
+                    os.makedirs(os.path.join(path, sub))
+            self._diskIndex()
+    
+        self.memoryHits = 0
+        self.diskHits = 0
+        self.misses = 0
+        self.bytesSaved = 0
+        self.stores = 0
+        self.evictions = 0
+    
+    #@-node:__init__
+    #@+node:cacheable
+    def cacheable(uri):
+        """
+        Returns True if the key's contents can never change, so may
+        be cached
+        """
+        uri = uri.split("freenet:")[-1]
+        if uri.startswith("CHK@"):
+            return True
+        parts = uri.split("/")
+        if uri.startswith("SSK@") and len(parts) > 1:
+            # SSK@.../docname-edition
+            return parts[1].rsplit("-", 1)[-1].isdigit()
+        if uri.startswith("USK@") and len(parts) > 2:
+            return parts[2].isdigit()
+        return False
+    
+    cacheable = staticmethod(cacheable)
+    
+    #@-node:cacheable
+    #@+node:get
+    def get(self, uri):
+        """
+        Returns (mimetype, data) for a key if we have it, otherwise None
+        """
+        uri = uri.split("freenet:")[-1]
+        self.lock.acquire()
+        try:
+            hit = self.memory.pop(uri, None)
+            if hit is not None:
+                self.memory[uri] = hit
+                self.memoryHits += 1
+            else:
+                hit = self.writing.get(uri, None) or self._diskGet(uri)
+                if hit is None:
+                    self.misses += 1
+                    return None
+                self.diskHits += 1
+                self._memoryPut(uri, hit)
+            self.bytesSaved += len(hit[1])
+            return hit
+        finally:
+            self.lock.release()
+    
+    #@-node:get
+    #@+node:put
+    def put(self, uri, mimetype, data):
+        """
+        Stores the contents of a key. They go to our directory, if we
+        have one, shortly after - see flush()
+        """
+        uri = uri.split("freenet:")[-1]
+        data = str(data)
+        self.lock.acquire()
+        try:
+            self._memoryPut(uri, (mimetype, data))
+            if self.path:
+                self.writing.pop(uri, None)
+                self.writing[uri] = (mimetype, data)
+                if not self.writerRunning:
+                    self.writerRunning = True
+                    writer = threading.Thread(target=self._diskWriter)
+                    writer.setDaemon(True)
+                    writer.start()
+            self.stores += 1
+        finally:
+            self.lock.release()
+    
+    #@-node:put
+    #@+node:flush
+    def flush(self):
+        """
+        Waits till everything put so far is in our directory
+        """
+        self.lock.acquire()
+        try:
+            while self.writerRunning:
+                self.written.wait()
+        finally:
+            self.lock.release()
+    
+    #@-node:flush
+    #@+node:clear
+    def clear(self):
+        """
+        Empties the cache, on disk as well as in memory
+        """
+        self.lock.acquire()
+        try:
+            self.memory.clear()
+            self.memoryBytes = 0
+            if self.path:
+                self.writing.clear()
+                while self.writerRunning:
+                    self.written.wait()
+                for sub in ("data", "uris"):
+                    dir = os.path.join(self.path, sub)
+                    for name in os.listdir(dir):
+                        os.unlink(os.path.join(dir, name))
+                self.diskData.clear()
+                self.diskEntries.clear()
+                self.diskRefs.clear()
+                self.diskBytes = 0
+        finally:
+            self.lock.release()
+    
+    #@-node:clear
+    #@+node:getStats
+    def getStats(self):
+        """
+        Returns a dict of how well the cache is doing:
+            - hits, misses - gets answered from the cache, and not
+            - memoryHits, diskHits - where the hits were found
+            - bytesSaved - data the node didn't have to send
+            - stores - keys put in the cache
+            - evictions - keys (in memory) and files (on disk) dropped
+              to make room
+            - memoryBytes, memoryKeys, diskBytes - what's held now
+            - diskPending - keys still to be written to disk
+        """
+        self.lock.acquire()
+        try:
+            return {'hits': self.memoryHits + self.diskHits,
+                    'misses': self.misses,
+                    'memoryHits': self.memoryHits,
+                    'diskHits': self.diskHits,
+                    'bytesSaved': self.bytesSaved,
+                    'stores': self.stores,
+                    'evictions': self.evictions,
+                    'memoryBytes': self.memoryBytes,
+                    'memoryKeys': len(self.memory),
+                    'diskBytes': self.diskBytes,
+                    'diskPending': len(self.writing),
+                    }
+        finally:
+            self.lock.release()
+    
+    #@-node:getStats
+    #@+node:_memoryPut
+    def _memoryPut(self, uri, entry):
+        """
+        Holds an entry in memory, dropping the least recently used ones
+        to make room
+        """
+        old = self.memory.pop(uri, None)
+        if old is not None:
+            self.memoryBytes -= len(old[1])
+        if len(entry[1]) > self.maxBytes:
+            return
+        self.memory[uri] = entry
+        self.memoryBytes += len(entry[1])
+        while self.memoryBytes > self.maxBytes:
+            uri, old = self.memory.popitem(last=False)
+            self.memoryBytes -= len(old[1])
+            self.evictions += 1
+    
+    #@-node:_memoryPut
+    #@+node:_diskIndex
+    def _diskIndex(self):
+        """
+        Builds the index of our directory, from what's there now, and
+        deletes the entries of keys whose data has gone
+        """
+        datadir = os.path.join(self.path, "data")
+        files = []
+        for name in os.listdir(datadir):
+            try:
+                st = os.stat(os.path.join(datadir, name))
+            except OSError:
+                continue
+            files.append((st.st_mtime, name, st.st_size))
+        files.sort()
+        for mtime, name, size in files:
+            self.diskData[name] = size
+            self.diskBytes += size
+    
+        urisdir = os.path.join(self.path, "uris")
+        for name in os.listdir(urisdir):
+            path = os.path.join(urisdir, name)
+            try:
+                size = os.path.getsize(path)
+                f = file(path, "rb")
+                try:
+                    digest, mimetype = f.read().split("\n")[:2]
+                finally:
+                    f.close()
+            except (IOError, OSError, ValueError):
+                continue
+            if digest in self.diskData:
+                self._indexEntry(name, digest, mimetype, size)
+                continue
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+    
+    #@-node:_diskIndex
+    #@+node:_indexEntry
+    def _indexEntry(self, name, digest, mimetype, size):
+        """
+        Adds a key's entry to the index, in place of any it had
+        """
+        self._unindexEntry(name)
+        self.diskEntries[name] = (digest, mimetype, size)
+        self.diskRefs.setdefault(digest, set()).add(name)
+        self.diskBytes += size
+    
+    #@-node:_indexEntry
+    #@+node:_unindexEntry
+    def _unindexEntry(self, name):
+        """
+        Drops a key's entry from the index, if it's there
+        """
+        old = self.diskEntries.pop(name, None)
+        if old is None:
+            return
+        refs = self.diskRefs.get(old[0], None)
+        if refs is not None:
+            refs.discard(name)
+            if not refs:
+                del self.diskRefs[old[0]]
+        self.diskBytes -= old[2]
+    
+    #@-node:_unindexEntry
+    #@+node:_diskGet
+    def _diskGet(self, uri):
+        """
+        Returns (mimetype, data) for a key from our directory, or None
+        """
+        if not self.path:
+            return None
+        name = hashlib.sha1(uri).hexdigest()
+        entry = self.diskEntries.get(name, None)
+        if entry is None:
+            return None
+        digest, mimetype, size = entry
+    
+        datafile = os.path.join(self.path, "data", digest)
+        try:
+            f = file(datafile, "rb")
+            try:
+                data = f.read()
+            finally:
+                f.close()
+        except IOError:
+            # gone from under us, so forget it, and the keys which had it
+            for name in list(self.diskRefs.get(digest, ())):
+                self._unindexEntry(name)
+                try:
+                    os.unlink(os.path.join(self.path, "uris", name))
+                except OSError:
+                    pass
+            self.diskBytes -= self.diskData.pop(digest, 0)
+            return None
+    
+        # mark it as recently used, here and for the next index built
+        self.diskData[digest] = self.diskData.pop(digest)
+        try:
+            os.utime(datafile, None)
+        except OSError:
+            pass
+        return (mimetype, data)
+    
+    #@-node:_diskGet
+    #@+node:_diskWriter
+    def _diskWriter(self):
+        """
+        Writes what's been put to our directory, in the order it was put,
+        in a thread of its own which lasts till there's nothing left
+        """
+        while True:
+            self.lock.acquire()
+            try:
+                if not self.writing:
+                    self.writerRunning = False
+                    self.written.notifyAll()
+                    return
+                uri = next(iter(self.writing))
+                entry = self.writing[uri]
+            finally:
+                self.lock.release()
+    
+            try:
+                doomed = self._diskPut(uri, entry)
+            except (IOError, OSError):
+                # the disk is full, say, so the cache does without it
+                self.lock.acquire()
+                try:
+                    if self.writing.get(uri, None) is entry:
+                        del self.writing[uri]
+                finally:
+                    self.lock.release()
+                continue
+    
+            for path in doomed:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+    
+    #@-node:_diskWriter
+    #@+node:_diskPut
+    def _diskPut(self, uri, entry):
+        """
+        Stores a key's contents, (mimetype, data), in our directory, and
+        returns the files to delete to bring it back under its limit.
+        The writing is done without the lock held, the indexing with it
+        """
+        mimetype, data = entry
+        digest = hashlib.sha256(data).hexdigest()
+        datafile = os.path.join(self.path, "data", digest)
+        self.lock.acquire()
+        try:
+            stored = digest in self.diskData
+        finally:
+            self.lock.release()
+        if stored:
+            try:
+                os.utime(datafile, None)
+            except OSError:
+                stored = False
+        if not stored:
+            self._writeFile(datafile, data)
+    
+        name = hashlib.sha1(uri).hexdigest()
+        text = "%s\n%s\n%s\n" % (digest, mimetype, uri)
+        self._writeFile(os.path.join(self.path, "uris", name), text)
+    
+        self.lock.acquire()
+        try:
+            if self.writing.get(uri, None) is entry:
+                # not put again meanwhile
+                del self.writing[uri]
+            self.diskBytes -= self.diskData.pop(digest, 0)
+            self.diskData[digest] = len(data)
+            self.diskBytes += len(data)
+            self._indexEntry(name, digest, mimetype, len(text))
+            if self.diskBytes > self.maxDiskBytes:
+                return self._diskEvict()
+            return []
+        finally:
+            self.lock.release()
+    
+    #@+node:_diskEvict
+    def _diskEvict(self):
+        """
+        Drops the data used longest ago from the index, and the entries
+        of the keys which had it, till the directory will be back under
+        90% of its limit. Returns the files to delete. Call with the lock
+        held
+        """
+        limit = self.maxDiskBytes * 9 / 10
+        doomed = []
+        while self.diskBytes > limit and self.diskData:
+            digest, size = self.diskData.popitem(last=False)
+            self.diskBytes -= size
+            doomed.append(os.path.join(self.path, "data", digest))
+            for name in list(self.diskRefs.get(digest, ())):
+                self._unindexEntry(name)
+                doomed.append(os.path.join(self.path, "uris", name))
+            self.evictions += 1
+        return doomed
+    
+    #@-node:_diskEvict
+    #@+node:_writeFile
+    def _writeFile(self, path, data):
+        """
+        Writes a file in one go, so that nobody ever reads half of it
+        """
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        f = os.fdopen(fd, "wb")
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        os.rename(tmp, path)
+    
+    #@-node:_writeFile
+    #@-others
+
+#@-node:class ContentCache
+#@+node:class CHKCache
+class CHKCache:
+    """
+    Remembers the CHKs of data the node has worked them out for, so that
+    FCPNode.genchk() needn't send the node the same data again.
+    
+    Entries are keyed by the sha256 of the data, together with everything
+    else which goes into a CHK - the mimetype, whether the data is
+    compressed, any filename, and the version of the node which did the
+    sums, since another version may compress differently. Given a path,
+    entries are appended to that file as they're made, and read back in
+    when a cache is next created on it, so they last from run to run.
+    
+    Safe from any thread.
+    
+    >>> cache = CHKCache()
+    >>> key = CHKCache.makeKey(hashlib.sha256("hello").hexdigest(), "text/plain")
+    >>> cache.get(key)
+    >>> cache.put(key, "CHK@foo")
+    >>> cache.get(key), sorted(cache.getStats().items())
+    ('CHK@foo', [('hits', 1), ('keys', 1), ('misses', 1)])
+    """
+    #@    @+others
+    #@+node:__init__
+    def __init__(self, path=None):
+        """
+        Arguments:
+            - path - a file to keep the cache in, which is created if need
+              be. Default None, memory only
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.chks = {}
+        self.hits = 0
+        self.misses = 0
+    
+        if path and os.path.exists(path):
+            f = file(path, "r")
+            try:
+                for line in f:
+                    if not line.endswith("\n"):
+                        # cut short by a crash
+                        continue
+                    parts = line[:-1].rsplit("\t", 1)
+                    if len(parts) == 2:
+                        self.chks[parts[0]] = parts[1]
+            finally:
+                f.close()
+    
+    #@-node:__init__
+    #@+node:makeKey
+    def makeKey(digest, mimetype, uri="CHK@", nocompress="false", name=None,
+                version=None):
+        """
+        Returns the key under which to cache a CHK
+        
+        Arguments:
+            - digest - hex sha256 of the data
+            - mimetype - the data's mimetype
+        
+        Keywords:
+            - uri - the URI given to put(), default 'CHK@'
+            - nocompress - 'true' if the data isn't compressed
+            - name - the TargetFilename, if any
+            - version - the node's version string
+        """
+        return "\t".join([digest, mimetype, uri, str(nocompress),
+                          str(name or ""), str(version or "")])
+    
+    makeKey = staticmethod(makeKey)
+    
+    #@-node:makeKey
+    #@+node:get
+    def get(self, key):
+        """
+        Returns the CHK cached under key, or None
+        """
+        self.lock.acquire()
+        try:
+            uri = self.chks.get(key, None)
+            if uri is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return uri
+        finally:
+            self.lock.release()
+    
+    #@-node:get
+    #@+node:put
+    def put(self, key, uri):
+        """
+        Caches the CHK for a key
+        """
+        self.lock.acquire()
+        try:
+            if self.chks.get(key, None) == uri:
+                return
+            self.chks[key] = uri
+            if self.path:
+                f = file(self.path, "a")
+                try:
+                    f.write("%s\t%s\n" % (key, uri))
+                finally:
+                    f.close()
+        finally:
+            self.lock.release()
+    
+    #@-node:put
+    #@+node:getStats
+    def getStats(self):
+        """
+        Returns a dict of hits, misses, and how many keys are cached
+        """
+        self.lock.acquire()
+        try:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'keys': len(self.chks)}
+        finally:
+            self.lock.release()
+    
+    #@-node:getStats
+    #@-others
+
+#@-node:class CHKCache
+#@+node:class KeyCache
+class KeyCache(CHKCache):
+    """
+    Remembers the public halves of the private keys the node has worked
+    out for FCPNode.invertprivate(), so it needn't ask again.
+    
+    Entries are keyed by the sha256 of the private key's 'SSK@...' part,
+    so no private key is ever written down. Given a path, the cache lasts
+    from run to run as a CHKCache does, in a file of its own.
+    
+    >>> cache = KeyCache()
+    >>> key = KeyCache.makeKey("SSK@private,crypto,AQECAAE")
+    >>> cache.get(key)
+    >>> cache.put(key, "SSK@public,crypto,AQACAAE")
+    >>> cache.get(key)
+    'SSK@public,crypto,AQACAAE'
+    """
+    #@    @+others
+    #@+node:makeKey
+    def makeKey(mainUri):
+        """
+        Returns the key under which to cache the public half of the
+        private key 'SSK@...' mainUri
+        """
+        return hashlib.sha256(mainUri).hexdigest()
+    
+    makeKey = staticmethod(makeKey)
+    
+    #@-node:makeKey
+    #@-others
+
+#@-node:class KeyCache
+#@-others
+
+#@-node:@file cache.py
+#@-leo
@@ -141,11 +141,7 @@ class Handler(SimpleHTTPRequestHandler):
                 self.send_response(resp.status)
                 self.send_header("Content-type",
                                  resp.getheader("Content-Type", "text/plain"))
-                data = resp.read()
-                self.send_header("Content-Length", str(len(data)))
-                self.end_headers()
-                self.wfile.write(data)
-                self.wfile.flush()
+                self.relay(resp)
                 conn.close()
                 return
     
@@ -204,11 +200,7 @@ class Handler(SimpleHTTPRequestHandler):
                     self.send_header("Location", newLocation)
     
                 # get the data from fproxy and send it up to the client
-                data = resp.read()
-                self.send_header("Content-Length", str(len(data)))
-                self.end_headers()
-                self.wfile.write(data)
-                self.wfile.flush()
+                self.relay(resp)
                 conn.close()
                 return
     
@@ -218,6 +210,24 @@ class Handler(SimpleHTTPRequestHandler):
             raise
     
     #@-node:fproxyGet
+    #@+node:relay
+    def relay(self, resp):
+        """
+        Finishes the headers, and passes the body of fproxy's response on
+        to the client a chunk at a time, as it arrives
+        """
+        length = resp.getheader("Content-Length")
+        if length is not None:
+            self.send_header("Content-Length", length)
+        self.end_headers()
+        while True:
+            chunk = resp.read(65536)
+            if not chunk:
+                break
+            self.wfile.write(chunk)
+        self.wfile.flush()
+    
+    #@-node:relay
     #@-others
 
 #@-node:class Handler
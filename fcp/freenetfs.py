@@ -376,7 +376,7 @@ class FreenetBaseFS:
                 uri = path.split("/", 2)[-1]
                 try:
                     self.connectToNode()
-                    mimetype, data = self.node.get(uri)
+                    mimetype, data = self.node.get(uri, coalesce=True)
                     rec = self.addToCache(
                         path=path,
                         isreg=True,
@@ -1123,10 +1123,9 @@ class FreenetBaseFS:
         # determine CHKs for all these jobs
         for rec in fileRecs:
             rec.mimetype = guessMimetype(rec.path)
-            rec.uri = node.put(
-                "CHK@file",
+            rec.uri = node.genchk(
+                uri="CHK@file",
                 data=rec.data,
-                chkonly=True,
                 mimetype=rec.mimetype)
         
         # now insert all these files
@@ -29,6 +29,29 @@ def usage(msg=None, ret=1):
     sys.exit(ret)
 
 #@-node:usage
+#@+node:openOutput
+def openOutput(outfile, mimetype):
+    """
+    Opens the file to save a key in, adding an extension to suit the
+    mimetype if it has none, or returns stdout if outfile is None
+    """
+    if not outfile:
+        return sys.stdout
+
+    # figure out an extension, if none given
+    base, ext = os.path.splitext(outfile)
+    if not ext:
+        ext = mimetypes.guess_extension(mimetype or "")
+        if not ext:
+            ext = ""
+        outfile = base + ext
+
+    try:
+        return file(outfile, "wb")
+    except:
+        usage("Failed to write data to output file %s" % repr(outfile))
+
+#@-node:openOutput
 #@+node:help
 def help():
     """
@@ -188,44 +211,50 @@ def main(argv=sys.argv[1:]):
             traceback.print_exc(file=sys.stderr)
         usage("Failed to connect to FCP service at %s:%s" % (fcpHost, fcpPort))
 
-    # try to retrieve the key
-    try:
-        # print "opts=%s" % opts
-        mimetype, data, msg = n.get(uri, **opts)
-        n.shutdown()
-    except:
+    # try to retrieve the key, writing out the data as it arrives
+    f = None
+    def failed():
         if verbose:
             traceback.print_exc(file=sys.stderr)
         sys.stderr.write("%s: Failed to retrieve key %s\n" % (progname, repr(uri)))
         n.shutdown()
+        if f is not None and outfile:
+            # don't leave half a key lying around
+            f.close()
+            os.unlink(f.name)
         sys.exit(1)
 
-    # try to dispose of the data
-    if outfile:
-        # figure out an extension, if none given
-        base, ext = os.path.splitext(outfile)
-        if not ext:
-            ext = mimetypes.guess_extension(mimetype)
-            if not ext:
-                ext = ""
-            outfile = base + ext
-
-        # try to save to file
-        try:           
-            f = file(outfile, "wb")
-            f.write(data)
-            f.close()
-            if verbose:
-                sys.stderr.write("Saved key to file %s\n" % outfile)
+    try:
+        chunks = n.iterget(uri, **opts)
+    except:
+        failed()
+    while True:
+        try:
+            chunk = chunks.next()
+        except StopIteration:
+            break
+        except:
+            failed()
+
+        if f is None:
+            f = openOutput(outfile, chunks.mimetype)
+        try:
+            f.write(chunk)
         except:
-            # save failed
             if verbose:
                 traceback.print_exc(file=sys.stderr)
-            usage("Failed to write data to output file %s" % repr(outfile))
+            n.shutdown()
+            usage("Failed to write data to output file %s" % repr(f.name))
+
+    if f is None:
+        # empty key
+        f = openOutput(outfile, chunks.mimetype)
+    if outfile:
+        f.close()
+        if verbose:
+            sys.stderr.write("Saved key to file %s\n" % f.name)
     else:
-        # no output file given, dump to stdout
-        sys.stdout.write(data)
-        sys.stdout.flush()
+        f.flush()
 
     # all done
     try:
@@ -0,0 +1,244 @@
+#@+leo-ver=4
+#@+node:@file jobregistry.py
+"""
+The index of an FCPNode's jobs, by kind, completion and identifier prefix
+"""
+
+#@+others
+#@+node:imports
+import threading
+
+#@-node:imports
+#@+node:class JobRegistry
+class JobRegistry:
+    """
+    The jobs of a connection, keyed by Identifier, as FCPNode.jobs
+    
+    Works as a dict, and also keeps the jobs indexed by kind -
+    persistent, global or transient, as for FCPNode.getPersistentJobs()
+    and friends - by whether they are complete, and by the leading
+    '|'-separated parts of their identifiers, so that queries take time
+    in proportion to what they return, not to the number of jobs.
+    
+    Changes and queries are safe from any thread.
+    
+    >>> from node import JobTicket
+    >>> class Conn:
+    ...     jobs = JobRegistry()
+    >>> jobs = Conn.jobs
+    >>> for id in ["freesitemgr|a|index.html", "freesitemgr|a|b.png",
+    ...            "freesitemgr|ab|index.html", "id12345"]:
+    ...     jobs[id] = JobTicket(Conn, id, "ClientPut",
+    ...                          {'Global': 'true', 'PersistenceType': 'forever'})
+    >>> sorted([j.id for j in jobs.select(prefix="freesitemgr|a|")])
+    ['freesitemgr|a|b.png', 'freesitemgr|a|index.html']
+    >>> len(jobs.select(prefix="freesitemgr|a")), len(jobs.select("global"))
+    (3, 4)
+    >>> [j.id for j in jobs.select(prefix="id1")]
+    ['id12345']
+    >>> len(jobs.select("global", prefix="freesite"))
+    3
+    >>> jobs["id12345"]._putResult("CHK@foo")
+    >>> [j.id for j in jobs.select("global", complete=True)]
+    ['id12345']
+    >>> del jobs["freesitemgr|a|b.png"]
+    >>> [j.id for j in jobs.select(prefix="freesitemgr|a|")]
+    ['freesitemgr|a|index.html']
+    """
+    #@    @+others
+    #@+node:__init__
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.jobs = {}
+    
+        # each of these maps ids to jobs, for a subset of self.jobs
+        self.kinds = {'persistent': {}, 'global': {}, 'transient': {}}
+        self.complete = {}
+        self.incomplete = {}
+        self.prefixes = {}
+    
+    #@-node:__init__
+    #@+node:dict methods
+    def __getitem__(self, id):
+        return self.jobs[id]
+    
+    def get(self, id, default=None):
+        return self.jobs.get(id, default)
+    
+    def has_key(self, id):
+        return id in self.jobs
+    
+    __contains__ = has_key
+    
+    def __len__(self):
+        return len(self.jobs)
+    
+    def __iter__(self):
+        return iter(self.keys())
+    
+    def keys(self):
+        return self.jobs.keys()
+    
+    def values(self):
+        return self.jobs.values()
+    
+    def items(self):
+        return self.jobs.items()
+    
+    def __setitem__(self, id, job):
+        self.lock.acquire()
+        try:
+            if id in self.jobs:
+                self._unindex(id, self.jobs[id])
+            self.jobs[id] = job
+            self._index(id, job)
+        finally:
+            self.lock.release()
+    
+    def __delitem__(self, id):
+        self.lock.acquire()
+        try:
+            self._unindex(id, self.jobs.pop(id))
+        finally:
+            self.lock.release()
+    
+    def pop(self, id, *default):
+        self.lock.acquire()
+        try:
+            if id not in self.jobs:
+                if default:
+                    return default[0]
+                raise KeyError(id)
+            job = self.jobs.pop(id)
+            self._unindex(id, job)
+            return job
+        finally:
+            self.lock.release()
+    
+    #@-node:dict methods
+    #@+node:select
+    def select(self, kind=None, complete=None, prefix=None):
+        """
+        Returns a list of the jobs matching all of the given criteria
+        
+        Arguments:
+            - kind - 'persistent' (persistent but not global), 'global' or
+              'transient' (not persistent)
+            - complete - True for jobs which are complete, False for jobs
+              which are not
+            - prefix - jobs whose identifiers start with this. Quickest
+              when it ends with a '|', as freesitemgr's prefixes do
+        """
+        self.lock.acquire()
+        try:
+            # start with the smallest set, and check the others against it
+            sets = []
+            if kind is not None:
+                sets.append(self.kinds[kind])
+            if complete is not None:
+                if complete:
+                    sets.append(self.complete)
+                else:
+                    sets.append(self.incomplete)
+            if prefix:
+                # the jobs under the longest indexed prefix, if it has one
+                i = prefix.rfind("|")
+                if i >= 0:
+                    sets.append(self.prefixes.get(prefix[:i+1], {}))
+            if not sets:
+                if not prefix:
+                    return self.jobs.values()
+                sets.append(self.jobs)
+            sets.sort(key=len)
+    
+            jobs = []
+            for id, job in sets[0].iteritems():
+                for others in sets[1:]:
+                    if id not in others:
+                        break
+                else:
+                    if not prefix or id.startswith(prefix):
+                        jobs.append(job)
+            return jobs
+        finally:
+            self.lock.release()
+    
+    #@-node:select
+    #@+node:completed
+    def completed(self, job):
+        """
+        Called when a job gets its result, to move it to the complete
+        jobs
+        """
+        self.lock.acquire()
+        try:
+            id = job.id
+            if self.jobs.get(id, None) is job:
+                self.incomplete.pop(id, None)
+                self.complete[id] = job
+        finally:
+            self.lock.release()
+    
+    #@-node:completed
+    #@+node:_index
+    def _index(self, id, job):
+        """
+        Adds a job to the indexes
+        """
+        if job.isGlobal:
+            self.kinds['global'][id] = job
+        elif job.isPersistent:
+            self.kinds['persistent'][id] = job
+        if not job.isPersistent:
+            self.kinds['transient'][id] = job
+    
+        if job.isComplete():
+            self.complete[id] = job
+        else:
+            self.incomplete[id] = job
+    
+        if isinstance(id, str):
+            for prefix in self._prefixes(id):
+                self.prefixes.setdefault(prefix, {})[id] = job
+    
+    #@-node:_index
+    #@+node:_unindex
+    def _unindex(self, id, job):
+        """
+        Removes a job from the indexes
+        """
+        for jobs in self.kinds.values():
+            jobs.pop(id, None)
+        self.complete.pop(id, None)
+        self.incomplete.pop(id, None)
+    
+        if isinstance(id, str):
+            for prefix in self._prefixes(id):
+                jobs = self.prefixes.get(prefix, None)
+                if jobs is not None:
+                    jobs.pop(id, None)
+                    if not jobs:
+                        del self.prefixes[prefix]
+    
+    #@-node:_unindex
+    #@+node:_prefixes
+    def _prefixes(self, id):
+        """
+        Returns the prefixes an id is indexed under - for id 'a|b|c',
+        these are 'a|' and 'a|b|'
+        """
+        prefixes = []
+        i = id.find("|")
+        while i >= 0:
+            prefixes.append(id[:i+1])
+            i = id.find("|", i+1)
+        return prefixes
+    
+    #@-node:_prefixes
+    #@-others
+
+#@-node:class JobRegistry
+#@-others
+
+#@-node:@file jobregistry.py
+#@-leo
@@ -0,0 +1,145 @@
+#@+leo-ver=4
+#@+node:@file metrics.py
+"""
+The counts and latency histograms kept by FCPNode(metrics=True)
+"""
+
+#@+others
+#@+node:imports
+import bisect
+import threading
+
+#@-node:imports
+#@+node:globals
+# upper bounds, in seconds, of the buckets of the latency histograms
+# kept by FCPNode(metrics=True)
+latencyBuckets = (0.001, 0.005, 0.025, 0.1, 0.5, 1, 5, 10, 60, 300, 3600)
+
+#@-node:globals
+#@+node:class Metrics
+class Metrics:
+    """
+    The counts and latency histograms an FCPNode keeps when created with
+    metrics=True, which FCPNode.getMetrics() reports. Safe from any thread.
+    
+    >>> m = Metrics()
+    >>> for t in [0.003, 0.02, 0.02, 7]:
+    ...     m.observe("total", "ClientGet", t)
+    >>> hist = m.histograms[("total", "ClientGet")]
+    >>> hist.count, [b for b in hist.buckets() if b[0] in (0.005, 0.025, 10)]
+    (4, [(0.005, 1), (0.025, 3), (10, 4)])
+    """
+    #@    @+others
+    #@+node:__init__
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.txCounts = {}
+        self.bytesSent = 0
+    
+        # bytes received on connections we've since replaced
+        self.bytesReceived = 0
+    
+        # (stage, command) -> _Histogram, with command None for "loop"
+        self.histograms = {}
+    
+    #@-node:__init__
+    #@+node:count
+    def count(self, header):
+        """
+        Counts a message sent to the node
+        """
+        self.lock.acquire()
+        try:
+            self.txCounts[header] = self.txCounts.get(header, 0) + 1
+        finally:
+            self.lock.release()
+    
+    #@-node:count
+    #@+node:sent
+    def sent(self, nbytes):
+        self.lock.acquire()
+        try:
+            self.bytesSent += nbytes
+        finally:
+            self.lock.release()
+    
+    #@-node:sent
+    #@+node:received
+    def received(self, nbytes):
+        self.lock.acquire()
+        try:
+            self.bytesReceived += nbytes
+        finally:
+            self.lock.release()
+    
+    #@-node:received
+    #@+node:observe
+    def observe(self, stage, cmd, seconds):
+        """
+        Adds a time to the histogram for a stage and command
+        """
+        self.lock.acquire()
+        try:
+            hist = self.histograms.get((stage, cmd), None)
+            if hist is None:
+                hist = self.histograms[(stage, cmd)] = _Histogram()
+            hist.add(seconds)
+        finally:
+            self.lock.release()
+    
+    #@-node:observe
+    #@+node:addTo
+    def addTo(self, snapshot):
+        """
+        Fills in our part of an FCPNode.getMetrics() snapshot
+        """
+        self.lock.acquire()
+        try:
+            snapshot['messagesSent'] = self.txCounts.copy()
+            snapshot['bytesSent'] = self.bytesSent
+            snapshot['bytesReceived'] += self.bytesReceived
+            for (stage, cmd), hist in self.histograms.items():
+                d = {'count': hist.count, 'sum': hist.sum,
+                     'buckets': hist.buckets()}
+                if stage == "loop":
+                    snapshot['loop'] = d
+                else:
+                    snapshot['latency'].setdefault(stage, {})[cmd] = d
+        finally:
+            self.lock.release()
+    
+    #@-node:addTo
+    #@-others
+
+#@-node:class Metrics
+#@+node:class _Histogram
+class _Histogram:
+    """
+    Counts of times falling within each of latencyBuckets
+    """
+    def __init__(self):
+        self.counts = [0] * (len(latencyBuckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+    
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(latencyBuckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+    
+    def buckets(self):
+        """
+        Returns (upper bound, cumulative count) for each bucket
+        """
+        result = []
+        n = 0
+        for le, k in zip(latencyBuckets, self.counts):
+            n += k
+            result.append((le, n))
+        return result
+
+#@-node:class _Histogram
+#@-others
+
+#@-node:@file metrics.py
+#@-leo
@@ -21,7 +21,10 @@ No warranty, yada yada
 #@+node:imports
 import Queue
 import base64
+import collections
+import errno
 import mimetypes
+import mmap
 import os
 import pprint
 import random
@@ -31,6 +34,9 @@ import select
 # since Python 2.5.
 # on pyhton < 2.5, distutils will automatically install hashlib from pypi.
 import hashlib
+import heapq
+import itertools
+import logging
 import socket
 import stat
 import sys
@@ -41,6 +47,10 @@ import time
 import traceback
 
 import pseudopythonparser
+from cache import ContentCache, CHKCache, KeyCache
+from metrics import Metrics
+from recorder import FCPRecorder
+from jobregistry import JobRegistry
 
 #@-node:imports
 #@+node:exceptions
@@ -122,16 +132,17 @@ if os.environ.has_key("FPROXY_HOST"):
 if os.environ.has_key("FPROXY_PORT"):
     defaultFProxyPort = int(os.environ["FPROXY_PORT"].strip())
 
-# poll timeout period for manager thread
-pollTimeout = 0.1
-#pollTimeout = 3
-
 # list of keywords sent from node to client, which have
 # int values
 intKeys = [
     'DataLength', 'Code',
     ]
 
+# field name tuples of the messages seen so far, shared between messages
+# with the same fields. Past this many, messages get their own
+maxFieldSets = 1000
+_fieldSets = {}
+
 # for the FCP 'ClientHello' handshake
 expectedVersion="2.0"
 
@@ -145,6 +156,13 @@ DETAIL = 5
 DEBUG = 6
 NOISY = 7
 
+# the stdlib logging levels our verbosity levels are logged at, when
+# FCPNode is given a 'logger'
+loggingLevels = {
+    FATAL: logging.CRITICAL, CRITICAL: logging.CRITICAL, ERROR: logging.ERROR,
+    INFO: logging.INFO, DETAIL: 15, DEBUG: logging.DEBUG, NOISY: 5,
+    }
+
 # peer note types
 PEER_NOTE_PRIVATE_DARKNET_COMMENT = 1
 
@@ -152,6 +170,37 @@ defaultVerbosity = ERROR
 
 ONE_YEAR = 86400 * 365
 
+# how many bytes of outgoing messages may be waiting to go to the node
+# before _submitCmd() makes callers wait
+defaultOutboundBudget = 4 * 1024 * 1024
+
+# files bigger than this get streamed from disk by putdir() and
+# freesitemgr, rather than read into memory whole
+streamThreshold = 1024 * 1024
+
+# how much of a key iterget() holds in memory for a consumer which is
+# falling behind, before spilling to a temporary file
+defaultIterWindow = 1024 * 1024
+
+# when reconnecting, seconds to wait after the first failed attempt,
+# and the most to wait between attempts as the wait doubles
+reconnectDelay = 1
+maxReconnectDelay = 60
+
+# how many times a request is sent again after the connection is lost
+# and regained, before it fails
+defaultResubmitRetries = 3
+
+# how many requests getmany() and putmany() keep running on the node
+# at once, and how many bytes of data putmany() keeps in the air
+defaultConcurrency = 10
+defaultPutmanyBytes = 16 * 1024 * 1024
+
+# how much of a file is read at a time, when hashing it, and how big a
+# file must be to be hashed through mmap instead, or None for never
+hashBlockSize = 1024 * 1024
+hashMmapThreshold = None
+
 #@<<fcp_version>>
 #@+node:<<fcp_version>>
 fcpVersion = "0.2.5"
@@ -215,6 +264,15 @@ class FCPNode:
     
     nodeIsAlive = False
     
+    writer = None
+    mgrThreadId = None
+    reconnecting = False
+    held = None
+    metrics = None
+    logger = None
+    trace = None
+    recorder = None
+    
     nodeVersion = None;
     nodeFCPVersion = None;
     nodeBuild = None;
@@ -223,6 +281,61 @@ class FCPNode:
     nodeExtRevision = None;
     nodeIsTestnet = None;
     
+    # names of the methods handling each message from the node - see
+    # addHandler() to change them on a running connection
+    rxHandlers = {
+        # GenerateSSK
+        'SSKKeypair': '_on_SSKKeypair',
+    
+        # ClientGet
+        'DataFound': '_on_DataFound',
+        'AllData': '_on_AllData',
+        'GetFailed': '_on_GetFailed',
+    
+        # ClientPut
+        'URIGenerated': '_on_URIGenerated',
+        'PutSuccessful': '_on_PutSuccessful',
+        'PutFailed': '_on_PutFailed',
+        'PutFetchable': '_on_PutFetchable',
+    
+        # progress
+        'StartedCompression': '_on_progress',
+        'FinishedCompression': '_on_progress',
+        'SimpleProgress': '_on_progress',
+        'SendingToNetwork': '_on_progress',
+    
+        # single-message replies
+        'ConfigData': '_on_reply',
+        'NodeData': '_on_reply',
+        'TestDDAReply': '_on_reply',
+        'TestDDAComplete': '_on_reply',
+    
+        # FCPPluginMessage
+        'FCPPluginReply': '_on_listEnd',
+    
+        # peer management
+        'Peer': '_on_Peer',
+        'EndListPeers': '_on_listEnd',
+        'PeerRemoved': '_on_listEnd',
+        'UnknownNodeIdentifier': '_on_listFailed',
+    
+        # peer note management
+        'PeerNote': '_on_PeerNote',
+        'EndListPeerNotes': '_on_listEnd',
+        'UnknownPeerNoteType': '_on_listFailed',
+    
+        # persistent jobs
+        'PersistentGet': '_on_listItem',
+        'PersistentPut': '_on_listItem',
+        'PersistentPutDir': '_on_listItem',
+        'EndListPersistentRequests': '_on_listEnd',
+        'PersistentRequestRemoved': '_on_PersistentRequestRemoved',
+    
+        # errors
+        'ProtocolError': '_on_ProtocolError',
+        'IdentifierCollision': '_on_IdentifierCollision',
+        }
+    
     #@-node:attribs
     #@+node:__init__
     def __init__(self, **kw):
@@ -242,12 +355,54 @@ class FCPNode:
               for no such function should be used, defaults to None
             - verbosity - how detailed the log messages should be, defaults to 0
               (silence)
+            - logger - a logging.Logger, or the name of one, to log through,
+              at the levels given in loggingLevels. Unless verbosity is
+              given, it follows the logger's level when we're created.
+              Log messages only go to logfile or logfunc as well if those
+              are given
+            - trace - a function to be called with a dict for every message
+              sent to or received from the node, with keys 'time',
+              'direction' ('in' or 'out'), 'header', 'fields' (a dict,
+              without any data) and 'dataLength' (None if there's no data)
+            - record - a pathname, file object or FCPRecorder, to record the
+              raw bytes of the session to, for replay.ReplayNode to play
+              back. A pathname is appended to. One recording per node -
+              don't share one between the connections of a pool
             - socketTimeout - value to pass to socket object's settimeout() if
               available and the value is not None, defaults to None
+            - outboundBudget - how many bytes of outgoing messages may be
+              queued for sending before new requests must wait their turn,
+              defaults to 4MB
+            - reconnect - if True, when the connection to the node is lost,
+              keep trying to connect again, and carry on where we left off,
+              rather than failing all jobs. Defaults to False
+            - reconnectTimeout - seconds after which to give up trying to
+              reconnect, and fail all jobs, defaults to None (never)
+            - resubmitRetries - how many reconnects a request not persisting
+              beyond the connection is sent again for, before it fails,
+              defaults to 3
+            - cache - a ContentCache, which get() answers from where it can,
+              and stores the keys it fetches in. May be shared by several
+              connections. Defaults to None (no caching)
+            - chkCache - a CHKCache, which genchk() looks in before asking the
+              node to work out a CHK, and remembers the answers in.
+              Defaults to None
+            - keyCache - a KeyCache, which invertprivate() looks in before
+              asking the node for a public key, and remembers the answers
+              in. Defaults to None
+            - metrics - if True, keep the counts, byte totals and latency
+              histograms which getMetrics() and getMetricsText() report.
+              Defaults to False, which costs next to nothing
+            - coalesceGets - if True, a get() of a key we're already getting,
+              with the same options, waits for that get's result instead of
+              asking the node again, unless it passes coalesce=False.
+              Defaults to False
     
         Attributes of interest:
             - jobs - a dict of currently running jobs (persistent and nonpersistent).
               keys are job ids and values are JobTicket objects
+            - reconnecting - True while the connection is lost, and we are
+              trying to connect again
     
         Notes:
             - when the connection is created, a 'hello' handshake takes place.
@@ -270,6 +425,41 @@ class FCPNode:
         self.port = kw.get('port', env.get("FCP_PORT", defaultFCPPort))
         self.port = int(self.port)
         self.socketTimeout = kw.get('socketTimeout', None)
+        self.outboundBudget = kw.get('outboundBudget', defaultOutboundBudget)
+        self.reconnect = kw.get('reconnect', False)
+        self.reconnectTimeout = kw.get('reconnectTimeout', None)
+        self.resubmitRetries = kw.get('resubmitRetries', defaultResubmitRetries)
+        self.coalesceGets = kw.get('coalesceGets', False)
+        self.cache = kw.get('cache', None)
+        self.chkCache = kw.get('chkCache', None)
+        self.keyCache = kw.get('keyCache', None)
+        if kw.get('metrics', False):
+            self.metrics = Metrics()
+    
+        # gets running on the node which identical gets can wait on,
+        # keyed by URI and options, and how many gets have done so
+        self.inflightGets = {}
+        self.inflightLock = threading.RLock()
+        self.coalescedGets = 0
+    
+        # for getReconnectStats()
+        self.reconnects = 0
+        self.downtime = 0.0
+        self.disconnectedAt = None
+        self.lastFailure = None
+    
+        # the WatchGlobal keywords to send again after reconnecting, and
+        # ids of persistent jobs we haven't heard of since reconnecting
+        self.watchGlobal = None
+        self.rebinding = set()
+    
+        # TestDDAComplete messages for the directories the node has let us
+        # use, keyed by (connectionidentifier, directory, 'Read'/'Write')
+        self.ddaGrants = {}
+    
+        # the public halves of the private keys invertprivate() has been
+        # asked about, keyed by KeyCache.makeKey()
+        self.publicKeys = {}
         
         #: The id for the connection
         self.connectionidentifier = None
@@ -277,7 +467,14 @@ class FCPNode:
         # set up the logger
         logfile = kw.get('logfile', None)
         logfunc = kw.get('logfunc', None)
-        if(None == logfile and None == logfunc):
+        logger = kw.get('logger', None)
+        if isinstance(logger, basestring):
+            logger = logging.getLogger(logger)
+        if logger is not None:
+            logging.addLevelName(loggingLevels[DETAIL], "DETAIL")
+            logging.addLevelName(loggingLevels[NOISY], "NOISY")
+        self.logger = logger
+        if(None == logfile and None == logfunc and None == logger):
             logfile = sys.stdout
         if(None != logfile and not hasattr(logfile, 'write')):
             # might be a pathname
@@ -286,38 +483,35 @@ class FCPNode:
             logfile = file(logfile, "a")
         self.logfile = logfile
         self.logfunc = logfunc
-        self.verbosity = kw.get('verbosity', defaultVerbosity)
-    
-        # try to connect to node
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        if(None != self.socketTimeout):
-            try:
-                self.socket.settimeout(self.socketTimeout)
-            except Exception, e:
-                # Socket timeout setting is not available until Python 2.3, so ignore exceptions
-                pass
-        try:
-            self.socket.connect((self.host, self.port))
-        except Exception, e:
-            raise Exception("Failed to connect to %s:%s - %s" % (self.host,
-                                                                 self.port,
-                                                                 e))
-    
-        # now do the hello
-        self._hello()
+        if logger is not None and not kw.has_key('verbosity'):
+            self.verbosity = SILENT
+            for level in (FATAL, CRITICAL, ERROR, INFO, DETAIL, DEBUG, NOISY):
+                if logger.isEnabledFor(loggingLevels[level]):
+                    self.verbosity = level
+        else:
+            self.verbosity = kw.get('verbosity', defaultVerbosity)
+        self.trace = kw.get('trace', None)
+        record = kw.get('record', None)
+        if record is not None and not isinstance(record, FCPRecorder):
+            record = FCPRecorder(record)
+        self.recorder = record
+    
+        # try to connect to node, and do the hello
+        self._connect()
         self.nodeIsAlive = True
     
         # the pending job tickets
-        self.jobs = {} # keyed by request ID
+        self.jobs = JobRegistry() # keyed by request ID
         self.keepJobs = [] # job ids that should never be removed from self.jobs
     
-        # queue for incoming client requests
-        self.clientReqQueue = Queue.Queue()
+        # handlers for incoming messages, and how many of each we've had
+        self.handlers = {}
+        for hdr, name in self.rxHandlers.items():
+            self.handlers[hdr] = getattr(self.__class__, name).im_func
+        self.rxCounts = {}
     
         # launch receiver thread
-        self.running = True
-        self.shutdownLock = threading.Lock()
-        thread.start_new_thread(self._mgrThread, ())
+        self._startManager()
     
         # and set up the name service
         namesitefile = kw.get('namesitefile', None)
@@ -364,6 +558,10 @@ class FCPNode:
         if not id:
             id = self._getUniqueId()
         
+        if kw.get("async", False):
+            # the ticket's result will be the bare (pub, priv) pair
+            return self._submitCmd(id, "GenerateSSK", Identifier=id, **kw)
+    
         pub, priv = self._submitCmd(id, "GenerateSSK", Identifier=id, **kw)
     
         name = kw.get("name", None)
@@ -444,19 +642,35 @@ class FCPNode:
               resources by retrieving it
             - stream - if given, this is a writeable file object, to which the
               received data should be written a chunk at a time
+            - flush - if true, and 'stream' is given, flush the stream after
+              every chunk, rather than just at the end
+            - buffer - if given, a bytearray which is resized to fit the data,
+              and into which the data is received straight off the socket. It
+              is returned in place of a data string, which saves a copy of
+              a big key, and can be reused from one get to the next
             - timeout - timeout for completion, in seconds, default one year
+            - coalesce - if true, and we're already getting this key with
+              the same options, wait for that get to finish and share its
+              result, rather than have the node fetch it again. Ignored
+              for persistent gets and with 'file', 'stream' or 'buffer'.
+              Defaults to the node's coalesceGets setting
+            - cache - if false, don't answer from or store in the node's
+              ContentCache, default True. Only CHKs, and SSKs and USKs
+              naming an edition, are ever cached, and never persistent
+              gets or those with 'file'
     
         Returns a 3-tuple, depending on keyword args:
             - if 'file' is given, returns (mimetype, pathname) if key is returned
-            - if 'file' is not given, returns (mimetype, data, msg) if key is returned
+            - if 'file' is not given, returns (mimetype, data, msg) if key is
+              returned, where data is the 'buffer' bytearray if one was given
             - if 'nodata' is true, returns (mimetype, 1) if key is returned
             - if 'stream' is given, returns (mimetype, None) if key is returned,
               because all the data will have been written to the stream
         If key is not found, raises an exception
         """
-        self._log(INFO, "get: uri=%s" % uri)
+        self._log(INFO, "get: uri=%s", uri)
     
-        self._log(DETAIL, "get: kw=%s" % kw)
+        self._log(DETAIL, "get: kw=%s", kw)
     
         # ---------------------------------
         # format the request
@@ -501,9 +715,12 @@ class FCPNode:
         elif kw.has_key('stream'):
             opts['ReturnType'] = "direct"
             opts['stream'] = kw['stream']
+            opts['flush'] = kw.get('flush', False)
         else:
             nodata = False
             opts['ReturnType'] = "direct"
+            if kw.get('buffer') is not None:
+                opts['buffer'] = kw['buffer']
         
         opts['Identifier'] = id
         
@@ -549,11 +766,105 @@ class FCPNode:
     
         #print "get: opts=%s" % opts
     
+        # keys which never change may already be in our cache
+        if self.cache is not None and kw.get('cache', True) \
+        and opts['Persistence'] == 'connection' \
+        and opts['ReturnType'] != 'disk' \
+        and self.cache.cacheable(uri):
+            hit = self.cache.get(uri)
+            if hit is not None:
+                return self._cachedGet(id, opts, hit)
+            if not opts.has_key('stream'):
+                opts['cacheResult'] = True
+    
+        # share the result of an identical get, if one's running
+        if kw.get('coalesce', self.coalesceGets) \
+        and opts['Persistence'] == 'connection' \
+        and opts['ReturnType'] != 'disk' \
+        and not (opts.has_key('stream') or opts.has_key('buffer')):
+            return self._coalescedGet(id, opts)
+    
         # ---------------------------------
         # now enqueue the request
         return self._submitCmd(id, "ClientGet", **opts)
     
     #@-node:get
+    #@+node:iterget
+    def iterget(self, uri, **kw):
+        """
+        Does a direct get of a key, returning an iterator which yields
+        the data a chunk at a time, as it arrives from the node
+        
+        Keywords are as for get(), except for 'async', 'file', 'nodata',
+        'stream' and 'buffer', plus:
+            - window - how many bytes to hold in memory while the consumer
+              falls behind, beyond which they go to a temporary file,
+              default 1MB
+            - timeout - timeout for completion, in seconds, default forever
+        
+        The iterator's 'mimetype' attribute is the key's mimetype once
+        the first chunk has arrived. The node connection never waits for
+        the consumer, so it's fine to relay the data to a slow client.
+        If the get fails, iteration raises the exception, as get() would.
+        """
+        it = DataIterator(kw.pop('window', None), kw.pop('timeout', None))
+        kw['async'] = True
+        kw['stream'] = it
+        it.job = self.get(uri, **kw)
+        return it
+    
+    #@-node:iterget
+    #@+node:getmany
+    def getmany(self, uris, **kw):
+        """
+        Gets many keys, keeping a number of gets running on the node at
+        once, and yielding the results as they come in
+        
+        Arguments:
+            - uris - an iterable of URIs, which is only read from as
+              there's room to start another get. An item may also be a
+              (uri, opts) tuple, where opts is a dict of get() keywords
+              for that key alone, such as 'priority' or 'timeout'
+        
+        Keywords are as for get(), and apply to every key, except for
+        'async' and 'stream', plus:
+            - concurrency - how many gets to have running at once,
+              default 10
+            - timeout - seconds each get may take from when it's started,
+              after which it is abandoned, default forever
+        
+        Returns an iterator, yielding (uri, result) for each key in the
+        order they complete, where result is what get() would have
+        returned, or the exception it would have raised. A get which
+        takes longer than its timeout yields an FCPNodeTimeout.
+        
+        Leaving the iteration early abandons the gets still running:
+        
+            for uri, result in node.getmany(uris, concurrency=20,
+                                            timeout=300, nodata=True):
+                if not isinstance(result, Exception):
+                    print "found", uri
+        """
+        concurrency = kw.pop('concurrency', defaultConcurrency)
+        kw.pop('async', None)
+    
+        def uriOf(item):
+            if isinstance(item, tuple):
+                return item[0]
+            return item
+    
+        def start(item, early):
+            opts = dict(kw)
+            if isinstance(item, tuple):
+                opts.update(item[1])
+            timeout = opts.pop('timeout', None)
+            opts['async'] = True
+            return self.get(uriOf(item), **opts), timeout
+    
+        for item, status, value in self._runBatch(uris, start, concurrency):
+            yield uriOf(item), value
+    
+    #@-node:getmany
     #@+node:put
     def put(self, uri="CHK@", **kw):
         """
@@ -565,6 +876,8 @@ class FCPNode:
         Keywords - you must specify one of the following to choose an insert mode:
             - file - path of file from which to read the key data
             - data - the raw data of the key as string
+            - stream - a readable file object from which to read the key data
+              as it is sent to the node, so it never has to be held in memory
             - dir - the directory to insert, for freesite insertion
             - redirect - the target URI to redirect to
     
@@ -573,11 +886,18 @@ class FCPNode:
             - usk - whether to insert as a USK (USK@privkey/sitename/version/), default False
             - version - valid if usk is true, default 0
     
-        Keywords for 'file' and 'data' modes:
+        Keywords for 'file', 'data' and 'stream' modes:
             - chkonly - only generate CHK, don't insert - default false
             - dontcompress - do not compress on insert - default false
     
-        Keywords for 'file', 'data' and 'redirect' modes:
+        Keywords for 'stream' mode:
+            - length - the number of bytes to read from the stream, default
+              the rest of the file if it is a regular file. Fewer bytes than
+              this in the stream is fatal to the node connection
+            - closeStream - if true, close the stream once it has been
+              sent, or the insert is over without it, default False
+    
+        Keywords for 'file', 'data', 'stream' and 'redirect' modes:
             - mimetype - the mime type, default text/plain
     
         Keywords valid for all modes:
@@ -604,7 +924,8 @@ class FCPNode:
             - timeout - timeout for completion, in seconds, default one year
     
         Notes:
-            - exactly one of 'file', 'data' or 'dir' keyword arguments must be present
+            - exactly one of 'file', 'data', 'stream' or 'dir' keyword arguments
+              must be present
         """
         # divert to putdir if dir keyword present
         if kw.has_key('dir'):
@@ -621,8 +942,8 @@ class FCPNode:
         if kw.has_key('callback'):
             opts['callback'] = kw['callback']
     
-        self._log(DETAIL, "put: uri=%s async=%s waituntilsent=%s" % (
-                            uri, opts['async'], opts['waituntilsent']))
+        self._log(DETAIL, "put: uri=%s async=%s waituntilsent=%s",
+                  uri, opts['async'], opts['waituntilsent'])
     
         opts['Persistence'] = kw.pop('persistence', 'connection')
         if kw.get('Global', False):
@@ -705,9 +1026,13 @@ class FCPNode:
                 sha256dda(self.connectionidentifier, id, 
                           path=filepath))
     
-        elif kw.has_key("data"):
+        elif kw.has_key("data") or kw.has_key("stream"):
             opts["UploadFrom"] = "direct"
-            opts["Data"] = kw['data']
+            if kw.has_key("data"):
+                opts["Data"] = kw['data']
+            else:
+                opts["Data"] = _StreamData(kw['stream'], kw.get('length'),
+                                           kw.get('closeStream', False))
             targetFilename = kw.get('name')
             if targetFilename:
                 opts["TargetFilename"] = targetFilename
@@ -716,7 +1041,7 @@ class FCPNode:
             opts["UploadFrom"] = "redirect"
             opts["TargetURI"] = kw['redirect']
         elif chkOnly != "true":
-            raise Exception("Must specify file, data or redirect keywords")
+            raise Exception("Must specify file, data, stream or redirect keywords")
     
         opts['timeout'] = int(kw.get("timeout", ONE_YEAR))
     
@@ -727,6 +1052,94 @@ class FCPNode:
         return self._submitCmd(id, "ClientPut", **opts)
     
     #@-node:put
+    #@+node:putmany
+    def putmany(self, items, **kw):
+        """
+        Inserts many keys, keeping a number of inserts running on the node
+        at once, and yielding their progress and results as they come in
+        
+        Arguments:
+            - items - an iterable of (uri, source, mimetype) tuples, which
+              is only read from as there's room to start another insert.
+              'source' is the data as a string, or a file object to read
+              it from, or a dict of put() keywords such as 'file' or
+              'stream' and 'length'. 'mimetype' may be None, to have put()
+              guess it. A fourth item, a dict of put() keywords for this
+              key alone, such as 'priority', may follow
+        
+        Keywords are as for put(), and apply to every key, except for
+        'async' and 'dir', plus:
+            - concurrency - how many inserts to have running at once,
+              default 10
+            - maxbytes - how many bytes of data to have in the air at
+              once, default 16MB. An item bigger than this still goes,
+              but on its own
+            - timeout - seconds each insert may take from when it's
+              started, after which it is abandoned, default forever
+            - chkonly - as for put(), so as to work out CHKs without
+              inserting anything
+        
+        Returns an iterator yielding (item, status, value), where item is
+        the item from 'items', and status is one of:
+            - 'generated' - the node has worked out the key, which is
+              'value'. For a CHK, this comes well before the insert is
+              done
+            - 'successful' - the insert is done, and 'value' is the URI
+            - 'failed' - 'value' is the exception put() would have raised
+        
+        Leaving the iteration early abandons the inserts still running:
+        
+            files = [("CHK@", file(path, "rb"), None) for path in paths]
+            for item, status, value in node.putmany(files, maxbytes=2**26):
+                if status == 'generated':
+                    print "%s will be at %s" % (item[1].name, value)
+        """
+        concurrency = kw.pop('concurrency', defaultConcurrency)
+        maxbytes = kw.pop('maxbytes', defaultPutmanyBytes)
+        kw.pop('async', None)
+    
+        def putKeywords(item):
+            opts = dict(kw)
+            source = item[1]
+            if isinstance(source, dict):
+                opts.update(source)
+            elif hasattr(source, 'read'):
+                opts['stream'] = source
+            else:
+                opts['data'] = source
+            if len(item) > 2 and item[2] is not None:
+                opts['mimetype'] = item[2]
+            if len(item) > 3:
+                opts.update(item[3])
+            return opts
+    
+        def size(item):
+            opts = putKeywords(item)
+            if opts.has_key('data'):
+                return len(opts['data'])
+            if opts.has_key('stream'):
+                if opts.get('length') is not None:
+                    return opts['length']
+                return _remainingLength(opts['stream'])
+            # the node reads it from disk itself
+            return 0
+    
+        def start(item, early):
+            opts = putKeywords(item)
+            timeout = opts.pop('timeout', None)
+            id = opts.pop('id', None) or self._getUniqueId()
+            userCallback = opts.pop('callback', None)
+            def callback(status, value):
+                if status == 'pending' and value['header'] == 'URIGenerated':
+                    early(id, 'generated', value['URI'])
+                if userCallback is not None:
+                    userCallback(status, value)
+            return self.put(item[0], id=id, async=True, callback=callback,
+                            **opts), timeout
+    
+        return self._runBatch(items, start, concurrency, size, maxbytes)
+    
+    #@-node:putmany
     #@+node:putdir
     def putdir(self, uri, **kw):
         """
@@ -886,19 +1299,17 @@ class FCPNode:
                 raw = file(fullpath, "rb").read()
             
                 # determine CHK
-                uri = self.put("CHK@",
-                               data=raw,
-                               mimetype=mimetype,
-                               Verbosity=Verbosity,
-                               chkonly=True,
-                               priority=priority,
-                               )
+                uri = self.genchk(data=raw,
+                                  mimetype=mimetype,
+                                  Verbosity=Verbosity,
+                                  priority=priority,
+                                  )
             
                 if uri != filerec.get('uri', None):
                     filerec['changed'] = True
                     filerec['uri'] = uri
             
-                log(INFO, "%s -> %s" % (relpath, uri))
+                log(INFO, "%s -> %s", relpath, uri)
             
             #@-node:<<derive chks>>
             #@nl
@@ -938,7 +1349,7 @@ class FCPNode:
                     relpath = filerec['relpath']
                     mimetype = filerec['mimetype']
                 
-                    log(DETAIL, "n=%s relpath=%s" % (repr(n), repr(relpath)))
+                    log(DETAIL, "n=%r relpath=%r", n, relpath)
                 
                     msgLines.extend(["Files.%d.Name=%s" % (n, relpath),
                                      "Files.%d.UploadFrom=redirect" % n,
@@ -1005,14 +1416,10 @@ class FCPNode:
                     log(INFO, "putdir: all inserts completed (or failed)")
                     break
         
-                # wait and go round again if concurrent inserts are maxed
-                if nInserting >= maxConcurrent:
-                    time.sleep(1)
-                    continue
-        
-                # just go round again if manifest is empty (all remaining are in progress)
-                if len(manifest) == 0:
-                    time.sleep(1)
+                # wait and go round again if concurrent inserts are maxed,
+                # or if manifest is empty (all remaining are in progress)
+                if nInserting >= maxConcurrent or len(manifest) == 0:
+                    self._waitForSomeJob(jobs, 1)
                     continue
         
                 # got >0 waiting jobs and >0 spare slots, so we can submit a new one
@@ -1023,18 +1430,18 @@ class FCPNode:
         
                 #manifestDict[relpath] = filerec
         
-                log(INFO, "Launching insert of %s" % relpath)
+                log(INFO, "Launching insert of %s", relpath)
         
         
-                # gotta suck raw data, since we might be inserting to a remote FCP
-                # service (which means we can't use 'file=' (UploadFrom=pathmae) keyword)
-                raw = file(fullpath, "rb").read()
+                # gotta send raw data, since we might be inserting to a remote FCP
+                # service (which means we can't use 'file=' (UploadFrom=pathmae) keyword),
+                # but big files are streamed rather than sucked into memory
+                upload = uploadKeywords(fullpath)
         
                 print "globalMode=%s persistence=%s" % (globalMode, persistence)
         
                 # fire up the insert job asynchronously
                 job = self.put("CHK@",
-                               data=raw,
                                mimetype=mimetype,
                                async=1,
                                waituntilsent=1,
@@ -1043,6 +1450,7 @@ class FCPNode:
                                priority=priority,
                                Global=globalMode,
                                Persistence=persistence,
+                               **upload
                                )
                 jobs.append(job)
                 filerec['job'] = job
@@ -1051,7 +1459,7 @@ class FCPNode:
                 # wait for that job to finish if we are in the slow 'one at a time' mode
                 if not allAtOnce:
                     job.wait()
-                    log(INFO, "Insert finished for %s" % relpath)
+                    log(INFO, "Insert finished for %s", relpath)
         
             # all done
             log(INFO, "All raw files now inserted (or failed)")
@@ -1100,7 +1508,7 @@ class FCPNode:
                     log(ERROR, "File %s failed to insert" % relpath)
                     continue
         
-            log(DETAIL, "n=%s relpath=%s" % (repr(n), repr(relpath)))
+            log(DETAIL, "n=%r relpath=%r", n, relpath)
         
             msgLines.extend(["Files.%d.Name=%s" % (n, relpath),
                              ])
@@ -1200,6 +1608,10 @@ class FCPNode:
     def invertprivate(self, privatekey):
         """
         Converts an SSK or USK private key to a public equivalent
+        
+        The node is only asked once for each key on this connection,
+        whatever the path that follows it, and only once ever for keys in
+        the keyCache, if we have one.
         """
         privatekey = privatekey.strip().split("freenet:")[-1]
     
@@ -1211,10 +1623,21 @@ class FCPNode:
         bits = privatekey.split("/", 1)
         mainUri = bits[0]
     
-        uri = self.put(mainUri+"/foo", data="bar", chkonly=1)
-    
-        uri = uri.split("/")[0]
-        uri = "/".join([uri] + bits[1:])
+        # the private key itself is kept nowhere, just a hash of it
+        key = KeyCache.makeKey(mainUri)
+        pubUri = self.publicKeys.get(key, None)
+        if pubUri is None:
+            cache = self.keyCache
+            if cache is not None:
+                pubUri = cache.get(key)
+            if pubUri is None:
+                uri = self.put(mainUri+"/foo", data="bar", chkonly=1)
+                pubUri = uri.split("/")[0]
+                if cache is not None:
+                    cache.put(key, pubUri)
+            self.publicKeys[key] = pubUri
+    
+        uri = "/".join([pubUri] + bits[1:])
     
         if isUsk:
             uri = uri.replace("SSK@", "USK@")
@@ -1245,8 +1668,67 @@ class FCPNode:
     
         Keywords - optional:
             - mimetype - defaults to text/plain - THIS AFFECTS THE CHK!!
+            - stream, length, closeStream - as for put(), instead of file
+              or data
+    
+        If the node has a chkCache, and the same data has been seen before
+        with the same mimetype and other options, the CHK comes from there,
+        and nothing is sent to the node.
+        """
+        cache = self.chkCache
+        if cache is None or kw.get('async', False):
+            return self.put(chkonly=True, **kw)
+    
+        key = self._chkCacheKey(kw)
+        if key is None:
+            return self.put(chkonly=True, **kw)
+    
+        uri = cache.get(key)
+        if uri is None:
+            uri = self.put(chkonly=True, **kw)
+            cache.put(key, uri)
+        elif kw.get('closeStream', False):
+            kw['stream'].close()
+        return uri
+    
+    #@-node:genchk
+    #@+node:_chkCacheKey
+    def _chkCacheKey(self, kw):
+        """
+        Returns the chkCache key for genchk() keywords, or None if they
+        aren't something we can cache
         """
-        return self.put(chkonly=True, **kw)
+        uri = kw.get('uri', "CHK@")
+        if not uri.startswith("CHK@"):
+            return None
+    
+        h = hashlib.sha256()
+        if kw.has_key('data'):
+            h.update(kw['data'])
+        elif kw.has_key('file'):
+            _hashPath(h, kw['file'])
+        elif kw.has_key('stream') and hasattr(kw['stream'], 'seek'):
+            # read it through, then back for put() to read again
+            stream = kw['stream']
+            pos = stream.tell()
+            _feedHash(h, stream, kw.get('length'))
+            stream.seek(pos)
+        else:
+            return None
+    
+        # the mimetype put() would use
+        if kw.has_key('mimetype'):
+            mimetype = kw['mimetype']
+        elif kw.has_key('file'):
+            mimetype = mimetypes.guess_type(kw['file'])[0] or "text/plain"
+        else:
+            ext = os.path.splitext(uri)[1] or ".txt"
+            mimetype = mimetypes.guess_type(ext)[0] or "text/plain"
+    
+        return CHKCache.makeKey(h.hexdigest(), mimetype, uri=uri,
+                                nocompress=toBool(kw.get("nocompress", "false")),
+                                name=kw.get('name'),
+                                version=self.nodeVersion)
     
     #@-node:genchk
     #@+node:listpeers
@@ -1335,9 +1817,26 @@ class FCPNode:
                       - if status is 'failed' or 'pending', this will contain
                         a dict containing the response from node
             - Directory - directory to test
-            - WithReadDirectory - default False - if True, want node to read from directory for a put operation
-            - WithWriteDirectory - default False - if True, want node to write to directory for a get operation
-        """
+            - WantReadDirectory - default False - if True, want node to read from directory for a put operation
+            - WantWriteDirectory - default False - if True, want node to write to directory for a get operation
+    
+        The node allows what it has allowed for the rest of the connection,
+        so once it has, asking again about the same directory is answered
+        from here, without the handshake.
+        """
+        directory = os.path.abspath(kw.get('Directory', ""))
+        wants = []
+        for mode in ('Read', 'Write'):
+            if toBool(kw.get('Want%sDirectory' % mode, False)) == "true":
+                wants.append(mode)
+        grants = self.ddaGrants
+        if wants and not kw.get('async', False):
+            granted = [grants.get((self.connectionidentifier, directory, mode))
+                       for mode in wants]
+            if None not in granted:
+                if kw.has_key('callback'):
+                    kw['callback']('successful', granted[0])
+                return granted[0]
         
         requestResult = self._submitCmd("__global", "TestDDARequest", **kw)
         writeFilename = None;
@@ -1367,6 +1866,10 @@ class FCPNode:
                 os.remove( writeFilename );
             except OSError, msg:
                 pass;
+    
+        for mode in wants:
+            if responseResult.get('%sDirectoryAllowed' % mode) == "true":
+                grants[(self.connectionidentifier, directory, mode)] = responseResult
         return responseResult;
     
     #@-node:testDDA
@@ -1796,35 +2299,41 @@ class FCPNode:
     
     #@-node:purgePersistentJobs
     #@+node:getAllJobs
-    def getAllJobs(self):
+    def getAllJobs(self, **kw):
         """
-        Returns a list of persistent jobs, excluding global jobs
+        Returns a list of all jobs
+        
+        Keywords, here and for getPersistentJobs() and friends:
+            - prefix - only jobs whose identifiers start with this, eg
+              'freesitemgr|mysite|'
+            - complete - if True, only jobs which are complete, if False,
+              only jobs which are still running
         """
-        return self.jobs.values()
+        return self.jobs.select(**kw)
     
     #@-node:getAllJobs
     #@+node:getPersistentJobs
-    def getPersistentJobs(self):
+    def getPersistentJobs(self, **kw):
         """
         Returns a list of persistent jobs, excluding global jobs
         """
-        return [j for j in self.jobs.values() if j.isPersistent and not j.isGlobal]
+        return self.jobs.select('persistent', **kw)
     
     #@-node:getPersistentJobs
     #@+node:getGlobalJobs
-    def getGlobalJobs(self):
+    def getGlobalJobs(self, **kw):
         """
         Returns a list of global jobs
         """
-        return [j for j in self.jobs.values() if j.isGlobal]
+        return self.jobs.select('global', **kw)
     
     #@-node:getGlobalJobs
     #@+node:getTransientJobs
-    def getTransientJobs(self):
+    def getTransientJobs(self, **kw):
         """
         Returns a list of non-persistent, non-global jobs
         """
-        return [j for j in self.jobs.values() if not j.isPersistent]
+        return self.jobs.select('transient', **kw)
     
     #@-node:getTransientJobs
     #@+node:refreshPersistentRequests
@@ -1925,6 +2434,198 @@ class FCPNode:
         self.verbosity = verbosity
     
     #@-node:setVerbosity
+    #@+node:addHandler
+    def addHandler(self, header, handler):
+        """
+        Registers a handler for messages from the node with the given
+        header, in place of any already registered
+        
+        Arguments:
+            - header - the message header, eg 'FCPPluginReply'
+            - handler - a callable, called as handler(node, job, msg) in the
+              manager thread for each such message. 'job' is the JobTicket
+              for the message's Identifier - a new one if we have no job
+              under it - and 'msg' is the message, as a dict. To finish
+              the job, call job.callback() and job._putResult() as the
+              built-in handlers do
+        
+        Returns the handler this one replaces, or None, so that a handler
+        can pass on the messages it doesn't want:
+        
+            def onReply(node, job, msg):
+                if msg.get('PluginName') != 'plugins.MyPlugin':
+                    return old(node, job, msg)
+                ...
+            old = node.addHandler('FCPPluginReply', onReply)
+        
+        Messages with no handler fail their job with an FCPException
+        """
+        old = self.handlers.get(header, None)
+        self.handlers[header] = handler
+        return old
+    
+    #@-node:addHandler
+    #@+node:removeHandler
+    def removeHandler(self, header):
+        """
+        Drops the handler registered for the given message header, putting
+        back the built-in handler if there is one
+        """
+        name = self.rxHandlers.get(header, None)
+        if name is None:
+            self.handlers.pop(header, None)
+        else:
+            self.handlers[header] = getattr(self.__class__, name).im_func
+    
+    #@-node:removeHandler
+    #@+node:getMessageCounts
+    def getMessageCounts(self):
+        """
+        Returns a dict of how many messages of each header the node has
+        sent us since we connected, not counting the NodeHello
+        """
+        return self.rxCounts.copy()
+    
+    #@-node:getMessageCounts
+    #@+node:getReconnectStats
+    def getReconnectStats(self):
+        """
+        Returns a dict describing how well the connection has held up:
+            - connected - False while we're trying to reconnect
+            - reconnects - how many times we've reconnected
+            - downtime - total seconds spent disconnected, including now
+            - lastFailure - the exception the connection last failed with,
+              or None
+        """
+        downtime = self.downtime
+        disconnectedAt = self.disconnectedAt
+        if disconnectedAt is not None:
+            downtime += time.time() - disconnectedAt
+        return dict(connected=self.nodeIsAlive and not self.reconnecting,
+                    reconnects=self.reconnects,
+                    downtime=downtime,
+                    lastFailure=self.lastFailure)
+    
+    #@-node:getReconnectStats
+    #@+node:getMetrics
+    def getMetrics(self):
+        """
+        Returns a snapshot of what the connection has been doing, as a dict:
+            - enabled - whether we were created with metrics=True. If not,
+              messagesSent, bytesSent, latency and loop are left empty
+            - messagesSent, messagesReceived - dicts of message counts,
+              keyed by header
+            - bytesSent, bytesReceived - totals since we were created
+            - jobs - how many jobs we have, as a dict with keys
+              'persistent', 'global', 'transient' and 'incomplete'
+            - latency - histograms of how long jobs spend, keyed by stage
+              and then by command. Stages are 'sent' (from being queued
+              to being sent to the node), 'reply' (from being sent to the
+              node's first reply) and 'total' (from being queued till
+              complete)
+            - loop - histogram of the time the manager spends on each pass
+              through its loop, not counting the wait for something to do
+            - reconnects - as from getReconnectStats()
+            - coalescedGets - gets which shared another get's result
+            - cache, chkCache - the caches' getStats(), if we have them
+        
+        Each histogram is a dict of 'count', 'sum' (seconds) and 'buckets',
+        a list of (upper bound, how many took at most that long) pairs
+        """
+        metrics = self.metrics
+        reader = getattr(self, 'reader', None)
+        jobs = self.jobs
+    
+        snapshot = {
+            'enabled': metrics is not None,
+            'messagesSent': {},
+            'messagesReceived': self.rxCounts.copy(),
+            'bytesSent': 0,
+            'bytesReceived': reader and reader.nread or 0,
+            'jobs': {'persistent': len(jobs.kinds['persistent']),
+                     'global': len(jobs.kinds['global']),
+                     'transient': len(jobs.kinds['transient']),
+                     'incomplete': len(jobs.incomplete)},
+            'latency': {},
+            'loop': None,
+            'reconnects': self.getReconnectStats(),
+            'coalescedGets': self.coalescedGets,
+            }
+        if self.cache is not None:
+            snapshot['cache'] = self.cache.getStats()
+        if self.chkCache is not None:
+            snapshot['chkCache'] = self.chkCache.getStats()
+        if metrics is not None:
+            metrics.addTo(snapshot)
+        return snapshot
+    
+    #@-node:getMetrics
+    #@+node:getMetricsText
+    def getMetricsText(self):
+        """
+        Returns getMetrics() in the Prometheus text exposition format
+        """
+        m = self.getMetrics()
+        lines = []
+    
+        def labelled(name, labels):
+            if not labels:
+                return name
+            return "%s{%s}" % (name, ",".join(['%s="%s"' % (k, v)
+                                               for k, v in labels]))
+    
+        def metric(name, kind, samples):
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, value in samples:
+                lines.append("%s %s" % (labelled(name, labels), value))
+    
+        def histogram(name, hist, labels=()):
+            for le, n in hist['buckets'] + [("+Inf", hist['count'])]:
+                lines.append("%s %s" % (
+                    labelled(name + "_bucket", labels + (('le', le),)), n))
+            lines.append("%s %r" % (labelled(name + "_sum", labels), hist['sum']))
+            lines.append("%s %s" % (labelled(name + "_count", labels),
+                                    hist['count']))
+    
+        for name, counts in [("fcp_messages_sent_total", m['messagesSent']),
+                             ("fcp_messages_received_total",
+                              m['messagesReceived'])]:
+            metric(name, "counter", [((('header', hdr),), n)
+                                     for hdr, n in sorted(counts.items())])
+        metric("fcp_bytes_sent_total", "counter", [((), m['bytesSent'])])
+        metric("fcp_bytes_received_total", "counter", [((), m['bytesReceived'])])
+        metric("fcp_jobs", "gauge", [((('kind', kind),), n)
+                                     for kind, n in sorted(m['jobs'].items())])
+    
+        if m['latency']:
+            lines.append("# TYPE fcp_job_seconds histogram")
+            for stage, hists in sorted(m['latency'].items()):
+                for cmd, hist in sorted(hists.items()):
+                    histogram("fcp_job_seconds", hist,
+                              (('stage', stage), ('cmd', cmd)))
+        if m['loop']:
+            lines.append("# TYPE fcp_loop_seconds histogram")
+            histogram("fcp_loop_seconds", m['loop'])
+    
+        reconnects = m['reconnects']
+        metric("fcp_connected", "gauge", [((), int(reconnects['connected']))])
+        metric("fcp_reconnects_total", "counter", [((), reconnects['reconnects'])])
+        metric("fcp_downtime_seconds_total", "counter",
+               [((), "%r" % reconnects['downtime'])])
+        metric("fcp_coalesced_gets_total", "counter", [((), m['coalescedGets'])])
+        for name in ('cache', 'chkCache'):
+            if m.has_key(name):
+                prefix = {'cache': "fcp_cache", 'chkCache': "fcp_chk_cache"}[name]
+                stats = m[name]
+                metric(prefix + "_hits_total", "counter", [((), stats['hits'])])
+                metric(prefix + "_misses_total", "counter", [((), stats['misses'])])
+                if stats.has_key('bytesSaved'):
+                    metric(prefix + "_bytes_saved_total", "counter",
+                           [((), stats['bytesSaved'])])
+    
+        return "\n".join(lines) + "\n"
+    
+    #@-node:getMetricsText
     #@+node:shutdown
     def shutdown(self):
         """
@@ -1942,13 +2643,17 @@ class FCPNode:
     
         self.running = False
     
-        # give the manager thread a chance to bail out
-        time.sleep(pollTimeout * 3)
+        # kick the manager thread out of its select(), and anyone held
+        # back by the outbound budget
+        self._wake()
+        self._adjustOutbound(0)
     
         # wait for mgr thread to quit
         log(DETAIL, "shutdown: waiting for manager thread to terminate")
         self.shutdownLock.acquire()
         log(DETAIL, "shutdown: manager thread terminated")
+        self.wakeRx.close()
+        self.wakeTx.close()
     
         # shut down FCP connection
         if hasattr(self, 'socket'):
@@ -1956,6 +2661,9 @@ class FCPNode:
                 self.socket.close()
                 del self.socket
     
+        if self.recorder is not None:
+            self.recorder.close()
+    
         # and close the logfile
         if None != self.logfile and self.logfile not in [sys.stdout, sys.stderr]:
             self.logfile.close()
@@ -1972,6 +2680,41 @@ class FCPNode:
     # methods for manager thread
     
     #@+others
+    #@+node:_startManager
+    def _startManager(self):
+        """
+        Sets up the client request queue and launches the manager thread
+        """
+        # queue for incoming client requests, and a socket pair with
+        # which to wake the manager thread when something is queued
+        self.clientReqQueue = Queue.Queue()
+        self.wakeRx, self.wakeTx = socketpair()
+        self.wakeRx.setblocking(0)
+        self.wakeTx.setblocking(0)
+    
+        # heap of [time, seq, job] for JobTicket.wait() timeouts, which
+        # the manager thread fires from its select() timeout
+        self.deadlines = []
+        self.deadlinesDead = 0
+        self.deadlinesLock = threading.Lock()
+        self.deadlineSeq = itertools.count()
+    
+        # outgoing messages, which the manager thread sends whenever the
+        # socket will take them, and the count of bytes submitted but not
+        # yet sent, for holding back _submitCmd() callers
+        self.writer = self._newWriter()
+        self.outCond = threading.Condition(threading.Lock())
+        self.outBytes = 0
+    
+        # messages other threads send while we're reconnecting, held back
+        # till the session is going again
+        self.heldLock = threading.Lock()
+    
+        self.running = True
+        self.shutdownLock = threading.Lock()
+        thread.start_new_thread(self._mgrThread, ())
+    
+    #@-node:_startManager
     #@+node:_mgrThread
     def _mgrThread(self):
         """
@@ -1981,34 +2724,64 @@ class FCPNode:
         log = self._log
     
         self.shutdownLock.acquire()
+        self.mgrThreadId = thread.get_ident()
     
         log(DETAIL, "FCPNode: manager thread starting")
         try:
             while self.running:
-    
-                log(NOISY, "_mgrThread: Top of manager thread")
-    
-                # try for incoming messages from node
-                log(NOISY, "_mgrThread: Testing for incoming message")
-                if self._msgIncoming():
-                    log(DEBUG, "_mgrThread: Retrieving incoming message")
-                    msg = self._rxMsg()
-                    log(DEBUG, "_mgrThread: Got incoming message, dispatching")
-                    self._on_rxMsg(msg)
-                    log(DEBUG, "_mgrThread: back from on_rxMsg")
-                else:
-                    log(NOISY, "_mgrThread: No incoming message from node")
-        
-                # try for incoming requests from clients
-                log(NOISY, "_mgrThread: Testing for client req")
                 try:
-                    req = self.clientReqQueue.get(True, pollTimeout)
-                    log(DEBUG, "_mgrThread: Got client req, dispatching")
-                    self._on_clientReq(req)
-                    log(DEBUG, "_mgrThread: Back from on_clientReq")
-                except Queue.Empty:
-                    log(NOISY, "_mgrThread: No incoming client req")
-                    pass
+                    log(NOISY, "_mgrThread: Top of manager thread")
+                    metrics = self.metrics
+                    if metrics is not None:
+                        busySince = time.time()
+    
+                    # send off everything clients have queued up
+                    log(NOISY, "_mgrThread: Testing for client req")
+                    while True:
+                        try:
+                            req = self.clientReqQueue.get_nowait()
+                        except Queue.Empty:
+                            log(NOISY, "_mgrThread: No incoming client req")
+                            break
+                        log(DEBUG, "_mgrThread: Got client req, dispatching")
+                        self._on_clientReq(req)
+                        log(DEBUG, "_mgrThread: Back from on_clientReq")
+    
+                    # sleep till the node sends something, a client wakes us,
+                    # or a job's wait() times out
+                    log(NOISY, "_mgrThread: Waiting for incoming message")
+                    if metrics is not None:
+                        busy = time.time() - busySince
+                    incoming = self._msgIncoming(self._fireDeadlines())
+                    if metrics is not None:
+                        busySince = time.time()
+                    if incoming:
+                        log(DEBUG, "_mgrThread: Retrieving incoming message")
+                        msg = self._rxMsg()
+                        log(DEBUG, "_mgrThread: Got incoming message, dispatching")
+                        self._on_rxMsg(msg)
+                        log(DEBUG, "_mgrThread: back from on_rxMsg")
+                    else:
+                        log(NOISY, "_mgrThread: Woken up, no incoming message")
+                    if metrics is not None:
+                        metrics.observe("loop", None,
+                                        busy + time.time() - busySince)
+    
+                except (FCPNodeFailure, socket.error, select.error), e:
+                    # lost the connection - try to get it back, if we may
+                    if not (self.reconnect and self.running):
+                        raise
+                    if not self._reconnect(e):
+                        if self.running:
+                            raise
+                        break
+    
+            # get out whatever was sent before the shutdown
+            try:
+                if self.writer is not None:
+                    self.writer.flush()
+            except socket.error:
+                pass
     
             self._log(DETAIL, "_mgrThread: Manager thread terminated normally")
     
@@ -2016,6 +2789,9 @@ class FCPNode:
             traceback.print_exc()
             self._log(CRITICAL, "_mgrThread: manager thread crashed")
     
+            # nothing more can be done on this connection
+            self.nodeIsAlive = False
+    
             # send the exception to all waiting jobs
             for id, job in self.jobs.items():
                 job._putResult(e)
@@ -2023,23 +2799,387 @@ class FCPNode:
             # send the exception to all queued jobs
             while True:
                 try:
-                    job = self.clientReqQueue.get(True, pollTimeout)
+                    job = self.clientReqQueue.get_nowait()
                     job._putResult(e)
                 except Queue.Empty:
                     log(NOISY, "_mgrThread: No incoming client req")
                     break
     
+        # nobody's left to fire deadlines, so wake all the timed waiters
+        # and leave them to look after their own from now on
+        self._fireDeadlines(final=True)
+    
+        # and nobody's going to send anything more
+        self._adjustOutbound(0)
+    
         self.shutdownLock.release()
     
     #@-node:_mgrThread
+    #@+node:_reconnect
+    def _reconnect(self, e):
+        """
+        Called in the manager thread when the connection to the node has
+        failed with exception e. Keeps trying to connect again, with the
+        same client name, till it works, or reconnectTimeout runs out, or
+        we're shut down. Then gets our jobs going again - see
+        _resumeSession()
+        
+        Returns True if we're connected again
+        """
+        log = self._log
+        log(ERROR, "FCPNode: lost connection to node: %s" % e)
+    
+        self.reconnecting = True
+        self.held = []
+        self.disconnectedAt = time.time()
+        self.lastFailure = e
+        if self.reconnectTimeout is None:
+            giveUp = None
+        else:
+            giveUp = self.disconnectedAt + self.reconnectTimeout
+    
+        # whatever was waiting to go out is lost with the old socket
+        lost = self.writer.pending()
+        self.writer = None
+        self._adjustOutbound(-lost)
+        try:
+            self.socket.close()
+        except socket.error:
+            pass
+    
+        delay = reconnectDelay
+        while True:
+            try:
+                self._connect()
+                break
+            except Exception, e:
+                log(ERROR, "FCPNode: failed to reconnect: %s" % e)
+                self.lastFailure = e
+    
+            if giveUp is not None and time.time() + delay > giveUp:
+                log(CRITICAL, "FCPNode: giving up on reconnecting to node")
+                self._dropHeld()
+                return False
+    
+            # wait, waking for shutdown, and timing out waiters meanwhile
+            resume = time.time() + delay
+            while self.running and time.time() < resume:
+                timeout = resume - time.time()
+                nextDeadline = self._fireDeadlines()
+                if nextDeadline is not None:
+                    timeout = min(timeout, nextDeadline)
+                if select.select([self.wakeRx], [], [], max(timeout, 0))[0]:
+                    try:
+                        while self.wakeRx.recv(4096):
+                            pass
+                    except socket.error:
+                        pass
+            if not self.running:
+                self._dropHeld()
+                return False
+            delay = min(delay * 2, maxReconnectDelay)
+    
+        self.writer = self._newWriter()
+        self.reconnects += 1
+        self.downtime += time.time() - self.disconnectedAt
+        log(INFO, "FCPNode: reconnected to node after %.1f seconds" % (
+                  time.time() - self.disconnectedAt))
+        self.disconnectedAt = None
+        self.reconnecting = False
+    
+        self._resumeSession()
+    
+        # then what other threads sent meanwhile, in the order they sent it
+        self.heldLock.acquire()
+        try:
+            held, self.held = self.held, None
+            for pieces in held:
+                self._send(*pieces)
+        finally:
+            self.heldLock.release()
+        return True
+    
+    #@-node:_reconnect
+    #@+node:_dropHeld
+    def _dropHeld(self):
+        """
+        Gives up on the messages held back while reconnecting, since
+        there's no connection to send them on
+        """
+        self.heldLock.acquire()
+        try:
+            if self.held:
+                self._log(ERROR, "FCPNode: dropping %d messages held back "
+                                 "while reconnecting", len(self.held))
+            self.held = None
+        finally:
+            self.heldLock.release()
+    
+    #@-node:_dropHeld
+    #@+node:_resumeSession
+    def _resumeSession(self):
+        """
+        Gets our jobs going again after reconnecting:
+            - requests which only lasted as long as the old connection are
+              sent again, up to resubmitRetries times each. Those which
+              can't be repeated - uploads from a stream, or downloads to
+              a stream which has already had some of the data - fail
+              with FCPNodeFailure
+            - persistent and global jobs are left to pick up the node's
+              messages about them once it lists them to us again. Any it
+              doesn't list, it has lost, so they fail with FCPNodeFailure
+        """
+        log = self._log
+    
+        # a new connection, so the node has forgotten what it let us do
+        self.ddaGrants.clear()
+    
+        if self.watchGlobal is not None:
+            self._txMsg("WatchGlobal", **self.watchGlobal)
+    
+        for id, job in self.jobs.items():
+            if job.isComplete():
+                continue
+    
+            if job.isPersistent or job.isGlobal:
+                self.rebinding.add(id)
+                if hasattr(job, "gotPersistentDataFound"):
+                    # so it asks for its data again
+                    del job.gotPersistentDataFound
+                continue
+    
+            if not job.reqSent:
+                # not one of ours, just made up for a message from the node
+                continue
+    
+            job.resubmits = getattr(job, "resubmits", 0) + 1
+            if job.resubmits > self.resubmitRetries:
+                reason = "lost %d times" % job.resubmits
+            elif isinstance(job.kw.get('Data', None), _StreamData):
+                reason = "can't send upload stream again"
+            elif job.stream and job.cmd == 'ClientGet' and hasattr(job, 'mimetype'):
+                reason = "data already partly written to stream"
+            else:
+                log(INFO, "FCPNode: resubmitting %s:%s" % (job.cmd, id))
+                self._txMsg(job.cmd, **job.kw)
+                continue
+            job._putResult(FCPNodeFailure(
+                "%s:%s: node connection lost, %s" % (job.cmd, id, reason)))
+    
+        if self.rebinding:
+            self._relistPersistent()
+    
+    #@-node:_resumeSession
+    #@+node:_relistPersistent
+    def _relistPersistent(self):
+        """
+        Has the node list our persistent requests again, to rebind our
+        jobs to them, as soon as no other '__global' command is running
+        """
+        job = self.jobs.get('__global', None)
+        if job is not None and not job.isComplete() \
+        and job.cmd != "ListPersistentRequests":
+            # its replies would get mixed up with ours
+            job.whenComplete(lambda job: self._relistPersistent())
+            return
+    
+        if job is None or job.isComplete():
+            try:
+                job = self.refreshPersistentRequests(async=True)
+            except Exception, e:
+                self._log(ERROR, "FCPNode: can't relist persistent requests: %s" % e)
+                return
+        job.whenComplete(self._rebindDone)
+    
+    #@-node:_relistPersistent
+    #@+node:_rebindDone
+    def _rebindDone(self, listJob):
+        """
+        The node has listed its persistent requests again. Fails the jobs
+        it said nothing about - unless they're global and we aren't
+        watching the global queue, so it wouldn't have
+        """
+        rebinding = self.rebinding
+        self.rebinding = set()
+        for id in rebinding:
+            job = self.jobs.get(id, None)
+            if job is None or job.isComplete():
+                continue
+            if job.isGlobal and self.watchGlobal is None:
+                continue
+            self.jobs.pop(id, None)
+            job._putResult(FCPNodeFailure(
+                "%s:%s: node lost persistent request" % (job.cmd, id)))
+    
+    #@-node:_rebindDone
     #@+node:_msgIncoming
-    def _msgIncoming(self):
+    def _msgIncoming(self, timeout=None):
         """
+        Blocks until a message is coming in from the node, or until
+        another thread calls _wake(), or for at most 'timeout' seconds
+        if given. Meanwhile, sends off queued messages as the socket
+        takes them.
+        
         Returns True if a message is coming in from the node
         """
-        return len(select.select([self.socket], [], [], pollTimeout)[0]) > 0
+        # a whole message may already be sitting in the receive buffer
+        if self.reader.pending():
+            return True
+    
+        if self.writer.pending():
+            wlist = [self.socket]
+        else:
+            wlist = []
+        readable, writable = select.select(
+            [self.socket, self.wakeRx], wlist, [], timeout)[:2]
+        if writable:
+            # a chunk at a time, so we can read in between
+            self._adjustOutbound(-self.writer.flush(self.writer.chunksize))
+        if self.wakeRx in readable:
+            # swallow the wakeup bytes, the caller will look at the queue
+            try:
+                while self.wakeRx.recv(4096):
+                    pass
+            except socket.error:
+                pass
+        return self.socket in readable
     
     #@-node:_msgIncoming
+    #@+node:_wake
+    def _wake(self):
+        """
+        Wakes the manager thread if it's waiting in _msgIncoming
+        """
+        try:
+            self.wakeTx.send("x")
+        except socket.error:
+            # buffer full (so it's awake anyway) or we've shut down
+            pass
+    
+    #@-node:_wake
+    #@+node:_reserveOutbound
+    def _reserveOutbound(self, nbytes):
+        """
+        Waits till there's room under the outbound budget for a message
+        of about nbytes, and books it. A message bigger than the whole
+        budget only has to wait till everything before it has gone
+        """
+        self.outCond.acquire()
+        try:
+            # a callback submitting more must never hold up the manager
+            while self.outBytes > 0 \
+            and self.outBytes + nbytes > self.outboundBudget \
+            and thread.get_ident() != self.mgrThreadId:
+                if not (self.running and self.nodeIsAlive):
+                    raise FCPNodeFailure("node connection is shut down")
+                self.outCond.wait()
+            self.outBytes += nbytes
+        finally:
+            self.outCond.release()
+    
+    #@-node:_reserveOutbound
+    #@+node:_adjustOutbound
+    def _adjustOutbound(self, nbytes):
+        """
+        Adds nbytes (which may be negative) to the count of outbound
+        bytes, waking callers held back by _reserveOutbound
+        """
+        self.outCond.acquire()
+        try:
+            self.outBytes += nbytes
+            if nbytes <= 0:
+                self.outCond.notifyAll()
+        finally:
+            self.outCond.release()
+    
+    #@-node:_adjustOutbound
+    #@+node:_addDeadline
+    def _addDeadline(self, when, job):
+        """
+        Arranges for the manager thread to wake the threads waiting on
+        job at time 'when', so they can time out.
+        
+        Returns a handle to pass to _dropDeadline, or None if the manager
+        thread has stopped
+        """
+        entry = [when, self.deadlineSeq.next(), job]
+        self.deadlinesLock.acquire()
+        try:
+            if self.deadlines is None:
+                return None
+            heapq.heappush(self.deadlines, entry)
+            isFirst = self.deadlines[0] is entry
+        finally:
+            self.deadlinesLock.release()
+    
+        # manager thread needs to shorten its select() timeout
+        if isFirst:
+            self._wake()
+        return entry
+    
+    #@-node:_addDeadline
+    #@+node:_dropDeadline
+    def _dropDeadline(self, entry):
+        """
+        Cancels a deadline set up by _addDeadline
+        """
+        if entry is None:
+            return
+        self.deadlinesLock.acquire()
+        try:
+            if self.deadlines is None:
+                return
+            if entry[2] is not None:
+                entry[2] = None
+                self.deadlinesDead += 1
+    
+            # cancelled entries sit in the heap until they expire, so
+            # sweep them out before they pile up
+            if self.deadlinesDead > 64 \
+            and self.deadlinesDead * 2 > len(self.deadlines):
+                self.deadlines = [e for e in self.deadlines if e[2] is not None]
+                heapq.heapify(self.deadlines)
+                self.deadlinesDead = 0
+        finally:
+            self.deadlinesLock.release()
+    
+    #@-node:_dropDeadline
+    #@+node:_fireDeadlines
+    def _fireDeadlines(self, final=False):
+        """
+        Wakes the waiters of jobs whose deadlines have passed. If 'final'
+        is set, wakes all waiters with deadlines and refuses new ones.
+        
+        Returns the number of seconds till the next deadline, or None if
+        there are none
+        """
+        now = time.time()
+        expired = []
+        self.deadlinesLock.acquire()
+        try:
+            heap = self.deadlines
+            while heap and (final or heap[0][0] <= now):
+                entry = heapq.heappop(heap)
+                if entry[2] is None:
+                    self.deadlinesDead -= 1
+                else:
+                    expired.append(entry[2])
+                    entry[2] = None
+            if heap:
+                nextDeadline = max(heap[0][0] - now, 0)
+            else:
+                nextDeadline = None
+            if final:
+                self.deadlines = None
+        finally:
+            self.deadlinesLock.release()
+    
+        for job in expired:
+            job._notify()
+    
+        return nextDeadline
+    
+    #@-node:_fireDeadlines
     #@+node:_submitCmd
     def _submitCmd(self, id, cmd, **kw):
         """
@@ -2075,27 +3215,59 @@ class FCPNode:
     
         log = self._log
     
-        log(DEBUG, "_submitCmd: kw=%s" % kw)
+        log(DEBUG, "_submitCmd: kw=%s", kw)
     
         async = kw.pop('async', False)
+        waituntilsent = kw.pop('waituntilsent', False)
+        timeout = kw.pop('timeout', ONE_YEAR)
+        job = self._newJob(id, cmd, kw)
+    
+        log(DEBUG, "_submitCmd: timeout=%s", timeout)
+    
+        # wait our turn if too much is already waiting to go out
+        job.outReserved = len(kw.get('Data', "")) + len(kw.get('rawcmd', ""))
+        self._reserveOutbound(job.outReserved)
+    
+        self.clientReqQueue.put(job)
+        self._wake()
+    
+        log(DEBUG, "_submitCmd: id=%s cmd=%s kw=%.256s", id, cmd, kw)
+    
+    
+        if async:
+            if waituntilsent:
+                job.waitTillReqSent()
+            return job
+        elif cmd in ['WatchGlobal', "RemovePersistentRequest"]:
+            return
+        else:
+            log(DETAIL, "Waiting on job")
+            return job.wait(timeout)
+    
+    #@-node:_submitCmd
+    #@+node:_newJob
+    def _newJob(self, id, cmd, kw):
+        """
+        Creates the job ticket for a command, taking the job options out
+        of kw and leaving just the FCP message fields
+        """
         followRedirect = kw.pop('followRedirect', True)
         stream = kw.pop('stream', None)
-        waituntilsent = kw.pop('waituntilsent', False)
+        flush = kw.pop('flush', False)
+        buffer = kw.pop('buffer', None)
         keepjob = kw.pop('keep', False)
-        timeout = kw.pop('timeout', ONE_YEAR)
         if( kw.has_key( "kwdict" )):
             kwdict = kw[ "kwdict" ]
             del kw[ "kwdict" ]
             for key in kwdict.keys():
                 kw[ key ] = kwdict[ key ]
-        job = JobTicket(
-            self, id, cmd, kw,
+        job = self._makeJobTicket(
+            id, cmd, kw,
             verbosity=self.verbosity, logger=self._log, keep=keepjob,
-            stream=stream)
+            stream=stream, flush=flush, buffer=buffer)
     
-        log(DEBUG, "_submitCmd: timeout=%s" % timeout)
-        
         job.followRedirect = followRedirect
+        job.cacheResult = kw.pop('cacheResult', False)
     
         if cmd == 'ClientGet':
             job.uri = kw['URI']
@@ -2103,372 +3275,610 @@ class FCPNode:
         if cmd == 'ClientPut':
             job.mimetype = kw['Metadata.ContentType']
     
-        self.clientReqQueue.put(job)
+        return job
     
-        log(DEBUG, "_submitCmd: id=%s cmd=%s kw=%s" % (id, cmd, str(kw)[:256]))
+    #@-node:_newJob
+    #@+node:_makeJobTicket
+    def _makeJobTicket(self, id, cmd, kw, **opts):
+        """
+        Creates a JobTicket, or whatever kind of job ticket this node uses
+        """
+        return JobTicket(self, id, cmd, kw, **opts)
     
+    #@-node:_makeJobTicket
+    #@+node:_runBatch
+    def _runBatch(self, items, start, concurrency, size=None, maxbytes=None):
+        """
+        Runs requests for the items from an iterable, for getmany() and
+        putmany(), keeping at most 'concurrency' of them, and at most
+        'maxbytes' bytes of them, running at once
+        
+        Arguments:
+            - items - the iterable, only read from as there's room
+            - start - start(item, early) starts the request for an item,
+              returning its job ticket and timeout in seconds, or None.
+              early(id, status, value) may be called in the manager
+              thread to report progress on the job with Identifier 'id'
+            - concurrency - the most requests to have running
+            - size - size(item) gives the number of bytes of the item,
+              for 'maxbytes'
+            - maxbytes - the most bytes to have running
+        
+        Yields (item, status, value) for each early() report, and once
+        for each item when it completes, with status 'successful' and
+        the job's result, or 'failed' and an exception
+        """
+        items = iter(items)
+    
+        # we wait on this ticket, which each job pokes as there's news
+        batch = self._makeJobTicket(None, "batch", {})
+        events = collections.deque()
+        def early(id, status, value):
+            events.append((id, status, value))
+            batch._notify()
+        def onComplete(job):
+            if isinstance(job.result, Exception):
+                events.append((job.id, 'failed', job.result))
+            else:
+                events.append((job.id, 'successful', job.result))
+            batch._notify()
     
-        if async:
-            if waituntilsent:
-                job.waitTillReqSent()
-            return job
-        elif cmd in ['WatchGlobal', "RemovePersistentRequest"]:
+        running = {} # [job, item, nbytes, deadline] for each job id
+        inflight = 0
+        waiting = [] # next item, if it's too big to start yet
+        try:
+            while True:
+                # start requests till we're at our limits
+                while len(running) < concurrency:
+                    if not waiting:
+                        try:
+                            waiting.append(items.next())
+                        except StopIteration:
+                            break
+                    item = waiting[0]
+                    try:
+                        if size is None:
+                            nbytes = 0
+                        else:
+                            nbytes = size(item)
+                        if running and maxbytes is not None \
+                        and inflight + nbytes > maxbytes:
+                            break
+                        del waiting[0]
+                        job, timeout = start(item, early)
+                    except Exception, e:
+                        del waiting[:]
+                        yield item, 'failed', e
+                        continue
+                    if timeout is None:
+                        deadline = None
+                    else:
+                        deadline = time.time() + timeout
+                    running[job.id] = [job, item, nbytes, deadline]
+                    inflight += nbytes
+                    job.whenComplete(onComplete)
+    
+                if not running:
+                    return
+    
+                # wait for news, or for one to time out
+                deadlines = [r[3] for r in running.values() if r[3] is not None]
+                if deadlines:
+                    deadline = min(deadlines)
+                else:
+                    deadline = None
+                batch._waitFor(lambda: events, deadline)
+    
+                while events:
+                    id, status, value = events.popleft()
+                    r = running.get(id, None)
+                    if r is None:
+                        # abandoned
+                        continue
+                    if status in ('successful', 'failed'):
+                        del running[id]
+                        inflight -= r[2]
+                    yield r[1], status, value
+    
+                now = time.time()
+                for id, (job, item, nbytes, deadline) in running.items():
+                    if deadline is not None and deadline <= now:
+                        del running[id]
+                        inflight -= nbytes
+                        self._abandon(job)
+                        yield item, 'failed', FCPNodeTimeout(
+                            header="%s took too long for node response" % job.cmd,
+                            URI=job.kw.get('URI'))
+        finally:
+            for job, item, nbytes, deadline in running.values():
+                self._abandon(job)
+    
+    #@-node:_runBatch
+    #@+node:_abandon
+    def _abandon(self, job):
+        """
+        Asks the node to drop a request whose result nobody wants any more
+        """
+        if job.isComplete():
             return
+        job.abandoned = True
+        if job.isGlobal:
+            isGlobal = "true"
         else:
-            log(DETAIL, "Waiting on job")
-            return job.wait(timeout)
+            isGlobal = "false"
+        try:
+            job.node._txMsg("RemovePersistentRequest",
+                            Global=isGlobal,
+                            Identifier=job.id)
+        except Exception, e:
+            self._log(ERROR, "_abandon: %s:%s: %s" % (job.cmd, job.id, e))
     
-    #@-node:_submitCmd
-    #@+node:_on_clientReq
-    def _on_clientReq(self, job):
+    #@-node:_abandon
+    #@+node:_wantsData
+    def _wantsData(self, job):
         """
-        takes an incoming request job from client and transmits it to
-        the fcp port, and also registers it so the manager thread
-        can action responses from the fcp port.
+        Whether the data the node sends for a job is wanted - not if we've
+        forgotten the job, or abandoned it
         """
-        id = job.id
-        cmd = job.cmd
-        kw = job.kw
+        return job is not None and not getattr(job, 'abandoned', False)
     
-        # register the req
-        if cmd != 'WatchGlobal':
-            self.jobs[id] = job
-            self._log(DEBUG, "_on_clientReq: cmd=%s id=%s lock=%s" % (
-                cmd, repr(id), job.lock))
+    #@-node:_wantsData
+    #@+node:_coalescedGet
+    def _coalescedGet(self, id, opts):
+        """
+        Submits a get, unless an identical one is already running on the
+        node, in which case our job just waits for that one's result
         
-        # now can send, since we're the only one who will
-        self._txMsg(cmd, **kw)
+        Arguments are as for _submitCmd
+        """
+        key = (opts['URI'], opts['ReturnType'], opts['followRedirect'],
+               opts['IgnoreDS'], opts['DSOnly'],
+               str(opts['MaxRetries']), str(opts['MaxSize']))
+        async = opts.pop('async', False)
+        timeout = opts.pop('timeout', ONE_YEAR)
     
-        job.timeQueued = int(time.time())
+        self.inflightLock.acquire()
+        try:
+            leader = self.inflightGets.get(key)
+            if leader is None or getattr(leader, 'abandoned', False):
+                # nobody else is getting it, so we do
+                job = self._submitCmd(id, "ClientGet", async=True, **opts)
+                self.inflightGets[key] = job
+                job.whenComplete(lambda job: self._dropInflight(key, job))
+            else:
+                self._log(DETAIL, "get: %s already running as %s",
+                          opts['URI'], leader.id)
+                opts.pop('waituntilsent', None)
+                job = self._newJob(id, "ClientGet", opts)
+                job._reqWasSent()
+                self.coalescedGets += 1
+                leader.whenComplete(job._follow)
+        finally:
+            self.inflightLock.release()
     
-        job.reqSentLock.release()
+        if async:
+            return job
+        return job.wait(timeout)
     
-    #@-node:_on_clientReq
-    #@+node:_on_rxMsg
-    def _on_rxMsg(self, msg):
+    #@-node:_coalescedGet
+    #@+node:_dropInflight
+    def _dropInflight(self, key, job):
         """
-        Handles incoming messages from node
+        A get which others could wait on is done, so later gets of the key
+        must go to the node
+        """
+        self.inflightLock.acquire()
+        try:
+            if self.inflightGets.get(key) is job:
+                del self.inflightGets[key]
+        finally:
+            self.inflightLock.release()
+    
+    #@-node:_dropInflight
+    #@+node:_cachedGet
+    def _cachedGet(self, id, opts, hit):
+        """
+        Completes a get from a (mimetype, data) found in our cache, without
+        troubling the node
+        
+        Arguments are as for _submitCmd, plus the cache entry
+        """
+        mimetype, data = hit
+        async = opts.pop('async', False)
+        opts.pop('timeout', None)
+        opts.pop('waituntilsent', None)
+        job = self._newJob(id, "ClientGet", opts)
+        self._log(DETAIL, "get: %s from cache", job.uri)
+    
+        msg = FCPMessage("AllData", ("Identifier", "DataLength", "Global"),
+                         (id, str(len(data)), "false"))
+        if opts['ReturnType'] == 'none':
+            msg['Data'] = None
+            result = (mimetype, 1, msg)
+        elif job.stream:
+            job.stream.write(data)
+            if hasattr(job.stream, 'flush'):
+                job.stream.flush()
+            msg['Data'] = None
+            result = (mimetype, None, msg)
+        elif job.buffer is not None:
+            job.buffer[:] = data
+            msg['Data'] = job.buffer
+            result = (mimetype, job.buffer, msg)
+        else:
+            msg['Data'] = data
+            result = (mimetype, data, msg)
+    
+        job.mimetype = mimetype
+        job._reqWasSent()
+        job.callback('successful', result)
+        job._putResult(result)
+    
+        if async:
+            return job
+        return job.getResult()
+    
+    #@-node:_cachedGet
+    #@+node:_waitForSomeJob
+    def _waitForSomeJob(self, jobs, timeout):
+        """
+        Waits up to timeout seconds for the first incomplete job in
+        jobs to finish, whether it succeeds or fails
+        """
+        for job in jobs:
+            if not job.isComplete():
+                try:
+                    job.wait(timeout)
+                except Exception:
+                    pass
+                return
+    
+    #@-node:_waitForSomeJob
+    #@+node:_on_clientReq
+    def _on_clientReq(self, job):
+        """
+        takes an incoming request job from client and transmits it to
+        the fcp port, and also registers it so the manager thread
+        can action responses from the fcp port.
+        """
+        id = job.id
+        cmd = job.cmd
+        kw = job.kw
+    
+        # register the req
+        if cmd != 'WatchGlobal':
+            self.jobs[id] = job
+            self._log(DEBUG, "_on_clientReq: cmd=%s id=%r", cmd, id)
+        elif kw.get('Enabled', None) == "true":
+            self.watchGlobal = dict(kw)
+        else:
+            self.watchGlobal = None
+        
+        # now can send, since we're the only one who will
+        self._txMsg(cmd, **kw)
+    
+        # _txMsg() counted the bytes it queued, so drop our booking
+        self._adjustOutbound(-getattr(job, 'outReserved', 0))
+    
+        job.timeSent = time.time()
+        if self.metrics is not None:
+            self.metrics.observe("sent", cmd, job.timeSent - job.timeQueued)
+    
+        job._reqWasSent()
+    
+    #@-node:_on_clientReq
+    #@+node:_on_rxMsg
+    def _on_rxMsg(self, msg):
+        """
+        Handles incoming messages from node
         
+        Finds the job the message relates to, and passes both to the
+        handler registered for the message's header - see addHandler().
         If an incoming message represents the termination of a command,
-        the job ticket object will be notified accordingly
+        the handler notifies the job ticket accordingly
         """
-        log = self._log
-    
         # find the job this relates to
         id = msg.get('Identifier', '__global')
     
         hdr = msg['header']
     
+        counts = self.rxCounts
+        counts[hdr] = counts.get(hdr, 0) + 1
+    
+        if self.rebinding:
+            # the node still has this one
+            self.rebinding.discard(id)
+    
         job = self.jobs.get(id, None)
+        if 'Data' in msg and msg['Data'] is None and not self._wantsData(job):
+            # _rxMsg threw its data away, there being nobody to give it to
+            return
         if not job:
             # we have a global job and/or persistent job from last connection
-            log(DETAIL, "***** Got %s from unknown job id %s" % (hdr, repr(id)))
-            job = JobTicket(self, id, hdr, msg)
+            self._log(DETAIL, "***** Got %s from unknown job id %r", hdr, id)
+            job = self._makeJobTicket(id, hdr, msg)
             self.jobs[id] = job
+        elif job.timeReplied is None:
+            job.timeReplied = time.time()
+            if self.metrics is not None and job.timeSent is not None:
+                self.metrics.observe("reply", job.cmd,
+                                     job.timeReplied - job.timeSent)
+    
+        handler = self.handlers.get(hdr, None)
+        if handler is None:
+            self._on_unknownMsg(job, msg)
+        else:
+            handler(self, job, msg)
     
-        # action from here depends on what kind of message we got
-    
-        # -----------------------------
-        # handle GenerateSSK responses
-    
-        if hdr == 'SSKKeypair':
-            # got requested keys back
-            keys = (msg['RequestURI'], msg['InsertURI'])
-            job.callback('successful', keys)
-            job._putResult(keys)
-    
-            # and remove job from queue
-            self.jobs.pop(id, None)
-            return
-    
-        # -----------------------------
-        # handle ClientGet responses
-    
-        if hdr == 'DataFound':
-            if( job.kw.has_key( 'URI' )):
-                log(INFO, "Got DataFound for URI=%s" % job.kw['URI'])
-            else:
-                log(ERROR, "Got DataFound without URI")
-            mimetype = msg['Metadata.ContentType']
-            if job.kw.has_key('Filename'):
-                # already stored to disk, done
-                #resp['file'] = file
-                result = (mimetype, job.kw['Filename'], msg)
-                job.callback('successful', result)
-                job._putResult(result)
-                return
-    
-            elif job.kw['ReturnType'] == 'none':
-                result = (mimetype, 1, msg)
-                job.callback('successful', result)
-                job._putResult(result)
-                return
+    #@-node:_on_rxMsg
+    #@+node:Message Handlers
+    # handlers for the messages the node sends, registered by header in
+    # FCPNode.rxHandlers. Each is called as handler(node, job, msg)
     
-            # otherwise, we're expecting an AllData and will react to it then
-            else:
-                # is this a persistent get?
-                if job.kw['ReturnType'] == 'direct' \
-                and job.kw.get('Persistence', None) != 'connection':
-                    # gotta poll for request status so we can get our data
-                    # FIXME: this is a hack, clean it up
-                    log(INFO, "Request was persistent")
-                    if not hasattr(job, "gotPersistentDataFound"):
-                        if job.isGlobal:
-                            isGlobal = "true"
-                        else:
-                            isGlobal = "false"
-                        job.gotPersistentDataFound = True
-                        log(INFO, "  --> sending GetRequestStatus")
-                        self._txMsg("GetRequestStatus",
-                                    Identifier=job.kw['Identifier'],
-                                    Persistence=msg.get("Persistence", "connection"),
-                                    Global=isGlobal,
-                                    )
+    #@+others
+    #@+node:_on_SSKKeypair
+    def _on_SSKKeypair(self, job, msg):
+        """
+        GenerateSSK response - got requested keys back
+        """
+        keys = (msg['RequestURI'], msg['InsertURI'])
+        job.callback('successful', keys)
+        job._putResult(keys)
     
-                job.callback('pending', msg)
-                job.mimetype = mimetype
-                return
+        # and remove job from queue
+        self.jobs.pop(job.id, None)
     
-        if hdr == 'AllData':
-            result = (job.mimetype, msg['Data'], msg)
+    #@-node:_on_SSKKeypair
+    #@+node:_on_DataFound
+    def _on_DataFound(self, job, msg):
+        """
+        ClientGet has found its data, which is either already on disk,
+        or still to come in an AllData
+        """
+        log = self._log
+        if( job.kw.has_key( 'URI' )):
+            log(INFO, "Got DataFound for URI=%s", job.kw['URI'])
+        else:
+            log(ERROR, "Got DataFound without URI")
+        mimetype = msg['Metadata.ContentType']
+        if job.kw.has_key('Filename'):
+            # already stored to disk, done
+            result = (mimetype, job.kw['Filename'], msg)
             job.callback('successful', result)
             job._putResult(result)
             return
     
-        if hdr == 'GetFailed':
-            # see if it's just a redirect problem
-            if job.followRedirect and msg.get('ShortCodeDescription', None) == "New URI":
-                uri = msg['RedirectURI']
-                job.kw['URI'] = uri
-                job.kw['id'] = self._getUniqueId();
-                self._txMsg(job.cmd, **job.kw)
-                log(DETAIL, "Redirect to %s" % uri)
-                return
-            # see if it's just a TOO_MANY_PATH_COMPONENTS redirect
-            if job.followRedirect and msg.get('ShortCodeDescription', None) == "Too many path components":
-                uri = msg['RedirectURI']
-                job.kw['URI'] = uri
-                job.kw['id'] = self._getUniqueId();
-                self._txMsg(job.cmd, **job.kw)
-                log(DETAIL, "Redirect to %s" % uri)
-                return
-    
-            # return an exception
-            job.callback("failed", msg)
-            job._putResult(FCPGetFailed(msg))
+        elif job.kw.get('ReturnType', None) == 'none':
+            result = (mimetype, 1, msg)
+            job.callback('successful', result)
+            job._putResult(result)
             return
     
-        # -----------------------------
-        # handle ClientPut responses
+        # otherwise, we're expecting an AllData and will react to it then
+    
+        # is this a persistent get?
+        if job.kw.get('ReturnType', None) == 'direct' \
+        and job.kw.get('Persistence', None) != 'connection':
+            # gotta poll for request status so we can get our data
+            # FIXME: this is a hack, clean it up
+            log(INFO, "Request was persistent")
+            if not hasattr(job, "gotPersistentDataFound"):
+                if job.isGlobal:
+                    isGlobal = "true"
+                else:
+                    isGlobal = "false"
+                job.gotPersistentDataFound = True
+                log(INFO, "  --> sending GetRequestStatus")
+                self._txMsg("GetRequestStatus",
+                            Identifier=job.kw['Identifier'],
+                            Persistence=msg.get("Persistence", "connection"),
+                            Global=isGlobal,
+                            )
     
-        if hdr == 'URIGenerated':
+        job.callback('pending', msg)
+        job.mimetype = mimetype
     
-            job.uri = msg['URI']
-            newUri = msg['URI']
-            job.callback('pending', msg)
+    #@-node:_on_DataFound
+    #@+node:_on_AllData
+    def _on_AllData(self, job, msg):
+        """
+        The data for a ClientGet
+        """
+        result = (job.mimetype, msg['Data'], msg)
     
-            return
+        # after a redirect, only a CHK is sure to stay the same
+        if getattr(job, 'cacheResult', False) and msg['Data'] is not None \
+        and (job.kw['URI'] == job.uri or job.uri.startswith("CHK@")):
+            self.cache.put(job.uri, job.mimetype, msg['Data'])
     
-            # bail here if no data coming back
-            if job.kw.get('GetCHKOnly', False) == 'true':
-                # done - only wanted a CHK
-                job._putResult(newUri)
-                return
+        job.callback('successful', result)
+        job._putResult(result)
     
-        if hdr == 'PutSuccessful':
-            result = msg['URI']
-            job.callback('successful', result)
-            job._putResult(result)
-            #print "*** PUTSUCCESSFUL"
-            return
-    
-        if hdr == 'PutFailed':
-            job.callback('failed', msg)
-            job._putResult(FCPPutFailed(msg))
-            return
-        
-        if hdr == 'PutFetchable':
-            uri = msg['URI']
+    #@-node:_on_AllData
+    #@+node:_on_GetFailed
+    def _on_GetFailed(self, job, msg):
+        """
+        ClientGet failed - unless it's just a redirect, and we're
+        following those
+        """
+        # see if it's just a redirect problem, or a TOO_MANY_PATH_COMPONENTS
+        # redirect
+        if job.followRedirect and msg.get('ShortCodeDescription', None) in \
+           ("New URI", "Too many path components"):
+            uri = msg['RedirectURI']
             job.kw['URI'] = uri
-            job.callback('pending', msg)
+            job.kw['id'] = self._getUniqueId();
+            self._txMsg(job.cmd, **job.kw)
+            self._log(DETAIL, "Redirect to %s", uri)
             return
     
-        # -----------------------------
-        # handle ConfigData
-        if hdr == 'ConfigData':
-            # return all the data recieved
-            job.callback('successful', msg)
-            job._putResult(msg)
-    
-            # remove job from queue
-            self.jobs.pop(id, None)
-            return
+        # return an exception
+        job.callback("failed", msg)
+        job._putResult(FCPGetFailed(msg))
     
-        # -----------------------------
-        # handle progress messages
+    #@-node:_on_GetFailed
+    #@+node:_on_URIGenerated
+    def _on_URIGenerated(self, job, msg):
+        """
+        ClientPut has worked out the key its data will go under
+        """
+        job.uri = msg['URI']
+        job.callback('pending', msg)
     
-        if hdr == 'StartedCompression':
-            job.callback('pending', msg)
-            return
+    #@-node:_on_URIGenerated
+    #@+node:_on_PutSuccessful
+    def _on_PutSuccessful(self, job, msg):
+        """
+        ClientPut or ClientPutComplexDir is done
+        """
+        result = msg['URI']
+        job.callback('successful', result)
+        job._putResult(result)
     
-        if hdr == 'FinishedCompression':
-            job.callback('pending', msg)
-            return
+    #@-node:_on_PutSuccessful
+    #@+node:_on_PutFailed
+    def _on_PutFailed(self, job, msg):
+        """
+        ClientPut or ClientPutComplexDir failed
+        """
+        job.callback('failed', msg)
+        job._putResult(FCPPutFailed(msg))
     
-        if hdr == 'SimpleProgress':
-            job.callback('pending', msg)
-            return
+    #@-node:_on_PutFailed
+    #@+node:_on_PutFetchable
+    def _on_PutFetchable(self, job, msg):
+        """
+        The inserted data can be fetched, though the insert goes on
+        """
+        uri = msg['URI']
+        job.kw['URI'] = uri
+        job.callback('pending', msg)
     
-        if hdr == 'SendingToNetwork':
-            job.callback('pending', msg)
-            return
-        
-        # -----------------------------
-        # handle FCPPluginMessage replies
-        
-        if hdr == 'FCPPluginReply':
-            job._appendMsg(msg)
-            job.callback('successful', job.msgs)
-            job._putResult(job.msgs)
-            return   
-        
-        # -----------------------------
-        # handle peer management messages
-        
-        if hdr == 'EndListPeers':
-            job._appendMsg(msg)
-            job.callback('successful', job.msgs)
-            job._putResult(job.msgs)
-            return   
-        
-        if hdr == 'Peer':
-            if(job.cmd == "ListPeers"):
-                job.callback('pending', msg)
-                job._appendMsg(msg)
-            else:
-                job.callback('successful', msg)
-                job._putResult(msg)
-            return
-        
-        if hdr == 'PeerRemoved':
-            job._appendMsg(msg)
-            job.callback('successful', job.msgs)
-            job._putResult(job.msgs)
-            return   
-        
-        if hdr == 'UnknownNodeIdentifier':
-            job._appendMsg(msg)
-            job.callback('failed', job.msgs)
-            job._putResult(job.msgs)
-            return   
-    
-        # -----------------------------
-        # handle peer note management messages
-        
-        if hdr == 'EndListPeerNotes':
-            job._appendMsg(msg)
-            job.callback('successful', job.msgs)
-            job._putResult(job.msgs)
-            return   
-        
-        if hdr == 'PeerNote':
-            if(job.cmd == "ListPeerNotes"):
-                job.callback('pending', msg)
-                job._appendMsg(msg)
-            else:
-                job.callback('successful', msg)
-                job._putResult(msg)
-            return
-        
-        if hdr == 'UnknownPeerNoteType':
-            job._appendMsg(msg)
-            job.callback('failed', job.msgs)
-            job._putResult(job.msgs)
-            return   
+    #@-node:_on_PutFetchable
+    #@+node:_on_progress
+    def _on_progress(self, job, msg):
+        """
+        Progress reports - StartedCompression, SimpleProgress and the
+        like - which are passed on to the job's callback
+        """
+        job.callback('pending', msg)
     
-        # -----------------------------
-        # handle persistent job messages
+    #@-node:_on_progress
+    #@+node:_on_reply
+    def _on_reply(self, job, msg):
+        """
+        Single-message replies - ConfigData, NodeData, TestDDAReply and
+        the like - which complete the job with the message itself
+        """
+        # return all the data recieved
+        job.callback('successful', msg)
+        job._putResult(msg)
     
-        if hdr == 'PersistentGet':
-            job.callback('pending', msg)
-            job._appendMsg(msg)
-            return
+        # remove job from queue
+        self.jobs.pop(job.id, None)
     
-        if hdr == 'PersistentPut':
-            job.callback('pending', msg)
-            job._appendMsg(msg)
-            return
+    #@-node:_on_reply
+    #@+node:_on_listItem
+    def _on_listItem(self, job, msg):
+        """
+        One entry of a list the node is sending - a persistent request,
+        a peer, a peer note - kept on the job till the list ends
+        """
+        job.callback('pending', msg)
+        job._appendMsg(msg)
     
-        if hdr == 'PersistentPutDir':
-            job.callback('pending', msg)
-            job._appendMsg(msg)
-            return
+    #@-node:_on_listItem
+    #@+node:_on_listEnd
+    def _on_listEnd(self, job, msg):
+        """
+        End of a list - EndListPeers, FCPPluginReply and the like. The job
+        completes with all the messages it has been sent
+        """
+        job._appendMsg(msg)
+        job.callback('successful', job.msgs)
+        job._putResult(job.msgs)
     
-        if hdr == 'EndListPersistentRequests':
-            job._appendMsg(msg)
-            job.callback('successful', job.msgs)
-            job._putResult(job.msgs)
-            return
-        
-        if hdr == 'PersistentRequestRemoved':
-            if self.jobs.has_key(id):
-                del self.jobs[id]
-            return
-        
-        # -----------------------------
-        # handle testDDA messages
-        
-        if hdr == 'TestDDAReply':
-            # return all the data recieved
-            job.callback('successful', msg)
-            job._putResult(msg)
+    #@-node:_on_listEnd
+    #@+node:_on_listFailed
+    def _on_listFailed(self, job, msg):
+        """
+        The node doesn't know the peer or note type asked for
+        """
+        job._appendMsg(msg)
+        job.callback('failed', job.msgs)
+        job._putResult(job.msgs)
     
-            # remove job from queue
-            self.jobs.pop(id, None)
-            return
-        
-        if hdr == 'TestDDAComplete':
-            # return all the data recieved
+    #@-node:_on_listFailed
+    #@+node:_on_Peer
+    def _on_Peer(self, job, msg):
+        """
+        A peer - either one of a ListPeers, or the answer to a
+        ListPeer, AddPeer or ModifyPeer
+        """
+        if(job.cmd == "ListPeers"):
+            self._on_listItem(job, msg)
+        else:
             job.callback('successful', msg)
             job._putResult(msg)
     
-            # remove job from queue
-            self.jobs.pop(id, None)
-            return
-    
-        # -----------------------------
-        # handle NodeData
-        if hdr == 'NodeData':
-            # return all the data recieved
+    #@-node:_on_Peer
+    #@+node:_on_PeerNote
+    def _on_PeerNote(self, job, msg):
+        """
+        A peer note - either one of a ListPeerNotes, or the answer to a
+        ModifyPeerNote
+        """
+        if(job.cmd == "ListPeerNotes"):
+            self._on_listItem(job, msg)
+        else:
             job.callback('successful', msg)
             job._putResult(msg)
     
-            # remove job from queue
-            self.jobs.pop(id, None)
-            return
-    
-        # -----------------------------
-        # handle various errors
+    #@-node:_on_PeerNote
+    #@+node:_on_PersistentRequestRemoved
+    def _on_PersistentRequestRemoved(self, job, msg):
+        """
+        The node has dropped a persistent request, so we drop its job
+        """
+        self.jobs.pop(job.id, None)
     
-        if hdr == 'ProtocolError':
-            job.callback('failed', msg)
-            job._putResult(FCPProtocolError(msg))
-            return
+        # any gets sharing an abandoned job's result mustn't wait forever
+        if getattr(job, 'abandoned', False) and not job.isComplete():
+            job._putResult(FCPGetFailed(msg))
     
-        if hdr == 'IdentifierCollision':
-            log(ERROR, "IdentifierCollision on id %s ???" % id)
-            job.callback('failed', msg)
-            job._putResult(Exception("Duplicate job identifier %s" % id))
-            return
+    #@-node:_on_PersistentRequestRemoved
+    #@+node:_on_ProtocolError
+    def _on_ProtocolError(self, job, msg):
+        """
+        The node didn't like what we sent
+        """
+        job.callback('failed', msg)
+        job._putResult(FCPProtocolError(msg))
     
-        # -----------------------------
-        # wtf is happening here?!?
+    #@-node:_on_ProtocolError
+    #@+node:_on_IdentifierCollision
+    def _on_IdentifierCollision(self, job, msg):
+        """
+        We reused an identifier the node already has a request under
+        """
+        self._log(ERROR, "IdentifierCollision on id %s ???" % job.id)
+        job.callback('failed', msg)
+        job._putResult(Exception("Duplicate job identifier %s" % job.id))
     
-        log(ERROR, "Unknown message type from node: %s" % hdr)
+    #@-node:_on_IdentifierCollision
+    #@+node:_on_unknownMsg
+    def _on_unknownMsg(self, job, msg):
+        """
+        A message with no handler registered - wtf is happening here?!?
+        """
+        self._log(ERROR, "Unknown message type from node: %s" % msg['header'])
         job.callback('failed', msg)
         job._putResult(FCPException(msg))
-        return
-    #@-node:_on_rxMsg
+    
+    #@-node:_on_unknownMsg
+    #@-others
+    
+    #@-node:Message Handlers
     #@-others
     
     #@-node:Manager Thread
@@ -2476,6 +3886,48 @@ class FCPNode:
     # low level noce comms methods
     
     #@+others
+    #@+node:_connect
+    def _connect(self):
+        """
+        Opens the FCP socket and does the hello handshake
+        """
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if(None != self.socketTimeout):
+            try:
+                self.socket.settimeout(self.socketTimeout)
+            except Exception, e:
+                # Socket timeout setting is not available until Python 2.3, so ignore exceptions
+                pass
+        try:
+            self.socket.connect((self.host, self.port))
+        except Exception, e:
+            raise Exception("Failed to connect to %s:%s - %s" % (self.host,
+                                                                 self.port,
+                                                                 e))
+        if self.metrics is not None and getattr(self, 'reader', None) is not None:
+            # keep the count from the last connection
+            self.metrics.received(self.reader.nread)
+        self.reader = FCPReader(self.socket)
+        if self.recorder is not None:
+            self.recorder.connected()
+            self.reader.tap = self.recorder.received
+    
+        # now do the hello
+        self._hello()
+    
+    #@-node:_connect
+    #@+node:_newWriter
+    def _newWriter(self):
+        """
+        Returns an FCPWriter for the socket, telling our recorder, if any,
+        what it sends
+        """
+        writer = FCPWriter(self.socket)
+        if self.recorder is not None:
+            writer.tap = self.recorder.sent
+        return writer
+    
+    #@-node:_newWriter
     #@+node:_hello
     def _hello(self):
         """
@@ -2552,11 +4004,14 @@ class FCPNode:
         """
         log = self._log
     
+        if self.metrics is not None:
+            self.metrics.count(msgType)
+    
         # just send the raw command, if given    
         rawcmd = kw.get('rawcmd', None)
         if rawcmd:
-            self.socket.sendall(rawcmd)
-            log(DETAIL, "CLIENT: %s" % rawcmd)
+            self._send(rawcmd)
+            log(DETAIL, "CLIENT: %s", rawcmd)
             return
     
         if kw.has_key("Data"):
@@ -2566,87 +4021,120 @@ class FCPNode:
             data = None
             sendEndMessage = True
     
+        # only pay for logging each line if it's going anywhere
+        detail = self.verbosity >= DETAIL
+    
         items = [msgType + "\n"]
-        log(DETAIL, "CLIENT: %s" % msgType)
+        if detail:
+            log(DETAIL, "CLIENT: %s", msgType)
     
         #print "CLIENT: %s" % msgType
         for k, v in kw.items():
             #print "CLIENT: %s=%s" % (k,v)
             line = k + "=" + str(v)
             items.append(line + "\n")
-            log(DETAIL, "CLIENT: %s" % line)
+            if detail:
+                log(DETAIL, "CLIENT: %s", line)
     
         if data != None:
             items.append("DataLength=%d\n" % len(data))
-            log(DETAIL, "CLIENT: DataLength=%d" % len(data))
             items.append("Data\n")
-            log(DETAIL, "CLIENT: ...data...")
-            items.append(data)
+            if detail:
+                log(DETAIL, "CLIENT: DataLength=%d", len(data))
+                log(DETAIL, "CLIENT: ...data...")
     
         #print "sendEndMessage=%s" % sendEndMessage
     
         if sendEndMessage:
             items.append("EndMessage\n")
-            log(DETAIL, "CLIENT: EndMessage")
-        raw = "".join(items)
+            if detail:
+                log(DETAIL, "CLIENT: EndMessage")
     
-        self.socket.sendall(raw)
+        if self.trace is not None:
+            if data is None:
+                dataLength = None
+            else:
+                dataLength = len(data)
+            self._trace('out', msgType, kw, dataLength)
+    
+        # the payload goes as is, rather than being joined onto the header
+        if data != None:
+            self._send("".join(items), data)
+        else:
+            self._send("".join(items))
     
     #@-node:_txMsg
+    #@+node:_send
+    def _send(self, *pieces):
+        """
+        Queues the pieces of a raw message for the manager thread to send
+        to the node, or sends it right away if the manager isn't yet running.
+        While the manager thread is reconnecting, other threads' messages
+        are held back till it has got the session going again
+        """
+        if (self.held is not None or self.writer is None) \
+        and self.mgrThreadId is not None \
+        and thread.get_ident() != self.mgrThreadId:
+            # the manager thread is reconnecting, or has given up on it
+            self.heldLock.acquire()
+            try:
+                if self.held is not None:
+                    self.held.append(pieces)
+                    return
+                if self.writer is None:
+                    raise FCPNodeFailure("node connection is lost")
+            finally:
+                self.heldLock.release()
+    
+        if self.writer is None:
+            raw = "".join(pieces)
+            if self.recorder is not None:
+                self.recorder.sent(raw)
+            self.socket.sendall(raw)
+            if self.metrics is not None:
+                self.metrics.sent(len(raw))
+            return
+    
+        nbytes = self.writer.write(pieces)
+        self._adjustOutbound(nbytes)
+        if self.metrics is not None:
+            self.metrics.sent(nbytes)
+    
+        # the manager sends as soon as it's back in select(), but someone
+        # else calling us - such as JobTicket.cancel() - must wake it
+        if thread.get_ident() != self.mgrThreadId:
+            self._wake()
+    
+    #@-node:_send
     #@+node:_rxMsg
     def _rxMsg(self):
         """
-        Receives and returns a message as a dict
+        Receives and returns a message as an FCPMessage, which can be
+        used as a dict
         
         The header keyword is included as key 'header'
         """
         log = self._log
     
-        log(DETAIL, "NODE: ----------------------------")
-    
-        # shorthand, for reading n bytes
-        def read(n):
-            if n > 1:
-                log(DEBUG, "read: want %d bytes" % n)
-            chunks = []
-            remaining = n
-            while remaining > 0:
-                chunk = self.socket.recv(remaining)
-                chunklen = len(chunk)
-                if chunk:
-                    chunks.append(chunk)
-                else:
-                    self.nodeIsAlive = False
-                    raise FCPNodeFailure("FCP socket closed by node")
-                remaining -= chunklen
-                if remaining > 0:
-                    if n > 1:
-                        log(DEBUG,
-                            "wanted %s, got %s still need %s bytes" % (n, chunklen, remaining)
-                            )
-                    pass
-            buf = "".join(chunks)
-            return buf
+        reader = self.reader
     
-        # read a line
-        def readln():
-            buf = []
-            while True:
-                c = read(1)
-                buf.append(c)
-                if c == '\n':
-                    break
-            ln = "".join(buf)
-            log(DETAIL, "NODE: " + ln[:-1])
-            return ln
+        # read a line, logging it only if it's going anywhere
+        if self.verbosity >= DETAIL:
+            log(DETAIL, "NODE: ----------------------------")
+            def readln():
+                ln = reader.readln()
+                log(DETAIL, "NODE: %s", ln[:-1])
+                return ln
+        else:
+            readln = reader.readln
     
-        items = {}
+        keys = []
+        values = []
     
         # read the header line
         while True:
-            line = readln().strip()
-            if line:
-                items['header'] = line
+            header = readln().strip()
+            if header:
                 break
     
         # read the body
@@ -2657,53 +4145,70 @@ class FCPNode:
     
             if line == 'Data':
                 # read the following data
+                items = FCPMessage(header, keys, values)
                 
                 # try to locate job
                 id = items['Identifier']
-                job = self.jobs[id]
+                job = self.jobs.get(id, None)
+                if not self._wantsData(job):
+                    # a late reply to a request we've forgotten or abandoned
+                    reader.skip(items['DataLength'])
+                    items['Data'] = None
+                    log(INFO, "NODE: discarded %d bytes of data for %s %r",
+                        items['DataLength'], header, id)
+                    return items
                 if job.stream:
-                    # loop to transfer from socket to stream
-                    remaining = items['DataLength']
-                    stream = job.stream
-                    while remaining > 0:
-                        buf = self.socket.recv(remaining)
-                        stream.write(buf)
-                        stream.flush()
-                        remaining -= len(buf)
+                    # transfer from socket to stream
+                    reader.readToStream(items['DataLength'], job.stream,
+                                        job.flushStream)
                     items['Data'] = None
-                else:
-                    buf = read(items['DataLength'])
+                elif job.buffer is not None:
+                    # straight from socket into the caller's bytearray
+                    buf = job.buffer
+                    resizeBuffer(buf, items['DataLength'])
+                    reader.readInto(buf)
                     items['Data'] = buf
-                log(DETAIL, "NODE: ...<%d bytes of data>" % len(buf))
-                break
+                else:
+                    items['Data'] = reader.read(items['DataLength'])
+                log(DETAIL, "NODE: ...<%d bytes of data>", items['DataLength'])
+                if self.trace is not None:
+                    self._trace('in', header, items, items['DataLength'])
+                return items
             else:
                 # it's a normal 'key=val' pair
                 try:
                     k, v = line.split("=", 1)
                 except:
-                    log(ERROR, "_rxMsg: barfed splitting '%s'" % repr(line))
+                    log(ERROR, "_rxMsg: barfed splitting %r", line)
                     raise
     
-                # attempt int conversion
-                try:
-                    v = int(v)
-                except:
-                    pass
-    
-                items[k] = v
+                # numeric fields are converted when looked at
+                keys.append(k)
+                values.append(v)
     
         # all done
-        return items
+        msg = FCPMessage(header, keys, values)
+        if self.trace is not None:
+            self._trace('in', header, msg, None)
+        return msg
     
     #@-node:_rxMsg
     #@+node:_log
-    def _log(self, level, msg):
+    def _log(self, level, msg, *args):
         """
         Logs a message. If level > verbosity, don't output it
+        
+        Any args are formatted into the message, as msg % args, once we
+        know it's wanted, so busy code should pass them, and not do the
+        formatting itself
         """
         if level > self.verbosity:
             return
+        if args:
+            msg = msg % args
     
+        if(None != self.logger):
+            self.logger.log(loggingLevels.get(level, logging.DEBUG), msg)
         if(None != self.logfile):
             if not msg.endswith("\n"):
                 msg += "\n"
@@ -2717,6 +4222,22 @@ class FCPNode:
                 self.logfunc(msgline)
     
     #@-node:_log
+    #@+node:_trace
+    def _trace(self, direction, header, fields, dataLength):
+        """
+        Passes a message to the trace function
+        """
+        fields = dict(fields)
+        fields.pop('header', None)
+        fields.pop('Data', None)
+        self.trace({'time': time.time(),
+                    'direction': direction,
+                    'header': header,
+                    'fields': fields,
+                    'dataLength': dataLength,
+                    })
+    
+    #@-node:_trace
     #@-others
     #@-node:Low Level Methods
     #@-others
@@ -2761,11 +4282,14 @@ class JobTicket:
         self._log = opts.get('logger', self.defaultLogger)
         self.keep = opts.get('keep', False)
         self.stream = opts.get('stream', None)
+        self.flushStream = opts.get('flush', False)
+        self.buffer = opts.get('buffer', None)
         self.followRedirect = opts.get('followRedirect', False)
     
         # find out if persistent
         if kw.get("Persistent", "connection") != "connection" \
-        or kw.get("PersistenceType", "connection") != "connection":
+        or kw.get("PersistenceType", "connection") != "connection" \
+        or kw.get("Persistence", "connection") != "connection":
             self.isPersistent = True
         else:
             self.isPersistent = False
@@ -2784,17 +4308,18 @@ class JobTicket:
             self.callback = callback
     
         self.timeout = int(kw.pop('timeout', 86400*365))
-        self.timeQueued = int(time.time())
+        self.timeQueued = time.time()
         self.timeSent = None
+        self.timeReplied = None
+        self.timeDone = None
     
-        self.lock = threading.Lock()
-        #print "** JobTicket.__init__: lock=%s" % self.lock
-    
-        self.lock.acquire()
+        # waiters sleep on this till the request is sent and again till
+        # it completes, and get notified as each happens
+        self.cond = threading.Condition(threading.Lock())
         self.result = None
-    
-        self.reqSentLock = threading.Lock()
-        self.reqSentLock.acquire()
+        self.done = False
+        self.reqSent = False
+        self.completionHooks = []
     
     #@-node:__init__
     #@+node:isComplete
@@ -2812,68 +4337,35 @@ class JobTicket:
         """
         log = self._log
     
-        log(DEBUG, "wait:%s:%s: timeout=%ss" % (self.cmd, self.id, timeout))
+        log(DEBUG, "wait:%s:%s: timeout=%ss", self.cmd, self.id, timeout)
     
         # wait forever for job to complete, if no timeout given
         if timeout == None:
-            log(DEBUG, "wait:%s:%s: no timeout" % (self.cmd, self.id))
-            while not self.lock.acquire(False):
-                time.sleep(0.1)
-            self.lock.release()
+            log(DEBUG, "wait:%s:%s: no timeout", self.cmd, self.id)
+            self._waitFor(lambda: self.done)
             return self.getResult()
     
-        # wait for timeout
-        then = int(time.time())
+        deadline = time.time() + timeout
     
         # ensure command has been sent, wait if not
-        while not self.reqSentLock.acquire(False):
-    
-            # how long have we waited?
-            elapsed = int(time.time()) - then
-    
-            # got any time left?
-            if elapsed < timeout:
-                # yep, patience remains
-                time.sleep(1)
-                log(DEBUG, "wait:%s:%s: job not dispatched, timeout in %ss" % \
-                     (self.cmd, self.id, timeout-elapsed))
-                continue
-    
-            # no - timed out waiting for job to be sent to node
-            log(DEBUG, "wait:%s:%s: timeout on send command" % (self.cmd, self.id))
+        if not self._waitFor(lambda: self.reqSent or self.done, deadline):
+            # timed out waiting for job to be sent to node
+            log(DEBUG, "wait:%s:%s: timeout on send command", self.cmd, self.id)
             raise FCPSendTimeout(
                     header="Command '%s' took too long to be sent to node" % self.cmd
                     )
     
-        log(DEBUG, "wait:%s:%s: job now dispatched" % (self.cmd, self.id))
+        log(DEBUG, "wait:%s:%s: job now dispatched", self.cmd, self.id)
     
         # wait now for node response
-        while not self.lock.acquire(False):
-            # how long have we waited?
-            elapsed = int(time.time()) - then
-    
-            # got any time left?
-            if elapsed < timeout:
-                # yep, patience remains
-                time.sleep(2)
-    
-                #print "** lock=%s" % self.lock
-    
-                if timeout < ONE_YEAR:
-                    log(DEBUG, "wait:%s:%s: awaiting node response, timeout in %ss" % \
-                         (self.cmd, self.id, timeout-elapsed))
-                continue
-    
-            # no - timed out waiting for node to respond
-            log(DEBUG, "wait:%s:%s: timeout on node response" % (self.cmd, self.id))
+        if not self._waitFor(lambda: self.done, deadline):
+            # timed out waiting for node to respond
+            log(DEBUG, "wait:%s:%s: timeout on node response", self.cmd, self.id)
             raise FCPNodeTimeout(
                     header="Command '%s' took too long for node response" % self.cmd
                     )
     
-        log(DEBUG, "wait:%s:%s: job complete" % (self.cmd, self.id))
-    
-        # if we get here, we got the lock, command completed
-        self.lock.release()
+        log(DEBUG, "wait:%s:%s: job complete", self.cmd, self.id)
     
         # and we have a result
         return self.getResult()
@@ -2884,9 +4376,104 @@ class JobTicket:
         """
         Waits till the request has been sent to node
         """
-        self.reqSentLock.acquire()
+        self._waitFor(lambda: self.reqSent or self.done)
     
     #@-node:waitTillReqSent
+    #@+node:_waitFor
+    def _waitFor(self, test, deadline=None):
+        """
+        Sleeps on the condition till test() returns true, or till time
+        'deadline' if given.
+        
+        Returns the final value of test()
+        """
+        self.cond.acquire()
+        try:
+            if test():
+                return True
+            if deadline is None:
+                while not test():
+                    self.cond.wait()
+                return True
+    
+            # have the manager thread wake us at the deadline, because a
+            # timed Condition.wait() is a sleep/poll loop
+            entry = self.node._addDeadline(deadline, self)
+            try:
+                while not test():
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    if entry is None or entry[2] is None:
+                        # manager thread has stopped, or already fired our
+                        # deadline as it stopped, so nobody will wake us
+                        self.cond.wait(remaining)
+                    else:
+                        self.cond.wait()
+                return True
+            finally:
+                self.node._dropDeadline(entry)
+        finally:
+            self.cond.release()
+    
+    #@-node:_waitFor
+    #@+node:_notify
+    def _notify(self):
+        """
+        Wakes all threads sleeping in _waitFor, so they can look again
+        """
+        self.cond.acquire()
+        try:
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+    
+    #@-node:_notify
+    #@+node:_reqWasSent
+    def _reqWasSent(self):
+        """
+        Called by manager thread once the request has gone to the node
+        """
+        self.cond.acquire()
+        try:
+            self.reqSent = True
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+    
+    #@-node:_reqWasSent
+    #@+node:whenComplete
+    def whenComplete(self, func):
+        """
+        Arranges for func(job) to be called once the job completes, or
+        right away if it already has.
+        
+        This gets called in the manager thread, so it mustn't block
+        """
+        self.cond.acquire()
+        try:
+            if not self.done:
+                self.completionHooks.append(func)
+                return
+        finally:
+            self.cond.release()
+        func(self)
+    
+    #@-node:whenComplete
+    #@+node:_follow
+    def _follow(self, job):
+        """
+        Completes this job with the result of another, identical one,
+        which did the work for us
+        """
+        result = job.result
+        if isinstance(result, Exception):
+            self.callback('failed', getattr(result, 'info', result))
+        else:
+            self.callback('successful', result)
+        self._putResult(result)
+    
+    #@-node:_follow
     #@+node:getResult
     def getResult(self):
         """
@@ -2948,21 +4535,35 @@ class JobTicket:
         and submit a result to be picked up by client
         """
         self.result = result
+        self.timeDone = time.time()
+    
+        metrics = getattr(self.node, 'metrics', None)
+        if metrics is not None:
+            metrics.observe("total", self.cmd, self.timeDone - self.timeQueued)
     
         if not (self.keep or self.isPersistent or self.isGlobal):
             try:
                 del self.node.jobs[self.id]
             except:
                 pass
+        elif self.node is not None:
+            self.node.jobs.completed(self)
     
-        #print "** job: lock=%s" % self.lock
+        data = self.kw.get('Data', None)
+        if isinstance(data, _StreamData):
+            data.close()
     
+        self.cond.acquire()
         try:
-            self.lock.release()
-        except:
-            pass
+            self.done = True
+            self.cond.notifyAll()
+            hooks = self.completionHooks
+            self.completionHooks = []
+        finally:
+            self.cond.release()
     
-        #print "** job: lock released"
+        for func in hooks:
+            func(self)
     
     #@-node:_putResult
     #@+node:__repr__
@@ -2975,10 +4576,12 @@ class JobTicket:
     
     #@-node:__repr__
     #@+node:defaultLogger
-    def defaultLogger(self, level, msg):
+    def defaultLogger(self, level, msg, *args):
         
         if level > self.verbosity:
             return
+        if args:
+            msg = msg % args
     
         if not msg.endswith("\n"): msg += "\n"
     
@@ -2989,6 +4592,887 @@ class JobTicket:
     #@-others
 
 #@-node:class JobTicket
+#@+node:class FCPReader
+class FCPReader:
+    """
+    Buffered reader for the FCP socket.
+
+    Pulls large blocks off the socket with a single recv() and frames
+    lines and DataLength payloads out of the buffer, instead of doing
+    one recv() per byte.
+    
+    For a non-blocking socket, the owner can instead feed() in whatever
+    it receives, and read a message only once hasMsg() says the whole
+    thing has arrived.
+
+    >>> r = FCPReader(_CannedSocket("NodeHello\\nFCPVersion=2.0\\nEndMessage\\n"))
+    >>> r.readln()
+    'NodeHello\\n'
+    >>> r.pending()
+    26
+    >>> r.readln(), r.read(3), r.readln()
+    ('FCPVersion=2.0\\n', 'End', 'Message\\n')
+    >>> r.readln()
+    Traceback (most recent call last):
+    ...
+    FCPNodeFailure: FCP socket closed by node
+    """
+    #@    @+others
+    #@+node:__init__
+    def __init__(self, sock, bufsize=65536):
+        """
+        Arguments:
+            - sock - the connected FCP socket
+            - bufsize - the number of bytes to ask for on each recv()
+        """
+        self.sock = sock
+        self.bufsize = bufsize
+        self.buf = ""
+        self.pos = 0
+    
+        # fed data not yet joined onto buf, and how many pending bytes
+        # the message being received needs, for feed()/hasMsg()
+        self.chunks = []
+        self.nchunked = 0
+        self.need = 0
+
+        # bytes received from the node in all
+        self.nread = 0
+
+        # if set, called with every chunk of bytes as it's received
+        self.tap = None
+
+    #@-node:__init__
+    #@+node:pending
+    def pending(self):
+        """
+        Returns the number of bytes received but not yet consumed
+        """
+        return len(self.buf) - self.pos
+
+    #@-node:pending
+    #@+node:_recv
+    def _recv(self, n):
+        """
+        One recv() from the socket, raising FCPNodeFailure on EOF
+        """
+        chunk = self.sock.recv(n)
+        if not chunk:
+            raise FCPNodeFailure("FCP socket closed by node")
+        self.nread += len(chunk)
+        if self.tap is not None:
+            self.tap(chunk)
+        return chunk
+
+    #@-node:_recv
+    #@+node:readln
+    def readln(self):
+        """
+        Returns the next line, including its trailing newline
+        """
+        while True:
+            i = self.buf.find("\n", self.pos)
+            if i >= 0:
+                ln = self.buf[self.pos:i+1]
+                self.pos = i + 1
+                return ln
+            # no complete line yet, keep the partial one and refill
+            self.buf = self.buf[self.pos:] + self._recv(self.bufsize)
+            self.pos = 0
+
+    #@-node:readln
+    #@+node:read
+    def read(self, n):
+        """
+        Returns exactly n bytes
+        """
+        avail = len(self.buf) - self.pos
+        if avail >= n:
+            buf = self.buf[self.pos:self.pos+n]
+            self.pos += n
+            return buf
+
+        # drain what's buffered, then go to the socket for the rest
+        chunks = [self.buf[self.pos:]]
+        self.buf = ""
+        self.pos = 0
+        remaining = n - avail
+        while remaining > 0:
+            chunk = self._recv(self.bufsize)
+            if len(chunk) > remaining:
+                # overshot into the next message, keep the tail
+                self.buf = chunk[remaining:]
+                chunk = chunk[:remaining]
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return "".join(chunks)
+
+    #@-node:read
+    #@+node:readInto
+    def readInto(self, buf):
+        """
+        Fills writable buffer 'buf', such as a bytearray, with the next
+        len(buf) bytes, receiving straight into it.
+        
+        Never reads past the end of buf, so nothing of the next message
+        is consumed
+
+        >>> a, b = socketpair()
+        >>> r = FCPReader(a, bufsize=4)
+        >>> b.sendall("Data\\nhello worldNext")
+        >>> r.readln()
+        'Data\\n'
+        >>> buf = bytearray(11)
+        >>> r.readInto(buf)
+        >>> buf, r.read(4)
+        (bytearray(b'hello world'), 'Next')
+        """
+        n = len(buf)
+        view = memoryview(buf)
+        got = min(self.pending(), n)
+        if got:
+            view[:got] = self.buf[self.pos:self.pos+got]
+            self.pos += got
+        while got < n:
+            k = self.sock.recv_into(view[got:], n - got)
+            if not k:
+                raise FCPNodeFailure("FCP socket closed by node")
+            if self.tap is not None:
+                self.tap(view[got:got+k].tobytes())
+            got += k
+            self.nread += k
+
+    #@-node:readInto
+    #@+node:readToStream
+    def readToStream(self, n, stream, flush=False):
+        """
+        Copies exactly n bytes to writeable file object 'stream', no more
+        than bufsize at a time. The stream is flushed at the end, or after
+        every chunk if 'flush' is set
+        """
+        remaining = n
+        avail = len(self.buf) - self.pos
+        if avail:
+            take = min(avail, remaining)
+            stream.write(self.buf[self.pos:self.pos+take])
+            self.pos += take
+            remaining -= take
+            if flush:
+                stream.flush()
+        while remaining > 0:
+            buf = self._recv(min(remaining, self.bufsize))
+            stream.write(buf)
+            if flush:
+                stream.flush()
+            remaining -= len(buf)
+        if not flush and hasattr(stream, 'flush'):
+            stream.flush()
+
+    #@-node:readToStream
+    #@+node:skip
+    def skip(self, n):
+        """
+        Reads past the next n bytes, keeping no more than bufsize of them
+        at a time
+
+        >>> a, b = socketpair()
+        >>> r = FCPReader(a, bufsize=4)
+        >>> b.sendall("Data\\nhello worldNext")
+        >>> r.readln()
+        'Data\\n'
+        >>> r.skip(11)
+        >>> r.read(4)
+        'Next'
+        """
+        take = min(len(self.buf) - self.pos, n)
+        self.pos += take
+        remaining = n - take
+        while remaining > 0:
+            remaining -= len(self._recv(min(remaining, self.bufsize)))
+
+    #@-node:skip
+    #@+node:feed
+    def feed(self, data):
+        """
+        Adds bytes which the owner has received from the socket
+        """
+        self.chunks.append(data)
+        self.nchunked += len(data)
+        self.nread += len(data)
+        if self.tap is not None:
+            self.tap(data)
+    
+    #@-node:feed
+    #@+node:hasMsg
+    def hasMsg(self):
+        """
+        Returns True if a whole message is buffered, so that reading it
+        will not touch the socket
+        
+        >>> r = FCPReader(None)
+        >>> r.feed("AllData\\nIdentifier=x\\nDataLength=4\\nData\\nab")
+        >>> r.hasMsg()
+        False
+        >>> r.feed("cdNodeHello\\nEndMessage")
+        >>> r.hasMsg(), r.readln(), r.readln(), r.readln(), r.readln(), r.read(4)
+        (True, 'AllData\\n', 'Identifier=x\\n', 'DataLength=4\\n', 'Data\\n', 'abcd')
+        >>> r.hasMsg()
+        False
+        >>> r.feed("\\n")
+        >>> r.hasMsg(), r.readln()
+        (True, 'NodeHello\\n')
+        """
+        if self.chunks:
+            # don't bother joining till there's enough for the message
+            if self.pending() + self.nchunked < self.need:
+                return False
+            self.buf = self.buf[self.pos:] + "".join(self.chunks)
+            self.pos = 0
+            self.chunks = []
+            self.nchunked = 0
+        elif self.pending() < self.need:
+            return False
+    
+        buf = self.buf
+        start = self.pos
+        header = None
+        dataLength = 0
+        while True:
+            i = buf.find("\n", start)
+            if i < 0:
+                # need at least another line's worth
+                self.need = len(buf) - self.pos + 1
+                return False
+            line = buf[start:i].strip()
+            start = i + 1
+            if header is None:
+                header = line or None
+            elif line in ['End', 'EndMessage']:
+                break
+            elif line == 'Data':
+                need = start - self.pos + dataLength
+                if len(buf) - self.pos < need:
+                    self.need = need
+                    return False
+                break
+            elif line.startswith("DataLength="):
+                dataLength = int(line[11:])
+    
+        self.need = 0
+        return True
+    
+    #@-node:hasMsg
+    #@-others
+
+#@-node:class FCPReader
+#@+node:class FCPWriter
+class FCPWriter:
+    """
+    Outbound byte queue for the FCP socket.
+
+    Messages are queued as lists of strings. Runs of small strings,
+    such as a burst of short commands, go out joined together in one
+    send(), while big ones - typically Data payloads - are sent in
+    slices straight out of the caller's string, without copying.
+    A payload given as a _StreamData is read a chunk at a time, as
+    the socket takes it. If 'tap' is set, it's called with the bytes
+    of each send(), as they go.
+
+    Safe for any number of threads to write(), while one flushes.
+
+    >>> a, b = socketpair()
+    >>> w = FCPWriter(a)
+    >>> w.write(["GetNode\\n", "Identifier=x\\n", "EndMessage\\n"])
+    32
+    >>> w.write(["ClientPut\\nDataLength=5\\nData\\n", "hello"])
+    33
+    >>> w.pending()
+    65
+    >>> w.flush(), w.pending()
+    (65, 0)
+    >>> b.recv(100)
+    'GetNode\\nIdentifier=x\\nEndMessage\\nClientPut\\nDataLength=5\\nData\\nhello'
+    """
+    #@    @+others
+    #@+node:__init__
+    def __init__(self, sock, chunksize=65536):
+        """
+        Arguments:
+            - sock - the connected FCP socket
+            - chunksize - the most bytes to hand to each send()
+        """
+        self.sock = sock
+        self.chunksize = chunksize
+        self.lock = threading.Lock()
+        self.queue = collections.deque()
+        self.pos = 0 # bytes of queue[0] already sent
+        self.nbytes = 0
+        self.tap = None
+
+    #@-node:__init__
+    #@+node:pending
+    def pending(self):
+        """
+        Returns the number of bytes queued but not yet sent
+        """
+        return self.nbytes
+
+    #@-node:pending
+    #@+node:write
+    def write(self, pieces):
+        """
+        Queues a list of strings to send, returning their total length
+        """
+        n = 0
+        self.lock.acquire()
+        try:
+            for piece in pieces:
+                if piece:
+                    self.queue.append(piece)
+                    n += len(piece)
+            self.nbytes += n
+        finally:
+            self.lock.release()
+        return n
+
+    #@-node:write
+    #@+node:flush
+    def flush(self, limit=None):
+        """
+        Sends queued bytes till the queue is empty, the socket would
+        block, or at least 'limit' bytes have gone.
+        
+        Returns the number of bytes sent
+        """
+        sent = 0
+        while limit is None or sent < limit:
+            self.lock.acquire()
+            try:
+                if not self.queue:
+                    break
+                chunk = self._chunk()
+            finally:
+                self.lock.release()
+    
+            try:
+                n = self.sock.send(chunk)
+            except socket.error, e:
+                if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    break
+                raise
+            sent += n
+            if self.tap is not None:
+                self.tap(chunk[:n])
+    
+            self.lock.acquire()
+            try:
+                self.nbytes -= n
+                self.pos += n
+                if self.pos >= len(self.queue[0]):
+                    self.queue.popleft()
+                    self.pos = 0
+            finally:
+                self.lock.release()
+        return sent
+
+    #@-node:flush
+    #@+node:_chunk
+    def _chunk(self):
+        """
+        Returns the next buffer to send, joining a run of small strings
+        at the head of the queue into one. Call with the lock held
+        """
+        queue = self.queue
+        head = queue[0]
+        if isinstance(head, _StreamData):
+            # read the stream's next chunk, to go out ahead of the rest
+            chunk = head.read(self.chunksize)
+            if not len(head):
+                queue.popleft()
+            queue.appendleft(chunk)
+            head = chunk
+    
+        size = len(head) - self.pos
+        if size >= self.chunksize or len(queue) == 1:
+            return buffer(head, self.pos, self.chunksize)
+    
+        n = 1
+        while n < len(queue) and isinstance(queue[n], str) \
+        and size + len(queue[n]) <= self.chunksize:
+            size += len(queue[n])
+            n += 1
+        if n == 1:
+            return buffer(head, self.pos, self.chunksize)
+    
+        parts = [head[self.pos:]]
+        queue.popleft()
+        for i in range(n - 1):
+            parts.append(queue.popleft())
+        joined = "".join(parts)
+        queue.appendleft(joined)
+        self.pos = 0
+        return joined
+
+    #@-node:_chunk
+    #@-others
+
+#@-node:class FCPWriter
+#@+node:class FCPMessage
+class FCPMessage(object):
+    """
+    A message from the node, as a mapping of field names to values, with
+    the header line under key 'header'. Behaves like the dict _rxMsg()
+    used to return.
+
+    Numeric fields come out as ints, as before, but the conversion is
+    only done when a field is looked at, and only for fields which look
+    like integers, rather than trying int() on every field of every
+    message. Fields set by the client, such as 'Data', are left as given.
+
+    The values live in a list, and the field names in a tuple shared by
+    all messages with the same fields, which for a long listing - a
+    ListPeers with volatile fields, say - is much smaller than a dict
+    per message.
+
+    >>> msg = FCPMessage("DataFound", ["Identifier", "DataLength"],
+    ...                  ["4711", "1024"])
+    >>> msg['header'], msg['Identifier'], msg['DataLength']
+    ('DataFound', 4711, 1024)
+    >>> msg['Data'] = "1024"
+    >>> msg.get('Data'), msg.get('Metadata.ContentType')
+    ('1024', None)
+    >>> msg == {'header': 'DataFound', 'Identifier': 4711,
+    ...         'DataLength': 1024, 'Data': '1024'}
+    True
+    """
+    __slots__ = ('_fields', '_values', '_verbatim')
+
+    #@    @+others
+    #@+node:__init__
+    def __init__(self, header, keys=(), values=()):
+        """
+        Create a message
+
+        Arguments:
+            - header - the message's header line
+            - keys - the field names, as parsed
+            - values - the matching values, as strings
+        """
+        self._values = [header]
+        self._values.extend(values)
+        self._fields = _messageFields(('header',) + tuple(keys))
+        self._verbatim = None
+
+        if len(self._fields[1]) < len(self._values):
+            # repeated field, so the last one wins, as with a dict
+            names, values = self._fields[0], self._values
+            self._fields = _messageFields(())
+            self._values = []
+            for k, v in zip(names, values):
+                self._set(k, v, False)
+
+    #@-node:__init__
+    #@+node:_get
+    def _get(self, i):
+        """
+        Returns the value at position i, converting it to an int first
+        if it came from the node and looks like one
+        """
+        v = self._values[i]
+        if v.__class__ is str and v and (v.isdigit()
+                                         or (v[0] in "-+" and v[1:].isdigit())):
+            if self._verbatim is None or i not in self._verbatim:
+                v = self._values[i] = int(v)
+        return v
+
+    #@-node:_get
+    #@+node:_set
+    def _set(self, k, v, verbatim=True):
+        """
+        Sets field k, adding it if new
+        """
+        names, index = self._fields
+        i = index.get(k, None)
+        if i is None:
+            i = len(names)
+            self._fields = _messageFields(names + (k,))
+            self._values.append(v)
+        else:
+            self._values[i] = v
+        if verbatim:
+            if self._verbatim is None:
+                self._verbatim = set()
+            self._verbatim.add(i)
+        elif self._verbatim is not None:
+            self._verbatim.discard(i)
+
+    #@-node:_set
+    #@+node:mapping methods
+    def __getitem__(self, k):
+        return self._get(self._fields[1][k])
+
+    def __setitem__(self, k, v):
+        self._set(k, v)
+
+    def __delitem__(self, k):
+        names, index = self._fields
+        i = index[k]
+        items = [(names[j], self._values[j],
+                  self._verbatim is not None and j in self._verbatim)
+                 for j in range(len(names)) if j != i]
+        self._fields = _messageFields(())
+        self._values = []
+        self._verbatim = None
+        for name, v, verbatim in items:
+            self._set(name, v, verbatim)
+
+    def __contains__(self, k):
+        return k in self._fields[1]
+
+    has_key = __contains__
+
+    def __len__(self):
+        return len(self._values)
+
+    def __iter__(self):
+        return iter(self._fields[0])
+
+    def get(self, k, default=None):
+        i = self._fields[1].get(k, None)
+        if i is None:
+            return default
+        return self._get(i)
+
+    def keys(self):
+        return list(self._fields[0])
+
+    iterkeys = __iter__
+
+    def values(self):
+        return [self._get(i) for i in range(len(self._values))]
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def items(self):
+        return zip(self._fields[0], self.values())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def setdefault(self, k, default=None):
+        if k not in self._fields[1]:
+            self._set(k, default)
+        return self[k]
+
+    def pop(self, k, *default):
+        if k not in self._fields[1]:
+            if default:
+                return default[0]
+            raise KeyError(k)
+        v = self[k]
+        del self[k]
+        return v
+
+    def update(self, other=(), **kw):
+        if hasattr(other, 'keys'):
+            other = [(k, other[k]) for k in other.keys()]
+        for k, v in other:
+            self._set(k, v)
+        for k, v in kw.items():
+            self._set(k, v)
+
+    def copy(self):
+        msg = FCPMessage.__new__(FCPMessage)
+        msg._fields = self._fields
+        msg._values = list(self._values)
+        msg._verbatim = self._verbatim and set(self._verbatim)
+        return msg
+
+    def __eq__(self, other):
+        if not hasattr(other, 'keys'):
+            return NotImplemented
+        return dict(self.items()) == dict([(k, other[k]) for k in other.keys()])
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        if eq is NotImplemented:
+            return eq
+        return not eq
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    #@-node:mapping methods
+    #@-others
+
+#@-node:class FCPMessage
+#@+node:class _StreamData
+class _StreamData:
+    """
+    A put() payload read from a file object as it is sent.
+    
+    len() gives the number of bytes still to be read, so it stands in
+    for the data string in _txMsg() and FCPWriter.
+
+    >>> import StringIO
+    >>> s = _StreamData(StringIO.StringIO("hello world"))
+    >>> len(s), s.read(5), len(s), s.read(100), len(s)
+    (11, 'hello', 6, ' world', 0)
+    >>> s = _StreamData(StringIO.StringIO("hello"), 10)
+    >>> s.read(100)
+    Traceback (most recent call last):
+    ...
+    IOError: put stream ended 5 bytes short
+    >>> s = _StreamData(StringIO.StringIO("hello"), closeStream=True)
+    >>> s.read(5), s.stream.closed
+    ('hello', True)
+    """
+    #@    @+others
+    #@+node:__init__
+    def __init__(self, stream, length=None, closeStream=False):
+        """
+        Arguments:
+            - stream - a readable file object
+            - length - how many bytes to read from it, default the rest of
+              the file, if it's a regular file or a StringIO
+            - closeStream - if true, close the stream once it's all read,
+              or on close()
+        """
+        if length is None:
+            length = _remainingLength(stream)
+        self.stream = stream
+        self.remaining = int(length)
+        self.closeStream = closeStream
+
+    #@-node:__init__
+    #@+node:__len__
+    def __len__(self):
+        return self.remaining
+
+    #@-node:__len__
+    #@+node:read
+    def read(self, n):
+        """
+        Reads the next n bytes or the rest, whichever is less
+        """
+        n = min(n, self.remaining)
+        chunks = []
+        while n > 0:
+            chunk = self.stream.read(n)
+            if not chunk:
+                raise IOError("put stream ended %d bytes short" % self.remaining)
+            chunks.append(chunk)
+            n -= len(chunk)
+            self.remaining -= len(chunk)
+        if not self.remaining:
+            self.close()
+        return "".join(chunks)
+
+    #@-node:read
+    #@+node:close
+    def close(self):
+        """
+        Closes the stream, if we were asked to
+        """
+        if self.closeStream:
+            self.stream.close()
+
+    #@-node:close
+    #@-others
+
+#@-node:class _StreamData
+#@+node:class DataIterator
+class DataIterator:
+    """
+    Iterator over the data of a get, yielding chunks as they arrive from
+    the node. FCPNode.iterget() returns one of these.
+    
+    The manager thread hands chunks over without ever waiting for the
+    consumer: whatever arrives while more than 'window' bytes are
+    waiting to be consumed goes to a temporary file, and is read back
+    from there in turn.
+    
+    Attributes of interest:
+        - job - the get's job ticket
+        - mimetype - the key's mimetype, once known
+    """
+    #@    @+others
+    #@+node:__init__
+    def __init__(self, window=None, timeout=None):
+        """
+        Arguments:
+            - window - bytes to hold in memory for a consumer which falls
+              behind, default 1MB
+            - timeout - seconds for the whole get to complete, default
+              forever
+        """
+        if window is None:
+            window = defaultIterWindow
+        self.window = window
+        if timeout is None:
+            self.deadline = None
+        else:
+            self.deadline = time.time() + timeout
+        self.job = None
+        self.mimetype = None
+        self.lock = threading.Lock()
+        self.chunks = collections.deque()
+        self.nbytes = 0
+        self.spill = None
+        self.spillWritten = 0
+        self.spillRead = 0
+        self.closed = False
+
+    #@-node:__init__
+    #@+node:__iter__
+    def __iter__(self):
+        return self
+
+    #@-node:__iter__
+    #@+node:next
+    def next(self):
+        """
+        Returns the next chunk, waiting for it if need be. Raises the
+        get's exception if it failed
+        """
+        job = self.job
+        if not job._waitFor(lambda: self._ready() or job.done, self.deadline):
+            raise FCPNodeTimeout(
+                    header="Get '%s' took too long to complete" % job.uri)
+        self.mimetype = getattr(job, 'mimetype', None)
+    
+        chunk = self._take()
+        if chunk is not None:
+            return chunk
+    
+        # finished - raises if it failed
+        job.getResult()
+        raise StopIteration
+    
+    #@-node:next
+    #@+node:read
+    def read(self):
+        """
+        Returns all the (remaining) data as one string
+        """
+        return "".join(self)
+
+    #@-node:read
+    #@+node:close
+    def close(self):
+        """
+        Drops the data received so far, and any yet to come
+        """
+        self.lock.acquire()
+        try:
+            self.closed = True
+            self.chunks.clear()
+            self.nbytes = 0
+            self._dropSpill()
+        finally:
+            self.lock.release()
+
+    #@-node:close
+    #@+node:write
+    def write(self, data):
+        """
+        Takes a chunk from the manager thread
+        """
+        self.lock.acquire()
+        try:
+            if self.closed:
+                return
+            if self.spill is None and self.nbytes < self.window:
+                self.chunks.append(data)
+                self.nbytes += len(data)
+            else:
+                # consumer's behind, keep the rest on disk till it catches up
+                if self.spill is None:
+                    self.spill = tempfile.TemporaryFile()
+                self.spill.seek(self.spillWritten)
+                self.spill.write(data)
+                self.spillWritten += len(data)
+        finally:
+            self.lock.release()
+        if self.job is not None:
+            self.job._notify()
+
+    #@-node:write
+    #@+node:flush
+    def flush(self):
+        pass
+
+    #@-node:flush
+    #@+node:_ready
+    def _ready(self):
+        """
+        True if there's a chunk to take
+        """
+        return len(self.chunks) > 0 or self.spillRead < self.spillWritten
+
+    #@-node:_ready
+    #@+node:_take
+    def _take(self):
+        """
+        Returns the next chunk in order, or None if none has arrived
+        """
+        self.lock.acquire()
+        try:
+            if self.chunks:
+                chunk = self.chunks.popleft()
+                self.nbytes -= len(chunk)
+                return chunk
+            if self.spillRead < self.spillWritten:
+                self.spill.flush()
+                self.spill.seek(self.spillRead)
+                chunk = self.spill.read(
+                            min(self.spillWritten - self.spillRead, 65536))
+                self.spillRead += len(chunk)
+                if self.spillRead == self.spillWritten:
+                    # caught up, back to memory
+                    self._dropSpill()
+                return chunk
+            return None
+        finally:
+            self.lock.release()
+
+    #@-node:_take
+    #@+node:_dropSpill
+    def _dropSpill(self):
+        if self.spill is not None:
+            self.spill.close()
+        self.spill = None
+        self.spillWritten = 0
+        self.spillRead = 0
+
+    #@-node:_dropSpill
+    #@-others
+
+#@-node:class DataIterator
+#@+node:class _CannedSocket
+class _CannedSocket:
+    """
+    Socket stand-in which serves recv() calls from a fixed string,
+    for testing and benchmarking the parser without a node
+    """
+    def __init__(self, raw):
+        self.raw = raw
+        self.pos = 0
+
+    def recv(self, n):
+        chunk = self.raw[self.pos:self.pos+n]
+        self.pos += len(chunk)
+        return chunk
+
+    def recv_into(self, buf, n):
+        chunk = self.recv(n)
+        buf[:len(chunk)] = chunk
+        return len(chunk)
+
+#@-node:class _CannedSocket
 #@+node:util funcs
 #@+others
 #@+node:toBool
@@ -3012,6 +5496,146 @@ def toBool(arg):
         return False
 
 #@-node:toBool
+#@+node:_remainingLength
+def _remainingLength(stream):
+    """
+    Returns the number of bytes left to read in a regular file or
+    StringIO, raising an exception for anything else
+    """
+    try:
+        mode = os.fstat(stream.fileno()).st_mode
+    except (AttributeError, OSError, IOError):
+        mode = None
+    if mode is not None and stat.S_ISREG(mode):
+        size = os.fstat(stream.fileno()).st_size
+    elif hasattr(stream, 'len'):
+        size = stream.len
+    else:
+        raise Exception("put: stream length unknown, 'length' is needed")
+    return size - stream.tell()
+
+#@-node:_remainingLength
+#@+node:uploadKeywords
+def uploadKeywords(path):
+    """
+    Returns the keywords for put() to upload a file's contents directly:
+    data= for small files, stream= for those over streamThreshold bytes,
+    so they are read as they're sent. put() or genchk() closes the stream
+    once it's done with it
+    """
+    size = os.path.getsize(path)
+    f = file(path, "rb")
+    if size > streamThreshold:
+        return {'stream': f, 'length': size, 'closeStream': True}
+    try:
+        return {'data': f.read()}
+    finally:
+        f.close()
+
+#@-node:uploadKeywords
+#@+node:_feedHash
+def _feedHash(h, stream, length=None):
+    """
+    Feeds a hash object what's left of a stream, or the next 'length'
+    bytes of it, a block at a time
+    """
+    while length is None or length > 0:
+        if length is None:
+            n = hashBlockSize
+        else:
+            n = min(length, hashBlockSize)
+        block = stream.read(n)
+        if not block:
+            break
+        h.update(block)
+        if length is not None:
+            length -= len(block)
+
+#@-node:_feedHash
+#@+node:_hashPath
+def _hashPath(h, path):
+    """
+    Feeds a hash object a file's contents, a block at a time, so that
+    a big file never has to fit in memory. Files of hashMmapThreshold
+    bytes or more are mapped rather than read
+    """
+    f = file(path, "rb")
+    try:
+        size = os.fstat(f.fileno()).st_size
+        if hashMmapThreshold is None or size == 0 or size < hashMmapThreshold:
+            _feedHash(h, f)
+            return
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for pos in xrange(0, size, hashBlockSize):
+                h.update(buffer(m, pos, hashBlockSize))
+        finally:
+            m.close()
+    finally:
+        f.close()
+
+#@-node:_hashPath
+#@+node:_messageFields
+def _messageFields(names):
+    """
+    Returns the (names, index) pair for a tuple of message field names,
+    shared with every other message with the same fields
+    """
+    fields = _fieldSets.get(names, None)
+    if fields is None:
+        index = {}
+        for i, k in enumerate(names):
+            index[k] = i
+        fields = (names, index)
+        if len(_fieldSets) < maxFieldSets:
+            _fieldSets[names] = fields
+    return fields
+
+#@-node:_messageFields
+#@+node:resizeBuffer
+def resizeBuffer(buf, n):
+    """
+    Truncates or zero-extends bytearray 'buf' in place to n bytes,
+    growing it a block at a time, so as not to need n bytes more memory
+    
+    >>> buf = bytearray("abc")
+    >>> resizeBuffer(buf, 5); buf
+    bytearray(b'abc\\x00\\x00')
+    >>> resizeBuffer(buf, 2); buf
+    bytearray(b'ab')
+    """
+    if len(buf) > n:
+        del buf[n:]
+    zeros = "\0" * min(n - len(buf), 65536)
+    while len(buf) < n:
+        buf.extend(zeros[:n - len(buf)])
+
+#@-node:resizeBuffer
+#@+node:socketpair
+def socketpair():
+    """
+    Returns a pair of connected sockets, falling back to a loopback
+    TCP connection where socket.socketpair() is missing (windows)
+    
+    >>> a, b = socketpair()
+    >>> a.sendall("x"); b.recv(1)
+    'x'
+    """
+    if hasattr(socket, "socketpair"):
+        return socket.socketpair()
+    
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        a = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        a.connect(listener.getsockname())
+        b, addr = listener.accept()
+    finally:
+        listener.close()
+    return a, b
+
+#@-node:socketpair
 #@+node:readdir
 def readdir(dirpath, prefix='', gethashes=False):
     """
@@ -3085,8 +5709,9 @@ def hashFile(path):
     >>> hashFile(filepath) == hashlib.sha1("test").hexdigest()
     True
     """
-    raw = file(path, "rb").read()
-    return hashlib.sha1(raw).hexdigest()
+    h = hashlib.sha1()
+    _hashPath(h, path)
+    return h.hexdigest()
 
 def sha256dda(nodehelloid, identifier, path=None):
     """
@@ -3098,8 +5723,9 @@ def sha256dda(nodehelloid, identifier, path=None):
     >>> print sha256dda("1","2",filepath) == hashlib.sha256("1-2-" + "test").digest()
     True
     """
-    tohash = "-".join([nodehelloid, identifier, file(path, "rb").read()])
-    return hashlib.sha256(tohash).digest()
+    h = hashlib.sha256("-".join([nodehelloid, identifier, ""]))
+    _hashPath(h, path)
+    return h.digest()
 
 #@-node:hashFile
 #@+node:guessMimetype
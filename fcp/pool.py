@@ -0,0 +1,473 @@
+#@+leo-ver=4
+#@+node:@file pool.py
+"""
+A pool of FCP connections to one node, behind the FCPNode interface
+
+A single FCPNode funnels everything through one socket and one manager
+thread, so a large AllData coming in for one get holds up every other
+reply behind it. FCPNodePool opens several connections, each with its
+own manager thread, and sends each new request down the connection with
+the fewest requests outstanding.
+
+Each connection says hello under its own name - the pool's name with
+'-0', '-1', ... appended - so the node keeps their persistent requests
+apart. A connection found dead is shut down and replaced by a fresh one
+under the same name, so its persistent requests come back with it.
+
+FCP primitives (get, put, putdir, genkey, genchk, listpeers and the
+rest) are spread over the pool. The job queries (getAllJobs and
+friends) and setVerbosity/setSocketTimeout cover all connections.
+Everything else - the namesite methods, listenGlobal, node attributes
+such as nodeVersion - goes to the first live connection.
+
+    pool = FCPNodePool(size=4)
+    jobs = [pool.get(uri, async=True) for uri in uris]
+    results = [job.wait() for job in jobs]
+    pool.shutdown()
+"""
+
+#@+others
+#@+node:imports
+import random
+import sys
+import threading
+import time
+import traceback
+
+from node import FCPNode, JobTicket, DataIterator, FCPNodeFailure
+from node import defaultVerbosity, ERROR
+
+#@-node:imports
+#@+node:globals
+# how many connections a pool opens, by default
+defaultPoolSize = 4
+
+# seconds between attempts to replace a dead connection
+defaultRetryInterval = 10
+
+#@-node:globals
+#@+node:class FCPNodePool
+class FCPNodePool:
+    """
+    Several FCP connections to one node, used as one FCPNode
+    """
+    #@    @+others
+    #@+node:__init__
+    def __init__(self, **kw):
+        """
+        Opens the connections
+
+        Keywords are as for FCPNode, plus:
+            - size - number of connections, default 4
+            - retryInterval - seconds to wait before trying again to
+              replace a dead connection, default 10
+            - nodeClass - the connection class, default FCPNode
+
+        The 'name' keyword is used as a prefix for the connections' own
+        names, and a logfile given by pathname is opened once and shared.
+        """
+        self.running = False
+        self.size = kw.pop('size', defaultPoolSize)
+        self.retryInterval = kw.pop('retryInterval', defaultRetryInterval)
+        self.nodeClass = kw.pop('nodeClass', FCPNode)
+        self.name = kw.pop('name', None)
+        if not self.name:
+            self.name = "pool%d" % random.randint(0, 1000000000)
+        self.verbosity = kw.get('verbosity', defaultVerbosity)
+
+        # the connections would each close a shared logfile on shutdown,
+        # so we keep it here and have them write to it through logfunc
+        logfile = kw.pop('logfile', None)
+        logfunc = kw.pop('logfunc', None)
+        self.logfile = None
+        self.logfunc = logfunc
+        if logfile in [sys.stdout, sys.stderr]:
+            kw['logfile'] = logfile
+        elif logfile is not None:
+            if not hasattr(logfile, 'write'):
+                if not isinstance(logfile, str):
+                    raise Exception(
+                        "Bad logfile '%s', must be pathname or file object" % logfile)
+                logfile = file(logfile, "a")
+            self.logfile = logfile
+            logfunc = self._writeLog
+        if logfunc is not None:
+            kw['logfunc'] = logfunc
+        self.kw = kw
+
+        self.lock = threading.Lock()
+        self.next = 0
+        self.slots = []
+        try:
+            for i in range(self.size):
+                self.slots.append(_Slot(self._newConn(i), self.lock))
+        except:
+            for slot in self.slots:
+                slot.conn.shutdown()
+            raise
+        self.running = True
+
+    #@-node:__init__
+    #@+node:__del__
+    def __del__(self):
+        """
+        object is getting cleaned up, so disconnect
+        """
+        try:
+            self.shutdown()
+        except:
+            traceback.print_exc()
+
+    #@-node:__del__
+    #@+node:__getattr__
+    def __getattr__(self, attr):
+        """
+        Anything the pool doesn't handle itself goes to the first live
+        connection
+        """
+        if attr.startswith("__") or 'slots' not in self.__dict__:
+            raise AttributeError(attr)
+        return getattr(self.primary(), attr)
+
+    #@-node:__getattr__
+    #@+node:primary
+    def primary(self):
+        """
+        Returns the first live connection
+        """
+        self._replaceDead()
+        for slot in self.slots:
+            if slot.isAlive():
+                return slot.conn
+        raise FCPNodeFailure("FCPNodePool: no live connections to node")
+
+    #@-node:primary
+    #@+node:connections
+    def connections(self):
+        """
+        Returns a list of the pool's connections, live or not
+        """
+        return [slot.conn for slot in self.slots]
+
+    #@-node:connections
+    #@+node:health
+    def health(self):
+        """
+        Returns a list with a dict per connection, with keys:
+            - name - the client name it said hello with
+            - alive - False if it has failed and awaits replacement
+            - outstanding - number of requests sent down it and not
+              yet complete
+            - reconnects - how many times it has been replaced
+        """
+        self.lock.acquire()
+        try:
+            return [dict(name=slot.conn.name,
+                         alive=slot.isAlive(),
+                         outstanding=slot.load,
+                         reconnects=slot.reconnects)
+                    for slot in self.slots]
+        finally:
+            self.lock.release()
+
+    #@-node:health
+    #@+node:job queries
+    def getAllJobs(self, **kw):
+        """
+        Returns a list of all jobs, on all connections. Keywords are as
+        for FCPNode.getAllJobs
+        """
+        return self._gather("getAllJobs", **kw)
+
+    def getPersistentJobs(self, **kw):
+        """
+        Returns a list of persistent jobs, excluding global jobs, on all
+        connections
+        """
+        return self._gather("getPersistentJobs", **kw)
+
+    def getGlobalJobs(self, **kw):
+        """
+        Returns a list of global jobs, without duplicates if several
+        connections are watching the global queue
+        """
+        jobs = {}
+        for job in self._gather("getGlobalJobs", **kw):
+            jobs.setdefault(job.id, job)
+        return jobs.values()
+
+    def getTransientJobs(self, **kw):
+        """
+        Returns a list of non-persistent, non-global jobs, on all
+        connections
+        """
+        return self._gather("getTransientJobs", **kw)
+
+    def purgePersistentJobs(self):
+        """
+        Cancels all persistent jobs on all connections
+        """
+        for slot in self.slots:
+            if slot.isAlive():
+                slot.conn.purgePersistentJobs()
+
+    def refreshPersistentRequests(self, **kw):
+        """
+        Has the node send each connection its persistent requests again
+        """
+        for slot in self.slots:
+            if slot.isAlive():
+                slot.conn.refreshPersistentRequests(**kw)
+
+    #@-node:job queries
+    #@+node:settings
+    def setVerbosity(self, verbosity):
+        """
+        Sets the verbosity for future logging calls, on all connections
+        """
+        self.verbosity = verbosity
+        self.kw['verbosity'] = verbosity
+        for slot in self.slots:
+            slot.conn.setVerbosity(verbosity)
+
+    def getVerbosity(self):
+        """
+        Gets the verbosity for future logging calls
+        """
+        return self.verbosity
+
+    def setSocketTimeout(self, socketTimeout):
+        """
+        Sets the socket timeout on all connections
+        """
+        self.kw['socketTimeout'] = socketTimeout
+        for slot in self.slots:
+            slot.conn.setSocketTimeout(socketTimeout)
+
+    #@-node:settings
+    #@+node:shutdown
+    def shutdown(self):
+        """
+        Shuts down all the connections
+        """
+        if not self.running:
+            return
+        self.running = False
+
+        for slot in self.slots:
+            try:
+                slot.conn.shutdown()
+            except:
+                traceback.print_exc()
+
+        if self.logfile is not None:
+            self.logfile.close()
+
+    #@-node:shutdown
+    #@+node:_call
+    def _call(self, method, args, kw):
+        """
+        Calls a method on the least busy connection, and counts the
+        request as outstanding on it till it completes
+        """
+        slot = self._pick()
+        try:
+            result = getattr(slot.conn, method)(*args, **kw)
+        except:
+            slot.release()
+            raise
+
+        if isinstance(result, JobTicket):
+            # async, so it's outstanding till the ticket completes
+            result.whenComplete(slot.release)
+        elif isinstance(result, DataIterator):
+            result.job.whenComplete(slot.release)
+        else:
+            slot.release()
+        return result
+
+    #@-node:_call
+    #@+node:_pick
+    def _pick(self):
+        """
+        Returns the live connection slot with fewest outstanding requests,
+        with its count already raised. Ties go round-robin
+        """
+        if not self.running:
+            raise FCPNodeFailure("FCPNodePool: pool is shut down")
+
+        self._replaceDead()
+
+        self.lock.acquire()
+        try:
+            n = len(self.slots)
+            start = self.next
+            self.next = (start + 1) % n
+            best = None
+            for i in range(n):
+                slot = self.slots[(start + i) % n]
+                if not slot.isAlive():
+                    continue
+                if best is None or slot.load < best.load:
+                    best = slot
+            if best is None:
+                raise FCPNodeFailure("FCPNodePool: no live connections to node")
+            best.load += 1
+            return best
+        finally:
+            self.lock.release()
+
+    #@-node:_pick
+    #@+node:_replaceDead
+    def _replaceDead(self):
+        """
+        Replaces any dead connections whose retry time has come round.
+
+        Reconnecting happens outside the lock, so requests carry on over
+        the live connections meanwhile
+        """
+        now = time.time()
+        self.lock.acquire()
+        try:
+            due = []
+            for i, slot in enumerate(self.slots):
+                if not slot.isAlive() and now >= slot.retryAt:
+                    # claim it, so nobody else tries at the same time
+                    slot.retryAt = now + self.retryInterval
+                    due.append((i, slot))
+        finally:
+            self.lock.release()
+
+        for i, slot in due:
+            try:
+                slot.conn.shutdown()
+            except:
+                pass
+            try:
+                conn = self._newConn(i)
+            except Exception, e:
+                self._log("FCPNodePool: can't replace connection %s: %s" % (
+                          slot.conn.name, e))
+                continue
+            new = _Slot(conn, self.lock)
+            new.reconnects = slot.reconnects + 1
+            self.lock.acquire()
+            try:
+                self.slots[i] = new
+            finally:
+                self.lock.release()
+            self._log("FCPNodePool: replaced connection %s" % conn.name)
+
+    #@-node:_replaceDead
+    #@+node:_newConn
+    def _newConn(self, i):
+        """
+        Opens connection number i
+        """
+        return self.nodeClass(name="%s-%d" % (self.name, i), **self.kw)
+
+    #@-node:_newConn
+    #@+node:_gather
+    def _gather(self, method, **kw):
+        """
+        Concatenates the lists returned by a method of each connection
+        """
+        result = []
+        for slot in self.slots:
+            result.extend(getattr(slot.conn, method)(**kw))
+        return result
+
+    #@-node:_gather
+    #@+node:_log
+    def _log(self, msg):
+        """
+        Logs a connection change, at the connections' ERROR level
+        """
+        for slot in self.slots:
+            if slot.isAlive():
+                slot.conn._log(ERROR, msg)
+                return
+
+    #@-node:_log
+    #@+node:_writeLog
+    def _writeLog(self, msg):
+        """
+        logfunc for the connections, writing to our logfile
+        """
+        self.logfile.write(msg + "\n")
+        self.logfile.flush()
+        if self.logfunc is not None:
+            self.logfunc(msg)
+
+    #@-node:_writeLog
+    #@-others
+
+#@-node:class FCPNodePool
+#@+node:class _Slot
+class _Slot:
+    """
+    One connection in a pool, and the count of requests outstanding on it
+    """
+    #@    @+others
+    #@+node:__init__
+    def __init__(self, conn, lock):
+        self.conn = conn
+        self.lock = lock
+        self.load = 0
+        self.reconnects = 0
+        self.retryAt = 0
+
+    #@-node:__init__
+    #@+node:isAlive
+    def isAlive(self):
+        """
+        True if the connection is up and its manager still running
+        """
+        return self.conn.nodeIsAlive and self.conn.running
+
+    #@-node:isAlive
+    #@+node:release
+    def release(self, job=None):
+        """
+        Counts one of our requests as complete
+        """
+        self.lock.acquire()
+        try:
+            self.load -= 1
+        finally:
+            self.lock.release()
+
+    #@-node:release
+    #@-others
+
+#@-node:class _Slot
+#@+node:pooled methods
+def _pooled(method):
+    """
+    Makes a FCPNodePool method which sends its call down the least busy
+    connection
+    """
+    def call(self, *args, **kw):
+        return self._call(method, args, kw)
+    call.__name__ = method
+    call.__doc__ = getattr(FCPNode, method).__doc__
+    return call
+
+for _method in ["genkey", "fcpPluginMessage", "get", "iterget", "put", "putdir",
+                "modifyconfig", "getconfig", "invertprivate", "redirect",
+                "genchk", "listpeers", "listpeernotes", "refstats",
+                "addpeer", "listpeer", "modifypeer", "modifypeernote",
+                "removepeer"]:
+    setattr(FCPNodePool, _method, _pooled(_method))
+del _method
+
+# these run in the pool itself, so their requests are spread over it
+for _method in ["getmany", "putmany"]:
+    setattr(FCPNodePool, _method, FCPNode.__dict__[_method])
+del _method
+
+#@-node:pooled methods
+#@-others
+
+#@-node:@file pool.py
+#@-leo
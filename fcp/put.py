@@ -8,7 +8,7 @@ This is the guts of the command-line front-end app fcpput
 
 #@+others
 #@+node:imports
-import sys, os, getopt, traceback, mimetypes
+import sys, os, getopt, traceback, mimetypes, stat, tempfile
 
 import node
 
@@ -29,6 +29,29 @@ def usage(msg=None, ret=1):
     sys.exit(ret)
 
 #@-node:usage
+#@+node:spoolStdin
+def spoolStdin():
+    """
+    Returns stdin, if it's a regular file, or otherwise a temporary
+    file holding a copy of it, since the node needs to know the length
+    before we send anything
+    """
+    try:
+        if stat.S_ISREG(os.fstat(sys.stdin.fileno()).st_mode):
+            return sys.stdin
+    except (AttributeError, OSError, ValueError):
+        pass
+
+    spool = tempfile.TemporaryFile()
+    while True:
+        chunk = sys.stdin.read(65536)
+        if not chunk:
+            break
+        spool.write(chunk)
+    spool.seek(0)
+    return spool
+
+#@-node:spoolStdin
 #@+node:help
 def help():
     """
@@ -253,19 +276,19 @@ def main():
 
     # try to insert the key using "direct" way if dda has failed
     if not TestDDARequest:
-        # grab the data
+        # open the data, to be streamed to the node as it's sent
         if not infile:
-            data = sys.stdin.read()
+            stream = spoolStdin()
         else:
             try:
-                data = file(infile, "rb").read()
+                stream = file(infile, "rb")
             except:
                 n.shutdown()
                 usage("Failed to read input from file %s" % repr(infile))
 
         try:
             #print "opts=%s" % str(opts)
-            uri = n.put(uri, data=data, **opts)
+            uri = n.put(uri, stream=stream, **opts)
         except:
             if verbose:
                 traceback.print_exc(file=sys.stderr)
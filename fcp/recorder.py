@@ -0,0 +1,141 @@
+#@+leo-ver=4
+#@+node:@file recorder.py
+"""
+Records FCP sessions, for replay.ReplayNode to play back without a node
+"""
+
+#@+others
+#@+node:imports
+import threading
+import time
+
+#@-node:imports
+#@+node:class FCPRecorder
+class FCPRecorder:
+    """
+    Records the raw bytes of an FCP session, as they go to and come from
+    the node, with the time of each chunk, for replay.ReplayNode to play
+    back without a node. FCPNode makes one of these from its 'record'
+    keyword.
+    
+    Each chunk is written as a line 'time direction length', then the
+    bytes themselves and a newline. direction is 'out' for bytes sent to
+    the node, 'in' for bytes received, and 'connect', with no bytes, for
+    each new connection. readRecording() reads them back.
+    
+    Safe from any thread.
+    
+    >>> import StringIO
+    >>> f = StringIO.StringIO()
+    >>> r = FCPRecorder(f)
+    >>> r.connected()
+    >>> r.sent("ClientHello\\nEndMessage\\n")
+    >>> r.received("NodeHello\\nEnd")
+    >>> f.seek(0)
+    >>> [(d, data) for t, d, data in readRecording(f)]
+    [('connect', ''), ('out', 'ClientHello\\nEndMessage\\n'), ('in', 'NodeHello\\nEnd')]
+    """
+    #@    @+others
+    #@+node:__init__
+    def __init__(self, f):
+        """
+        Arguments:
+            - f - the file object to write to, or a pathname to append to
+        """
+        if hasattr(f, 'write'):
+            self.file = f
+            self.ownFile = False
+        else:
+            self.file = file(f, "ab")
+            self.ownFile = True
+        self.lock = threading.Lock()
+    
+    #@-node:__init__
+    #@+node:write
+    def write(self, direction, data):
+        """
+        Records a chunk of bytes going in the given direction
+        """
+        self.lock.acquire()
+        try:
+            self.file.write("%.6f %s %d\n" % (time.time(), direction, len(data)))
+            self.file.write(data)
+            self.file.write("\n")
+        finally:
+            self.lock.release()
+    
+    #@-node:write
+    #@+node:connected
+    def connected(self):
+        """
+        Records the start of a new connection to the node
+        """
+        self.write("connect", "")
+    
+    #@-node:connected
+    #@+node:sent
+    def sent(self, data):
+        """
+        Records bytes sent to the node
+        """
+        self.write("out", data)
+    
+    #@-node:sent
+    #@+node:received
+    def received(self, data):
+        """
+        Records bytes received from the node
+        """
+        self.write("in", data)
+    
+    #@-node:received
+    #@+node:close
+    def close(self):
+        """
+        Closes the file, if we opened it, or else just flushes it
+        """
+        self.lock.acquire()
+        try:
+            if self.ownFile:
+                self.file.close()
+            else:
+                self.file.flush()
+        finally:
+            self.lock.release()
+    
+    #@-node:close
+    #@-others
+
+#@-node:class FCPRecorder
+#@+node:readRecording
+def readRecording(f):
+    """
+    Reads a recording made by FCPRecorder, from a file object or pathname,
+    yielding (time, direction, data) for each chunk. A chunk cut short by
+    the end of the file is dropped
+    """
+    if hasattr(f, 'read'):
+        close = False
+    else:
+        f = file(f, "rb")
+        close = True
+    try:
+        while True:
+            line = f.readline()
+            if not line.endswith("\n"):
+                return
+            t, direction, length = line.split()
+            length = int(length)
+            data = f.read(length)
+            if len(data) < length or f.read(1) != "\n":
+                return
+            yield float(t), direction, data
+    finally:
+        if close:
+            f.close()
+
+#@-node:readRecording
+#@-others
+
+#@-node:@file recorder.py
+#@-leo
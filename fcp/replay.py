@@ -0,0 +1,248 @@
+#@+leo-ver=4
+#@+node:@file replay.py
+"""
+Plays back a recorded FCP session, with no node involved
+
+An FCPNode created with the 'record' keyword writes the raw bytes it
+sends and receives to a file, with the time of each chunk (see
+recorder.FCPRecorder). ReplayNode feeds such a recording through the same
+parser (_rxMsg) and dispatch (_on_rxMsg and the message handlers) as a
+live connection, either as fast as they'll go or at the pace it was
+recorded, for repeatable throughput and latency measurements against
+real traffic.
+
+The requests in the recording are made into job tickets again, through
+_on_clientReq, at the point they were sent, so the node's replies find
+their jobs as they did live. Nothing is sent anywhere. What the library
+decided for itself on reconnecting, such as failing jobs the node had
+lost, isn't played back - only what went over the wire.
+
+    node = ReplayNode(metrics=True)
+    stats = node.replay("session.fcp")
+    print stats['messagesIn'] / stats['seconds'], "msgs/sec"
+    print node.getMetricsText()
+"""
+
+#@+others
+#@+node:imports
+import sys
+import time
+
+from node import FCPNode, FCPReader, FCPNodeFailure
+from recorder import readRecording
+from node import SILENT
+
+#@-node:imports
+#@+node:class ReplayNode
+class ReplayNode(FCPNode):
+    """
+    FCPNode which takes its traffic from a recording instead of a node
+    """
+    #@    @+others
+    #@+node:__init__
+    def __init__(self, **kw):
+        """
+        Create a node to play recordings through
+
+        Keywords are as for FCPNode, though the connection ones mean
+        nothing here, and verbosity defaults to SILENT
+        """
+        kw.setdefault('verbosity', SILENT)
+        kw.pop('record', None)
+        FCPNode.__init__(self, **kw)
+
+    #@-node:__init__
+    #@+node:replay
+    def replay(self, recording, speed=None):
+        """
+        Plays a recording through the node
+
+        Arguments:
+            - recording - a file object or pathname, recorded by FCPRecorder
+
+        Keywords:
+            - speed - None, the default, to play it as fast as it will go,
+              or else a multiple of the recorded pace, so 1.0 for real time
+
+        Returns a dict of:
+            - messagesIn - the messages from the node parsed and dispatched
+            - messagesOut - the messages to the node read back
+            - bytesIn - the bytes from the node
+            - seconds - how long it took
+            - maxLag - played at a given speed, the furthest behind the
+              recorded pace we finished handling a chunk, in seconds, or
+              None at full speed
+        """
+        if not self.running:
+            raise FCPNodeFailure("node connection is shut down")
+
+        metrics = self.metrics
+        stats = {'messagesIn': 0, 'messagesOut': 0, 'bytesIn': 0,
+                 'maxLag': None}
+        if speed is not None:
+            stats['maxLag'] = 0.0
+
+        start = time.time()
+        first = None
+        for t, direction, data in readRecording(recording):
+            if speed is not None:
+                if first is None:
+                    first = t
+                due = start + (t - first) / speed
+                delay = due - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+            if direction == "in":
+                busySince = time.time()
+                stats['bytesIn'] += len(data)
+                stats['messagesIn'] += self._replayIn(data)
+                if metrics is not None:
+                    metrics.observe("loop", None, time.time() - busySince)
+            elif direction == "out":
+                stats['messagesOut'] += self._replayOut(data)
+            elif direction == "connect":
+                self._connect()
+
+            if speed is not None:
+                stats['maxLag'] = max(stats['maxLag'], time.time() - due)
+
+        stats['seconds'] = time.time() - start
+        return stats
+
+    #@-node:replay
+    #@+node:shutdown
+    def shutdown(self):
+        """
+        Stops taking recordings
+        """
+        if not self.running:
+            return
+        self.running = False
+
+        if None != self.logfile and self.logfile not in [sys.stdout, sys.stderr]:
+            self.logfile.close()
+
+    #@-node:shutdown
+    #@+node:_connect
+    def _connect(self):
+        """
+        Nothing to connect to, just start afresh on a new recorded
+        connection. Its first message from the node is the NodeHello,
+        which _hello() would have read
+        """
+        if self.metrics is not None and getattr(self, 'reader', None) is not None:
+            # keep the count from the last connection
+            self.metrics.received(self.reader.nread)
+        self.socket = None
+        self.reader = FCPReader(None)
+        self.outReader = FCPReader(None)
+        self.helloPending = True
+
+    #@-node:_connect
+    #@+node:_startManager
+    def _startManager(self):
+        """
+        No manager thread, replay() does its work
+        """
+        self.writer = None
+        self.running = True
+
+    #@-node:_startManager
+    #@+node:_send
+    def _send(self, *pieces):
+        """
+        Drops what we'd have sent the node, which the recording already has
+        """
+        if self.metrics is not None:
+            self.metrics.sent(sum([len(piece) for piece in pieces]))
+
+    #@-node:_send
+    #@+node:_adjustOutbound
+    def _adjustOutbound(self, nbytes):
+        """
+        Nothing is ever queued, so there's nothing to hold back
+        """
+        pass
+
+    #@-node:_adjustOutbound
+    #@+node:_replayIn
+    def _replayIn(self, data):
+        """
+        Takes a chunk of what the node sent, and parses and dispatches
+        every message which has fully arrived. Returns how many there were
+        """
+        reader = self.reader
+        reader.feed(data)
+        n = 0
+        while reader.hasMsg():
+            msg = self._rxMsg()
+            n += 1
+            if self.helloPending:
+                self.helloPending = False
+                self.connectionidentifier = msg.get("ConnectionIdentifier", None)
+            else:
+                self._on_rxMsg(msg)
+        return n
+
+    #@-node:_replayIn
+    #@+node:_replayOut
+    def _replayOut(self, data):
+        """
+        Takes a chunk of what was sent to the node, and makes a job of
+        every request in it, as _submitCmd() did. Returns how many
+        messages there were
+        """
+        reader = self.outReader
+        reader.feed(data)
+        n = 0
+        while reader.hasMsg():
+            cmd, kw = self._readRequest()
+            n += 1
+            id = kw.get('Identifier', None)
+            if cmd == 'WatchGlobal':
+                pass
+            elif cmd == 'ClientHello' or id is None:
+                continue
+            else:
+                job = self.jobs.get(id, None)
+                if job is not None and not job.isComplete():
+                    # something the library sent by itself about a job
+                    # it has, such as a redirect or a cancel
+                    continue
+            self._on_clientReq(self._newJob(id, cmd, kw))
+        return n
+
+    #@-node:_replayOut
+    #@+node:_readRequest
+    def _readRequest(self):
+        """
+        Reads a message sent to the node from outReader, as its header
+        and a dict of its fields, with any data as field 'Data'
+        """
+        reader = self.outReader
+        while True:
+            header = reader.readln().strip()
+            if header:
+                break
+
+        kw = {}
+        while True:
+            line = reader.readln().strip()
+            if line in ['End', 'EndMessage']:
+                break
+            if line == 'Data':
+                kw['Data'] = reader.read(int(kw.pop('DataLength')))
+                break
+            k, v = line.split("=", 1)
+            kw[k] = v
+        return header, kw
+
+    #@-node:_readRequest
+    #@-others
+
+#@-node:class ReplayNode
+#@-others
+
+#@-node:@file replay.py
+#@-leo
@@ -10,7 +10,7 @@ import sys, os, threading, traceback, pprint, time, stat, sha
 
 import fcp
 from fcp import CRITICAL, ERROR, INFO, DETAIL, DEBUG, NOISY
-from fcp.node import hashFile
+from fcp.node import hashFile, uploadKeywords
 
 #@-node:imports
 #@+node:globals
@@ -99,6 +99,10 @@ class SiteMgr:
                         port=self.fcpPort,
                         verbosity=self.verbosity,
                         name="freesitemgr",
+                        chkCache=fcp.cache.CHKCache(
+                                    os.path.join(self.basedir, ".chkcache")),
+                        keyCache=fcp.cache.KeyCache(
+                                    os.path.join(self.basedir, ".keycache")),
                         )
         if self.logfile:
             nodeopts['logfile'] = self.logfile
@@ -714,8 +718,8 @@ class SiteState:
             if rec['state'] == 'waiting':
                 continue
             log(INFO, "Pre-computing CHK for file %s" % rec['name'])
-            raw = file(rec['path'],"rb").read()
-            uri = self.chkCalcNode.genchk(data=raw, mimetype=rec['mimetype'])
+            uri = self.chkCalcNode.genchk(mimetype=rec['mimetype'],
+                                          **uploadKeywords(rec['path']))
             rec['uri'] = uri
             rec['state'] = 'waiting'
     
@@ -723,20 +727,19 @@ class SiteState:
             id = self.allocId(rec['name'])
     
             # and queue it up for insert, possibly on a different node
-            raw = file(rec['path'], "rb").read()
             self.node.put(
                 "CHK@",
                 id=id,
                 mimetype=rec['mimetype'],
                 priority=self.priority,
                 Verbosity=self.Verbosity,
-                data=raw,
                 async=True,
                 chkonly=testMode,
                 persistence="forever",
                 Global=True,
                 waituntilsent=True,
                 maxretries=maxretries,
+                **uploadKeywords(rec['path'])
                 )
             rec['state'] = 'inserting'
     
@@ -884,19 +887,12 @@ class SiteState:
         queuedJobs = {}
         
         # for each job on queue that we know, clear it
-        globalJobs = self.node.getGlobalJobs()
+        prefix = self.allocId("")
+        globalJobs = self.node.getGlobalJobs(prefix=prefix)
         for job in globalJobs:
         
             # get file rec, if any (could be __manifest)
-            parts = job.id.split("|")
-            if parts[0] != 'freesitemgr':
-                # that's not our job - ignore it
-                continue
-            if parts[1] != self.name:
-                # not our site - ignore it
-                continue
-        
-            name = parts[2]
+            name = job.id[len(prefix):]
             # bab: huh? duplicated info?
             queuedJobs[name] = name
         
@@ -1056,11 +1052,8 @@ class SiteState:
         """
         self.log(INFO, "clearing node queue of leftovers")
         self.node.refreshPersistentRequests()
-        for job in self.node.getGlobalJobs():
-            id = job.id
-            idparts = id.split("|")
-            if idparts[0] == 'freesitemgr' and idparts[1] == self.name:
-                self.node.clearGlobalJob(id)
+        for job in self.node.getGlobalJobs(prefix=self.allocId("")):
+            self.node.clearGlobalJob(job.id)
     
     #@-node:clearNodeQueue
     #@+node:readNodeQueue
@@ -1073,12 +1066,9 @@ class SiteState:
         """
         jobs = {}
         self.node.refreshPersistentRequests()
-        for job in self.node.getGlobalJobs():
-            id = job.id
-            idparts = id.split("|")
-            if idparts[0] == 'freesitemgr' and idparts[1] == self.name:
-                name = idparts[2]
-                jobs[name] = job
+        prefix = self.allocId("")
+        for job in self.node.getGlobalJobs(prefix=prefix):
+            jobs[job.id[len(prefix):]] = job
         return jobs
     
     #@-node:readNodeQueue
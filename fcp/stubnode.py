@@ -0,0 +1,1399 @@
+#@+leo-ver=4
+#@+node:@file stubnode.py
+"""
+A stand-in for a freenet node, for tests and load tests without one
+
+StubNode speaks enough FCP 2.0 on a localhost port for FCPNode, and
+what's built on it - putdir(), SiteMgr, the command line tools - to run
+on a machine with no node and no network. It serves no FProxy, so
+nothing which goes over HTTP, such as fproxyproxy, can use it. Keys live
+in memory: whatever is put can be got back, under the URI the node
+would have given it (CHKs from a hash of the data, public SSKs and USKs
+from the private ones), and anything else is not found.
+
+It answers ClientHello, ClientGet, ClientPut, ClientPutComplexDir,
+GetRequestStatus, GenerateSSK, ListPersistentRequests,
+RemovePersistentRequest, WatchGlobal, TestDDARequest/TestDDAResponse,
+ListPeers, ListPeer, AddPeer, ModifyPeer, RemovePeer, ListPeerNotes,
+ModifyPeerNote, GetNode, GetConfig, ModifyConfig and FCPPluginMessage.
+Anything else gets a ProtocolError.
+
+To make it behave like a busy node on a slow network, gets and puts can
+be given:
+    - latency, jitter - a fixed, and a random, number of seconds each
+      get or put takes
+    - bandwidth - bytes/second shared by all data fetched and inserted
+    - failRate - the chance of each get or put failing
+    - progress - how many SimpleProgress messages to flood each get or
+      put with before it finishes
+
+    stub = StubNode(latency=0.1, jitter=0.5, failRate=0.01)
+    stub.start()
+    node = FCPNode(port=stub.port)
+    ...
+    node.shutdown()
+    stub.shutdown()
+
+Run as a script, it serves till interrupted - see usage().
+"""
+
+#@+others
+#@+node:imports
+import SocketServer
+import base64
+import getopt
+import hashlib
+import heapq
+import itertools
+import mimetypes
+import os
+import random
+import re
+import socket
+import sys
+import threading
+import time
+
+from node import defaultFCPPort, expectedVersion
+
+#@-node:imports
+#@+node:globals
+# what we say we are in the NodeHello
+stubVersion = "Fred,0.7,1.0,1466"
+stubBuild = 1466
+
+# how many peers a stub node has, unless told otherwise
+defaultPeers = 3
+
+# USK@routing,crypto,extra/site/edition[/path]
+uskPattern = re.compile(r"^(USK@[^/]+/[^/]+)/(-?\d+)(/.*)?$")
+
+#@-node:globals
+#@+node:class StubNode
+class StubNode(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """
+    FCP server which keeps keys in memory, and answers like a node
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    #@    @+others
+    #@+node:__init__
+    def __init__(self, **kw):
+        """
+        Creates the server, listening but not yet answering - see start()
+
+        Keywords:
+            - host - address to listen on, default 127.0.0.1
+            - port - port to listen on, default 0, any free one. The
+              port actually used is in attribute 'port'
+            - latency - seconds each get or put takes, default 0
+            - jitter - up to this many random seconds more, default 0
+            - bandwidth - bytes/second the data of all the gets and puts
+              has to share, default None, unlimited
+            - failRate - chance, from 0 to 1, that a get or put fails,
+              default 0
+            - progress - number of SimpleProgress messages sent for each
+              get or put before it finishes, default 0
+            - peers - how many peers we have, default 3
+            - seed - seed for the random numbers behind jitter and
+              failRate, for repeatable runs
+        """
+        self.latency = kw.get('latency', 0)
+        self.jitter = kw.get('jitter', 0)
+        self.bandwidth = kw.get('bandwidth', None)
+        self.failRate = kw.get('failRate', 0)
+        self.progress = kw.get('progress', 0)
+        self.random = random.Random(kw.get('seed', None))
+
+        self.lock = threading.RLock()
+
+        # the keys, by URI, each (mimetype, data), or (None, uri) for a
+        # redirect to another key
+        self.store = {}
+
+        # gets and puts, keyed by (owner, identifier), where the owner is
+        # the client name for persistent requests, None for global ones,
+        # or else the connection
+        self.requests = {}
+
+        self.connections = []
+        self.peers = [_makePeer(i) for i in range(kw.get('peers', defaultPeers))]
+
+        # when the data of the gets and puts so far will all have gone
+        # through, at our bandwidth
+        self.linkFree = 0.0
+
+        # messages received and sent, by header
+        self.received = {}
+        self.sent = {}
+
+        self.scheduler = _Scheduler()
+        self.thread = None
+
+        SocketServer.TCPServer.__init__(
+            self, (kw.get('host', "127.0.0.1"), kw.get('port', 0)),
+            _StubConnection)
+        self.host, self.port = self.server_address
+
+    #@-node:__init__
+    #@+node:start
+    def start(self):
+        """
+        Starts answering connections, in a thread of our own.
+
+        Returns the port we're listening on
+        """
+        self.scheduler.start()
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        return self.port
+
+    #@-node:start
+    #@+node:shutdown
+    def shutdown(self):
+        """
+        Stops answering, and closes every connection
+        """
+        if self.thread is not None:
+            SocketServer.TCPServer.shutdown(self)
+            self.thread = None
+        self.server_close()
+        self.scheduler.stop()
+
+        self.lock.acquire()
+        try:
+            connections = list(self.connections)
+        finally:
+            self.lock.release()
+        for conn in connections:
+            conn.close()
+
+        # so none of them is still running as the interpreter exits
+        for conn in connections:
+            if conn.thread is not threading.currentThread():
+                conn.thread.join(5)
+
+    #@-node:shutdown
+    #@+node:insert
+    def insert(self, uri, data, mimetype="text/plain"):
+        """
+        Stores data under a URI, as if it had been put there, and returns
+        the URI it can be got from - for 'CHK@', the CHK of the data, and
+        for a private SSK or USK, the public one
+        """
+        uri = _insertUri(uri, data)
+        self.lock.acquire()
+        try:
+            self.store[uri] = (mimetype, data)
+        finally:
+            self.lock.release()
+        return uri
+
+    #@-node:insert
+    #@+node:getStats
+    def getStats(self):
+        """
+        Returns a dict of:
+            - received - messages received, by header
+            - sent - messages sent, by header
+            - keys - the number of keys stored
+            - requests - gets and puts the node is keeping, running or done
+            - connections - connections open
+        """
+        self.lock.acquire()
+        try:
+            return {'received': dict(self.received),
+                    'sent': dict(self.sent),
+                    'keys': len(self.store),
+                    'requests': len(self.requests),
+                    'connections': len(self.connections),
+                    }
+        finally:
+            self.lock.release()
+
+    #@-node:getStats
+    #@+node:_count
+    def _count(self, counts, header):
+        """
+        Counts a message received or sent
+        """
+        self.lock.acquire()
+        try:
+            counts[header] = counts.get(header, 0) + 1
+        finally:
+            self.lock.release()
+
+    #@-node:_count
+    #@+node:_delay
+    def _delay(self, nbytes):
+        """
+        Returns how many seconds from now a get or put of nbytes of data
+        should finish, and books the bandwidth it needs
+        """
+        delay = self.latency
+        if self.jitter:
+            delay += self.random.uniform(0, self.jitter)
+        if not self.bandwidth:
+            return delay
+
+        self.lock.acquire()
+        try:
+            now = time.time()
+            done = max(now + delay, self.linkFree) + float(nbytes) / self.bandwidth
+            self.linkFree = done
+        finally:
+            self.lock.release()
+        return done - now
+
+    #@-node:_delay
+    #@+node:_fails
+    def _fails(self):
+        """
+        Returns True if a get or put should fail, at our failRate
+        """
+        return self.failRate and self.random.random() < self.failRate
+
+    #@-node:_fails
+    #@+node:_lookup
+    def _lookup(self, uri):
+        """
+        Finds a key, following redirects.
+
+        Returns (mimetype, data), or (None, uri) if the key isn't there but
+        a later edition of the USK is, or None
+        """
+        uri = _normalize(uri)
+        self.lock.acquire()
+        try:
+            for i in range(10):
+                found = self.store.get(uri, None)
+                if found is None:
+                    break
+                if found[0] is not None:
+                    return found
+                uri = _normalize(found[1])
+
+            # a USK edition we haven't got - the node would point at the
+            # latest it knows of
+            match = uskPattern.match(uri)
+            if match is None:
+                return None
+            site, edition, path = match.groups()
+            editions = []
+            for key in self.store.keys():
+                m = uskPattern.match(key)
+                if m is not None and m.group(1) == site:
+                    editions.append(int(m.group(2)))
+            if not editions or max(editions) == int(edition):
+                return None
+            return (None, "%s/%d%s" % (site, max(editions), path or ""))
+        finally:
+            self.lock.release()
+
+    #@-node:_lookup
+    #@+node:_recipients
+    def _recipients(self, req):
+        """
+        Returns the open connections which should hear about a request -
+        the one which made it, and any other which the node would tell
+        """
+        self.lock.acquire()
+        try:
+            conns = []
+            for conn in self.connections:
+                if conn is req.conn \
+                or (req.owner is None and conn.watchGlobal) \
+                or (req.owner is not None and req.owner == conn.name):
+                    conns.append(conn)
+            return conns
+        finally:
+            self.lock.release()
+
+    #@-node:_recipients
+    #@-others
+
+#@-node:class StubNode
+#@+node:class _Request
+class _Request:
+    """
+    A get or put the stub node is working on, or has done
+    """
+    #@    @+others
+    #@+node:__init__
+    def __init__(self, conn, header, fields):
+        self.conn = conn
+        self.header = header
+        self.fields = fields
+        self.id = fields.get('Identifier', None)
+        self.isGlobal = _isTrue(fields.get('Global'))
+        self.isPersistent = self.isGlobal \
+            or fields.get('Persistence', "connection") != "connection"
+        if self.isGlobal:
+            self.owner = None
+        elif self.isPersistent:
+            self.owner = conn.name
+        else:
+            self.owner = conn
+        self.done = False
+        self.removed = False
+
+        # what we said when it finished, to say again when asked, and the
+        # AllData of a persistent get, which waits for a GetRequestStatus
+        self.replies = []
+        self.allData = None
+
+    #@-node:__init__
+    #@-others
+
+#@-node:class _Request
+#@+node:class _StubConnection
+class _StubConnection(SocketServer.BaseRequestHandler):
+    """
+    One client's connection to a StubNode
+    """
+    # the method handling each message, by header
+    handlers = {
+        'ClientHello': '_on_ClientHello',
+        'GenerateSSK': '_on_GenerateSSK',
+        'ClientGet': '_on_ClientGet',
+        'ClientPut': '_on_ClientPut',
+        'ClientPutComplexDir': '_on_ClientPutComplexDir',
+        'GetRequestStatus': '_on_GetRequestStatus',
+        'ListPersistentRequests': '_on_ListPersistentRequests',
+        'RemovePersistentRequest': '_on_RemovePersistentRequest',
+        'WatchGlobal': '_on_WatchGlobal',
+        'TestDDARequest': '_on_TestDDARequest',
+        'TestDDAResponse': '_on_TestDDAResponse',
+        'ListPeers': '_on_ListPeers',
+        'ListPeer': '_on_ListPeer',
+        'AddPeer': '_on_AddPeer',
+        'ModifyPeer': '_on_ModifyPeer',
+        'RemovePeer': '_on_RemovePeer',
+        'ListPeerNotes': '_on_ListPeerNotes',
+        'ModifyPeerNote': '_on_ModifyPeerNote',
+        'GetNode': '_on_GetNode',
+        'GetConfig': '_on_GetConfig',
+        'ModifyConfig': '_on_ModifyConfig',
+        'FCPPluginMessage': '_on_FCPPluginMessage',
+        }
+
+    #@    @+others
+    #@+node:setup
+    def setup(self):
+        self.stub = self.server
+        self.sock = self.request
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.rfile = self.sock.makefile("rb")
+        self.sendLock = threading.Lock()
+        self.thread = threading.currentThread()
+        self.closed = False
+        self.name = None
+        self.watchGlobal = False
+
+        # TestDDA checks under way, by directory
+        self.ddaChecks = {}
+
+    #@-node:setup
+    #@+node:handle
+    def handle(self):
+        """
+        Reads and answers messages till the client goes away
+        """
+        stub = self.stub
+        stub.lock.acquire()
+        try:
+            stub.connections.append(self)
+        finally:
+            stub.lock.release()
+
+        try:
+            while True:
+                msg = self._readMsg()
+                if msg is None:
+                    break
+                header, fields, data = msg
+                stub._count(stub.received, header)
+
+                if self.name is None and header != 'ClientHello':
+                    self.send("ProtocolError", Code=1, Fatal="true",
+                              CodeDescription="ClientHello must be first message",
+                              Identifier=fields.get('Identifier', None))
+                    break
+
+                name = self.handlers.get(header, None)
+                if name is None:
+                    self.send("ProtocolError", Code=7, Fatal="false",
+                              CodeDescription="Invalid message: %s" % header,
+                              Identifier=fields.get('Identifier', None))
+                else:
+                    getattr(self, name)(fields, data)
+        finally:
+            self._dropped()
+
+    #@-node:handle
+    #@+node:finish
+    def finish(self):
+        self.close()
+
+    #@-node:finish
+    #@+node:close
+    def close(self):
+        """
+        Hangs up on the client
+        """
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.rfile.close()
+
+    #@-node:close
+    #@+node:send
+    def send(self, header, data=None, **fields):
+        """
+        Sends a message, leaving out fields which are None. If data is
+        given, it follows as the message's data
+        """
+        lines = [header]
+        for k, v in fields.items():
+            if v is not None:
+                lines.append("%s=%s" % (k, v))
+        if data is None:
+            lines.append("EndMessage\n")
+            raw = "\n".join(lines)
+        else:
+            lines.append("DataLength=%d" % len(data))
+            lines.append("Data\n")
+            raw = "\n".join(lines) + data
+
+        self.sendLock.acquire()
+        try:
+            if self.closed:
+                return
+            try:
+                self.sock.sendall(raw)
+            except socket.error:
+                self.close()
+                return
+        finally:
+            self.sendLock.release()
+        self.stub._count(self.stub.sent, header)
+
+    #@-node:send
+    #@+node:_readMsg
+    def _readMsg(self):
+        """
+        Reads the next message, returning (header, fields, data) or None
+        once the client has gone
+        """
+        rfile = self.rfile
+        try:
+            while True:
+                line = rfile.readline()
+                if not line:
+                    return None
+                header = line.strip()
+                if header:
+                    break
+
+            fields = {}
+            data = None
+            while True:
+                line = rfile.readline()
+                if not line:
+                    return None
+                line = line.strip()
+                if line in ['End', 'EndMessage']:
+                    break
+                if line == 'Data':
+                    length = int(fields['DataLength'])
+                    data = rfile.read(length)
+                    if len(data) < length:
+                        return None
+                    break
+                k, v = line.split("=", 1)
+                fields[k] = v
+        except (socket.error, ValueError):
+            return None
+        return header, fields, data
+
+    #@-node:_readMsg
+    #@+node:_dropped
+    def _dropped(self):
+        """
+        The client has gone - forget it, and the requests which only
+        lasted as long as its connection
+        """
+        stub = self.stub
+        stub.lock.acquire()
+        try:
+            if self in stub.connections:
+                stub.connections.remove(self)
+            for key, req in stub.requests.items():
+                if req.owner is self:
+                    req.removed = True
+                    del stub.requests[key]
+        finally:
+            stub.lock.release()
+
+    #@-node:_dropped
+    #@+node:_deliver
+    def _deliver(self, req, header, data=None, **fields):
+        """
+        Sends a message about a request to everyone who should hear it
+        """
+        fields['Identifier'] = req.id
+        fields['Global'] = str(req.isGlobal).lower()
+        for conn in self.stub._recipients(req):
+            conn.send(header, data, **fields)
+
+    #@-node:_deliver
+    #@+node:_newRequest
+    def _newRequest(self, header, fields):
+        """
+        Registers a get or put, and returns it - or says IdentifierCollision
+        and returns None, if one is already running under its identifier
+        """
+        req = _Request(self, header, fields)
+        stub = self.stub
+        stub.lock.acquire()
+        try:
+            old = stub.requests.get((req.owner, req.id), None)
+            if old is None or old.done:
+                stub.requests[(req.owner, req.id)] = req
+                return req
+        finally:
+            stub.lock.release()
+
+        self.send("IdentifierCollision", Identifier=req.id,
+                  Global=str(req.isGlobal).lower())
+        return None
+
+    #@-node:_newRequest
+    #@+node:_findRequest
+    def _findRequest(self, fields):
+        """
+        Returns the request a GetRequestStatus or RemovePersistentRequest
+        is about, or None
+        """
+        id = fields.get('Identifier', None)
+        if _isTrue(fields.get('Global')):
+            owners = [None]
+        else:
+            owners = [self.name, self]
+        stub = self.stub
+        stub.lock.acquire()
+        try:
+            for owner in owners:
+                req = stub.requests.get((owner, id), None)
+                if req is not None:
+                    return req
+        finally:
+            stub.lock.release()
+        return None
+
+    #@-node:_findRequest
+    #@+node:_flood
+    def _flood(self, req):
+        """
+        Sends a request's share of progress messages, all at once
+        """
+        total = self.stub.progress
+        for i in range(total):
+            self._deliver(req, "SimpleProgress", Total=total, Required=total,
+                          Failed=0, FatallyFailed=0, Succeeded=i + 1,
+                          FinalizedTotal="true")
+
+    #@-node:_flood
+    #@+node:_finish
+    def _finish(self, req, header, data=None, **fields):
+        """
+        Sends the message which finishes a request, and remembers it for
+        ListPersistentRequests and GetRequestStatus.
+
+        Returns False if the request has been removed meanwhile, so there
+        was nothing to send
+        """
+        stub = self.stub
+        stub.lock.acquire()
+        try:
+            if req.removed:
+                return False
+            req.done = True
+            req.replies.append((header, data, fields))
+            if not req.isPersistent:
+                stub.requests.pop((req.owner, req.id), None)
+        finally:
+            stub.lock.release()
+        self._deliver(req, header, data, **fields)
+        return True
+
+    #@-node:_finish
+    #@+node:_on_ClientHello
+    def _on_ClientHello(self, fields, data):
+        if self.name is not None:
+            self.send("ProtocolError", Code=2, Fatal="false",
+                      CodeDescription="No late ClientHello")
+            return
+        self.name = fields.get('Name', "")
+        self.send("NodeHello", FCPVersion=expectedVersion, Version=stubVersion,
+                  Node="Fred", Build=stubBuild, Revision="stub",
+                  ExtBuild=29, ExtRevision="stub", Testnet="false",
+                  CompressionCodecs="1 - GZIP(0)",
+                  ConnectionIdentifier=_randomHex(16))
+
+    #@-node:_on_ClientHello
+    #@+node:_on_GenerateSSK
+    def _on_GenerateSSK(self, fields, data):
+        routing = _randomKeyPart()
+        crypto = _randomKeyPart()
+        private = "SSK@%s,%s,AQECAAE/" % (routing, crypto)
+        self.send("SSKKeypair", Identifier=fields.get('Identifier', None),
+                  InsertURI=private, RequestURI=_publicUri(private) + "/")
+
+    #@-node:_on_GenerateSSK
+    #@+node:_on_ClientGet
+    def _on_ClientGet(self, fields, data):
+        req = self._newRequest("ClientGet", fields)
+        if req is None:
+            return
+        self._flood(req)
+
+        found = self.stub._lookup(fields.get('URI', ""))
+        if found is None or found[0] is None:
+            nbytes = 0
+        else:
+            nbytes = len(found[1])
+        self.stub.scheduler.call(self.stub._delay(nbytes),
+                                 self._finishGet, req, found)
+
+    #@-node:_on_ClientGet
+    #@+node:_finishGet
+    def _finishGet(self, req, found):
+        """
+        Gives a get its result, once it has taken long enough
+        """
+        fields = req.fields
+        if self.stub._fails():
+            self._finish(req, "GetFailed", Code=28, Fatal="false",
+                         CodeDescription="All data not found",
+                         ShortCodeDescription="All data not found")
+            return
+        if found is None:
+            self._finish(req, "GetFailed", Code=13, Fatal="true",
+                         CodeDescription="Data not found",
+                         ShortCodeDescription="Data not found")
+            return
+
+        mimetype, data = found
+        if mimetype is None:
+            self._finish(req, "GetFailed", Code=27, Fatal="true",
+                         CodeDescription="Permanent redirect: use the new URI",
+                         ShortCodeDescription="New URI", RedirectURI=data)
+            return
+
+        returnType = fields.get('ReturnType', "direct")
+        if returnType == "disk":
+            try:
+                f = file(fields['Filename'], "wb")
+                try:
+                    f.write(data)
+                finally:
+                    f.close()
+            except (IOError, KeyError):
+                self._finish(req, "ProtocolError", Code=13, Fatal="false",
+                             CodeDescription="Could not write file")
+                return
+
+        if returnType == "direct":
+            allData = (data, {'Metadata.ContentType': mimetype})
+            if req.isPersistent:
+                # sent when asked for with GetRequestStatus
+                req.allData = allData
+        delivered = self._finish(req, "DataFound", DataLength=len(data),
+                                 **{'Metadata.ContentType': mimetype})
+        if delivered and returnType == "direct" and not req.isPersistent:
+            self._deliver(req, "AllData", allData[0], **allData[1])
+
+    #@-node:_finishGet
+    #@+node:_on_ClientPut
+    def _on_ClientPut(self, fields, data):
+        mimetype = fields.get('Metadata.ContentType', "text/plain")
+        uploadFrom = fields.get('UploadFrom', "direct")
+        if uploadFrom == "disk":
+            data = self._readFile(fields)
+            if data is None:
+                return
+        elif uploadFrom == "redirect":
+            data = None
+        elif data is None:
+            data = ""
+
+        req = self._newRequest("ClientPut", fields)
+        if req is None:
+            return
+
+        uri = _insertUri(fields.get('URI', "CHK@"), data or "",
+                              fields.get('TargetFilename', None))
+        self._deliver(req, "URIGenerated", URI=uri)
+        self._flood(req)
+
+        if _isTrue(fields.get('GetCHKOnly')):
+            self._finish(req, "PutSuccessful", URI=uri)
+            return
+
+        if uploadFrom == "redirect":
+            value = (None, fields['TargetURI'])
+        else:
+            value = (mimetype, data)
+        self.stub.scheduler.call(self.stub._delay(len(data or "")),
+                                 self._finishPut, req, uri, {uri: value})
+
+    #@-node:_on_ClientPut
+    #@+node:_on_ClientPutComplexDir
+    def _on_ClientPutComplexDir(self, fields, data):
+        # gather the files, whose direct data comes one after another
+        files = []
+        offset = 0
+        n = 0
+        while fields.has_key("Files.%d.Name" % n):
+            prefix = "Files.%d." % n
+            name = fields[prefix + "Name"]
+            mimetype = fields.get(prefix + "Metadata.ContentType", None) \
+                or mimetypes.guess_type(name)[0] or "application/octet-stream"
+            uploadFrom = fields.get(prefix + "UploadFrom", "direct")
+            if uploadFrom == "disk":
+                content = self._readFile(fields, prefix + "Filename")
+                if content is None:
+                    return
+                value = (mimetype, content)
+            elif uploadFrom == "redirect":
+                value = (None, fields[prefix + "TargetURI"])
+            else:
+                length = int(fields[prefix + "DataLength"])
+                value = (mimetype, (data or "")[offset:offset + length])
+                offset += length
+            files.append((name, value))
+            n += 1
+
+        req = self._newRequest("ClientPutComplexDir", fields)
+        if req is None:
+            return
+
+        # the manifest's CHK depends on everything in it
+        h = hashlib.sha256()
+        nbytes = 0
+        for name, value in files:
+            h.update("%s\0%s\0%s\0" % (name, value[0], value[1]))
+            if value[0] is not None:
+                nbytes += len(value[1])
+        uri = _insertUri(fields.get('URI', "CHK@"), h.digest(), None)
+        uri = uri.rstrip("/")
+        self._deliver(req, "URIGenerated", URI=uri + "/")
+        self._flood(req)
+
+        keys = {}
+        names = []
+        for name, value in files:
+            keys[uri + "/" + name] = value
+            names.append(name)
+        default = fields.get('DefaultName', "index.html")
+        if default in names:
+            keys[uri] = (None, uri + "/" + default)
+        self.stub.scheduler.call(self.stub._delay(nbytes),
+                                 self._finishPut, req, uri + "/", keys)
+
+    #@-node:_on_ClientPutComplexDir
+    #@+node:_finishPut
+    def _finishPut(self, req, uri, keys):
+        """
+        Stores what a put has put, once it has taken long enough
+        """
+        if self.stub._fails():
+            self._finish(req, "PutFailed", Code=10, Fatal="false",
+                         CodeDescription="Route not found",
+                         ShortCodeDescription="Route not found")
+            return
+
+        stub = self.stub
+        stub.lock.acquire()
+        try:
+            if req.removed:
+                return
+            stub.store.update(keys)
+        finally:
+            stub.lock.release()
+        now = int(time.time() * 1000)
+        self._finish(req, "PutSuccessful", URI=uri, StartupTime=now,
+                     CompletionTime=now)
+
+    #@-node:_finishPut
+    #@+node:_readFile
+    def _readFile(self, fields, key='Filename'):
+        """
+        Reads the file a put is to upload from disk, or says why not and
+        returns None
+        """
+        try:
+            f = file(fields[key], "rb")
+            try:
+                return f.read()
+            finally:
+                f.close()
+        except (IOError, KeyError):
+            self.send("ProtocolError", Code=9, Fatal="false",
+                      CodeDescription="File not found",
+                      Identifier=fields.get('Identifier', None),
+                      Global=fields.get('Global', None))
+            return None
+
+    #@-node:_readFile
+    #@+node:_on_GetRequestStatus
+    def _on_GetRequestStatus(self, fields, data):
+        req = self._findRequest(fields)
+        if req is None:
+            self.send("ProtocolError", Code=15, Fatal="false",
+                      CodeDescription="No such identifier",
+                      Identifier=fields.get('Identifier', None),
+                      Global=fields.get('Global', None))
+            return
+        if not req.done:
+            return
+        if req.allData is not None:
+            data, extra = req.allData
+            self._deliverTo(req, "AllData", data, **extra)
+        else:
+            for header, data, extra in req.replies:
+                self._deliverTo(req, header, data, **extra)
+
+    #@-node:_on_GetRequestStatus
+    #@+node:_deliverTo
+    def _deliverTo(self, req, header, data=None, **fields):
+        """
+        Sends a message about a request to this connection only
+        """
+        fields['Identifier'] = req.id
+        fields['Global'] = str(req.isGlobal).lower()
+        self.send(header, data, **fields)
+
+    #@-node:_deliverTo
+    #@+node:_on_ListPersistentRequests
+    def _on_ListPersistentRequests(self, fields, data):
+        stub = self.stub
+        stub.lock.acquire()
+        try:
+            reqs = [req for (owner, id), req in stub.requests.items()
+                    if (owner is None and self.watchGlobal)
+                    or (owner is not None and owner == self.name)]
+        finally:
+            stub.lock.release()
+
+        listed = {'ClientGet': "PersistentGet", 'ClientPut': "PersistentPut",
+                  'ClientPutComplexDir': "PersistentPutDir"}
+        for req in reqs:
+            extra = {}
+            for k in ['URI', 'Verbosity', 'PriorityClass', 'ReturnType',
+                      'Filename', 'UploadFrom', 'Metadata.ContentType',
+                      'MaxRetries', 'ClientToken']:
+                if req.fields.has_key(k):
+                    extra[k] = req.fields[k]
+            extra['PersistenceType'] = req.fields.get('Persistence', "forever")
+            self._deliverTo(req, listed[req.header], Started="true", **extra)
+            for header, data, extra in req.replies:
+                self._deliverTo(req, header, data, **extra)
+        self.send("EndListPersistentRequests")
+
+    #@-node:_on_ListPersistentRequests
+    #@+node:_on_RemovePersistentRequest
+    def _on_RemovePersistentRequest(self, fields, data):
+        req = self._findRequest(fields)
+        if req is not None:
+            stub = self.stub
+            stub.lock.acquire()
+            try:
+                req.removed = True
+                stub.requests.pop((req.owner, req.id), None)
+            finally:
+                stub.lock.release()
+        self.send("PersistentRequestRemoved",
+                  Identifier=fields.get('Identifier', None),
+                  Global=fields.get('Global', "false"))
+
+    #@-node:_on_RemovePersistentRequest
+    #@+node:_on_WatchGlobal
+    def _on_WatchGlobal(self, fields, data):
+        self.watchGlobal = _isTrue(fields.get('Enabled', "true"))
+
+    #@-node:_on_WatchGlobal
+    #@+node:_on_TestDDARequest
+    def _on_TestDDARequest(self, fields, data):
+        directory = fields.get('Directory', "")
+        check = {}
+        reply = {'Directory': directory}
+        if _isTrue(fields.get('WantReadDirectory')):
+            # we write a file for the client to read back to us
+            readFilename = os.path.join(directory, "DDACheck-%s.tmp" % _randomHex(8))
+            content = _randomHex(16)
+            try:
+                f = file(readFilename, "wb")
+                try:
+                    f.write(content)
+                finally:
+                    f.close()
+                reply['ReadFilename'] = readFilename
+                check['read'] = (readFilename, content)
+            except IOError:
+                check['read'] = None
+        if _isTrue(fields.get('WantWriteDirectory')):
+            # and the client writes one for us to read
+            writeFilename = os.path.join(directory, "DDACheck-%s.tmp" % _randomHex(8))
+            content = _randomHex(16)
+            reply['WriteFilename'] = writeFilename
+            reply['ContentToWrite'] = content
+            check['write'] = (writeFilename, content)
+        self.ddaChecks[directory] = check
+        self.send("TestDDAReply", **reply)
+
+    #@-node:_on_TestDDARequest
+    #@+node:_on_TestDDAResponse
+    def _on_TestDDAResponse(self, fields, data):
+        directory = fields.get('Directory', "")
+        check = self.ddaChecks.pop(directory, None)
+        if check is None:
+            self.send("ProtocolError", Code=7, Fatal="false",
+                      CodeDescription="TestDDAResponse without TestDDARequest")
+            return
+
+        reply = {'Directory': directory}
+        if check.has_key('read'):
+            allowed = False
+            if check['read'] is not None:
+                readFilename, content = check['read']
+                allowed = fields.get('ReadContent', None) == content
+                try:
+                    os.remove(readFilename)
+                except OSError:
+                    pass
+            reply['ReadDirectoryAllowed'] = str(allowed).lower()
+        if check.has_key('write'):
+            writeFilename, content = check['write']
+            try:
+                f = file(writeFilename, "rb")
+                try:
+                    allowed = f.read() == content
+                finally:
+                    f.close()
+            except IOError:
+                allowed = False
+            reply['WriteDirectoryAllowed'] = str(allowed).lower()
+        self.send("TestDDAComplete", **reply)
+
+    #@-node:_on_TestDDAResponse
+    #@+node:_on_ListPeers
+    def _on_ListPeers(self, fields, data):
+        id = fields.get('Identifier', None)
+        withMetadata = _isTrue(fields.get('WithMetadata'))
+        withVolatile = _isTrue(fields.get('WithVolatile'))
+        for peer in list(self.stub.peers):
+            self._sendPeer(peer, id, withMetadata, withVolatile)
+        self.send("EndListPeers", Identifier=id)
+
+    #@-node:_on_ListPeers
+    #@+node:_sendPeer
+    def _sendPeer(self, peer, id=None, withMetadata=True, withVolatile=True):
+        """
+        Sends a Peer message
+        """
+        fields = {}
+        for k, v in peer.items():
+            if k == 'notes' \
+            or (k.startswith("metadata.") and not withMetadata) \
+            or (k.startswith("volatile.") and not withVolatile):
+                continue
+            fields[k] = v
+        self.send("Peer", Identifier=id, **fields)
+
+    #@-node:_sendPeer
+    #@+node:_findPeer
+    def _findPeer(self, fields):
+        """
+        Returns the peer named by a message's NodeIdentifier, or says
+        UnknownNodeIdentifier and returns None
+        """
+        ident = fields.get('NodeIdentifier', None)
+        for peer in self.stub.peers:
+            if ident in (peer['identity'], peer['myName'],
+                         peer['physical.udp']):
+                return peer
+        self.send("UnknownNodeIdentifier", NodeIdentifier=ident,
+                  Identifier=fields.get('Identifier', None))
+        return None
+
+    #@-node:_findPeer
+    #@+node:_on_ListPeer
+    def _on_ListPeer(self, fields, data):
+        peer = self._findPeer(fields)
+        if peer is not None:
+            self._sendPeer(peer, fields.get('Identifier', None))
+
+    #@-node:_on_ListPeer
+    #@+node:_on_AddPeer
+    def _on_AddPeer(self, fields, data):
+        if not fields.has_key('identity'):
+            self.send("ProtocolError", Code=16, Fatal="false",
+                      CodeDescription="Not supported: AddPeer from a File or URL",
+                      Identifier=fields.get('Identifier', None))
+            return
+        stub = self.stub
+        stub.lock.acquire()
+        try:
+            peer = _makePeer(len(stub.peers))
+            for k, v in fields.items():
+                if k != 'Identifier':
+                    peer[k] = v
+            stub.peers.append(peer)
+        finally:
+            stub.lock.release()
+        self._sendPeer(peer, fields.get('Identifier', None))
+
+    #@-node:_on_AddPeer
+    #@+node:_on_ModifyPeer
+    def _on_ModifyPeer(self, fields, data):
+        peer = self._findPeer(fields)
+        if peer is None:
+            return
+        for k in ['AllowLocalAddresses', 'IsDisabled', 'IsListenOnly',
+                  'IsBurstOnly', 'IgnoreSourcePort']:
+            if fields.has_key(k):
+                peer[k[0].lower() + k[1:]] = fields[k]
+        self._sendPeer(peer, fields.get('Identifier', None))
+
+    #@-node:_on_ModifyPeer
+    #@+node:_on_RemovePeer
+    def _on_RemovePeer(self, fields, data):
+        peer = self._findPeer(fields)
+        if peer is None:
+            return
+        stub = self.stub
+        stub.lock.acquire()
+        try:
+            if peer in stub.peers:
+                stub.peers.remove(peer)
+        finally:
+            stub.lock.release()
+        self.send("PeerRemoved", identity=peer['identity'],
+                  NodeIdentifier=fields.get('NodeIdentifier', None),
+                  Identifier=fields.get('Identifier', None))
+
+    #@-node:_on_RemovePeer
+    #@+node:_on_ListPeerNotes
+    def _on_ListPeerNotes(self, fields, data):
+        peer = self._findPeer(fields)
+        if peer is None:
+            return
+        for noteType, text in peer['notes'].items():
+            self.send("PeerNote", NodeIdentifier=fields['NodeIdentifier'],
+                      PeerNoteType=noteType, NoteText=text,
+                      Identifier=fields.get('Identifier', None))
+        self.send("EndListPeerNotes", NodeIdentifier=fields['NodeIdentifier'],
+                  Identifier=fields.get('Identifier', None))
+
+    #@-node:_on_ListPeerNotes
+    #@+node:_on_ModifyPeerNote
+    def _on_ModifyPeerNote(self, fields, data):
+        peer = self._findPeer(fields)
+        if peer is None:
+            return
+        noteType = fields.get('PeerNoteType', "1")
+        if noteType != "1":
+            self.send("UnknownPeerNoteType", PeerNoteType=noteType,
+                      Identifier=fields.get('Identifier', None))
+            return
+        peer['notes'][noteType] = fields.get('NoteText', "")
+        self.send("PeerNote", NodeIdentifier=fields['NodeIdentifier'],
+                  PeerNoteType=noteType, NoteText=peer['notes'][noteType],
+                  Identifier=fields.get('Identifier', None))
+
+    #@-node:_on_ModifyPeerNote
+    #@+node:_on_GetNode
+    def _on_GetNode(self, fields, data):
+        reply = {'Identifier': fields.get('Identifier', None),
+                 'identity': _keyPart(hashlib.sha256("stub").digest()),
+                 'myName': "stub", 'opennet': "false", 'testnet': "false",
+                 'version': stubVersion, 'lastGoodVersion': stubVersion,
+                 'physical.udp': "127.0.0.1:%d" % self.stub.port,
+                 'location': "0.5", 'ark.number': 1,
+                 'ark.pubURI': _publicUri("SSK@stub,stub,AQECAAE/ark"),
+                 }
+        if _isTrue(fields.get('WithPrivate')):
+            reply['ark.privURI'] = "SSK@stub,stub,AQECAAE/ark"
+            reply['dsaPrivKey.x'] = _randomHex(20)
+        if _isTrue(fields.get('WithVolatile')):
+            reply['volatile.uptimeSeconds'] = 3600
+            reply['volatile.numberOfConnected'] = len(self.stub.peers)
+            reply['volatile.numberOfRunningRequests'] = len(self.stub.requests)
+        self.send("NodeData", **reply)
+
+    #@-node:_on_GetNode
+    #@+node:_on_GetConfig
+    def _on_GetConfig(self, fields, data):
+        self.send("ConfigData", Identifier=fields.get('Identifier', None),
+                  **{'current.fcp.port': self.stub.port,
+                     'current.node.name': "stub"})
+
+    #@-node:_on_GetConfig
+    #@+node:_on_ModifyConfig
+    def _on_ModifyConfig(self, fields, data):
+        self._on_GetConfig(fields, data)
+
+    #@-node:_on_ModifyConfig
+    #@+node:_on_FCPPluginMessage
+    def _on_FCPPluginMessage(self, fields, data):
+        self.send("FCPPluginReply", PluginName=fields.get('PluginName', None),
+                  Identifier=fields.get('Identifier', None))
+
+    #@-node:_on_FCPPluginMessage
+    #@-others
+
+#@-node:class _StubConnection
+#@+node:class _Scheduler
+class _Scheduler:
+    """
+    A thread which calls functions when their time comes, so that any
+    number of gets and puts can be taking their time at once
+    """
+    #@    @+others
+    #@+node:__init__
+    def __init__(self):
+        self.heap = []
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    #@-node:__init__
+    #@+node:start
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    #@-node:start
+    #@+node:stop
+    def stop(self):
+        self.cond.acquire()
+        try:
+            self.running = False
+            self.cond.notify()
+        finally:
+            self.cond.release()
+        if self.thread is not None \
+        and self.thread is not threading.currentThread():
+            self.thread.join(5)
+
+    #@-node:stop
+    #@+node:call
+    def call(self, delay, func, *args):
+        """
+        Calls func(*args) in delay seconds
+        """
+        self.cond.acquire()
+        try:
+            heapq.heappush(self.heap, (time.time() + delay, self.seq.next(),
+                                       func, args))
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    #@-node:call
+    #@+node:_run
+    def _run(self):
+        cond = self.cond
+        while True:
+            cond.acquire()
+            try:
+                while self.running:
+                    if self.heap:
+                        wait = self.heap[0][0] - time.time()
+                        if wait <= 0:
+                            break
+                        cond.wait(wait)
+                    else:
+                        cond.wait()
+                if not self.running:
+                    return
+                when, seq, func, args = heapq.heappop(self.heap)
+            finally:
+                cond.release()
+            func(*args)
+
+    #@-node:_run
+    #@-others
+
+#@-node:class _Scheduler
+#@+node:util funcs
+def _keyPart(digest):
+    """
+    Encodes 32 bytes as freenet does for the parts of a key
+    """
+    return base64.b64encode(digest, "~-").rstrip("=")
+
+def _randomKeyPart():
+    return _keyPart(os.urandom(32))
+
+def _randomHex(nbytes):
+    return os.urandom(nbytes).encode("hex")
+
+def _isTrue(value):
+    """
+    Returns True if a message field says 'true', in any case
+    """
+    return str(value).lower() == "true"
+
+def _normalize(uri):
+    """
+    Strips a URI of anything which makes no difference to what it names
+    """
+    return uri.strip().split("freenet:")[-1].rstrip("/")
+
+def _insertUri(uri, data, filename=None):
+    """
+    Returns the URI data inserted under uri would be fetchable from.
+    CHKs depend only on the data
+    """
+    uri = _normalize(uri)
+    if uri.startswith("CHK@"):
+        h = hashlib.sha256(data)
+        routing = _keyPart(h.digest())
+        crypto = _keyPart(hashlib.sha256(h.digest()).digest())
+        uri = "CHK@%s,%s,AAMC--8" % (routing, crypto)
+        if filename:
+            uri += "/" + filename
+        return uri
+    return _publicUri(uri)
+
+def _publicUri(uri):
+    """
+    Returns the public form of an SSK or USK, given the private one.
+    Anything else is returned as it is
+    """
+    uri = _normalize(uri)
+    if uri[:4] not in ("SSK@", "USK@"):
+        return uri
+    bits = uri[4:].split("/", 1)
+    parts = bits[0].split(",")
+    if len(parts) != 3 or not parts[2].startswith("AQEC"):
+        return uri
+    routing = _keyPart(hashlib.sha256(parts[0]).digest())
+    key = "%s%s,%s,AQACAAE" % (uri[:4], routing, parts[1])
+    return "/".join([key] + bits[1:])
+
+def _makePeer(n):
+    """
+    Makes up the fields of peer number n
+    """
+    return {
+        'identity': _keyPart(hashlib.sha256("peer%d" % n).digest()),
+        'myName': "peer%d" % n,
+        'opennet': "false",
+        'version': stubVersion,
+        'lastGoodVersion': stubVersion,
+        'physical.udp': "127.0.0.%d:%d" % (n % 250 + 2, 30000 + n),
+        'location': "%.6f" % ((n * 0.618034) % 1),
+        'metadata.timeLastConnected': int(time.time() * 1000),
+        'volatile.status': "CONNECTED",
+        'volatile.averagePingTime': "50.0",
+        'notes': {},
+        }
+
+#@-node:util funcs
+#@+node:usage
+def usage(msg="", ret=1):
+
+    if msg:
+        sys.stderr.write(msg+"\n")
+
+    print "\n".join([
+        "Stub freenet node, for testing FCP clients without a node",
+        "Usage: %s [options]" % sys.argv[0],
+        "Options:",
+        "  -h, --help",
+        "       show this usage message",
+        "  --host=",
+        "       hostname to listen on, default 127.0.0.1",
+        "  --port=",
+        "       port to listen on, default %s" % defaultFCPPort,
+        "  --latency=",
+        "       seconds each get or put takes, default 0",
+        "  --jitter=",
+        "       up to this many random seconds more, default 0",
+        "  --bandwidth=",
+        "       bytes/sec shared by all gets and puts, default unlimited",
+        "  --failrate=",
+        "       chance, 0 to 1, of a get or put failing, default 0",
+        "  --progress=",
+        "       SimpleProgress messages for each get or put, default 0",
+        "  --peers=",
+        "       number of peers, default %d" % defaultPeers,
+        "  --seed=",
+        "       random seed, for repeatable runs",
+        ])
+
+    sys.exit(ret)
+
+#@-node:usage
+#@+node:main
+def main():
+    """
+    Runs a stub node until interrupted
+    """
+    opts = {'port': defaultFCPPort}
+    try:
+        cmdopts, args = getopt.getopt(
+            sys.argv[1:], "?h",
+            ["help", "host=", "port=", "latency=", "jitter=", "bandwidth=",
+             "failrate=", "progress=", "peers=", "seed="])
+    except getopt.GetoptError:
+        usage()
+
+    numeric = {'--port': ('port', int), '--latency': ('latency', float),
+               '--jitter': ('jitter', float),
+               '--bandwidth': ('bandwidth', float),
+               '--failrate': ('failRate', float),
+               '--progress': ('progress', int), '--peers': ('peers', int),
+               '--seed': ('seed', int)}
+    for o, a in cmdopts:
+        if o in ("-?", "-h", "--help"):
+            usage(ret=0)
+        elif o == "--host":
+            opts['host'] = a
+        else:
+            name, conv = numeric[o]
+            try:
+                opts[name] = conv(a)
+            except ValueError:
+                usage("Invalid %s '%s'" % (o, a))
+
+    stub = StubNode(**opts)
+    stub.start()
+    print "Stub freenet node listening on %s:%s" % (stub.host, stub.port)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        stub.shutdown()
+
+#@-node:main
+#@-others
+
+if __name__ == '__main__':
+    main()
+
+#@-node:@file stubnode.py
+#@-leo
@@ -94,7 +94,9 @@ class FreenetXMLRPCRequestHandler:
         if options.has_key('dir'):
             raise Exception("dir option not available over XML-RPC")
     
-        return self.node.get(uri, **options)
+        # xmlrpclib only marshals real dicts
+        mimetype, data, msg = self.node.get(uri, **options)
+        return mimetype, data, dict(msg)
     
     def put(self, uri, options=None):
         """
@@ -11,16 +11,22 @@ wrong node ip
 different IP Port
 """
 
-import sys, os, tempfile, random, uuid
+import sys, os, tempfile, random, uuid, threading, time, socket
 import fcp
 fcpHost = "127.0.0.1"
+fcpPort = fcp.node.defaultFCPPort
 workdir = tempfile.mkdtemp()
 os.chdir(workdir)
 myid = str(uuid.uuid4().hex)
 with open("index.html", "w") as f:
     f.write("<html><head><title>Test</title></head><body>Test</body></html>\n")
 
-node = fcp.FCPNode(host=fcpHost, verbosity=fcp.FATAL)
+if os.environ.get("FCP_STUB"):
+    # no node needed - test against a stub one, on a port of its own
+    stub = fcp.StubNode(latency=0.1)
+    fcpPort = stub.start()
+
+node = fcp.FCPNode(host=fcpHost, port=fcpPort, verbosity=fcp.FATAL)
 
 def genkey(*args, **kwds):
     '''
@@ -63,6 +69,36 @@ def submitCmd(*args, **kwds):
     return node._submitCmd(*args, **kwds)
 
 
+def addHandler(*args, **kwds):
+    '''
+
+    A handler added for a message sees it first, and can pass it on to
+    the one it replaced:
+
+    >>> seen = []
+    >>> def onGenerated(node, job, msg):
+    ...     seen.append(msg['URI'])
+    ...     return old(node, job, msg)
+    >>> old = addHandler('URIGenerated', onGenerated)
+    >>> chk = put(data="handled" + myid, priority=1, realtime=True)
+    >>> seen == [chk]
+    True
+    >>> removeHandler('URIGenerated')
+    >>> chk = put(data="unhandled" + myid, priority=1, realtime=True)
+    >>> len(seen)
+    1
+    
+    '''
+    return node.addHandler(*args, **kwds)
+
+def removeHandler(*args, **kwds):
+    '''
+
+    (tested with addHandler)
+    
+    '''
+    return node.removeHandler(*args, **kwds)
+
 def fcpPluginMessage(*args, **kwds):
     '''
 
@@ -106,10 +142,108 @@ def get(uri, *args, **kwds):
     '''
     
     >>> # get("KSK@gpl.txt")
+
+    The data of a reply nobody is waiting for any more is read past,
+    and the connection kept:
+
+    >>> slow = fcp.StubNode(latency=1)
+    >>> n = fcp.FCPNode(host=fcpHost, port=slow.start(), verbosity=fcp.FATAL)
+    >>> chk = slow.insert("CHK@", "forgotten" + myid)
+    >>> forgotten = n.get(chk, async=True)
+    >>> abandoned = n.get(chk, async=True)
+    >>> _waitUntil(lambda: forgotten.id in n.jobs and abandoned.id in n.jobs)
+    True
+    >>> del n.jobs[forgotten.id]
+    >>> abandoned.abandoned = True    # removed too late to stop the reply
+    >>> _waitUntil(lambda: slow.getStats()['sent'].get('AllData') == 2)
+    True
+    >>> n.get(chk)[1] == "forgotten" + myid
+    True
+    >>> n.shutdown()
+    >>> slow.shutdown()
     
     '''
     return node.get(uri, *args, **kwds)
 
+def iterget(uri, *args, **kwds):
+    '''
+
+    >>> data = "iter" + myid
+    >>> chk = put(data=data, priority=1, realtime=True)
+    >>> chunks = iterget(chk, priority=1, realtime=True)
+    >>> "".join(chunks) == data
+    True
+    >>> chunks.mimetype
+    'text/plain'
+    '''
+    return node.iterget(uri, *args, **kwds)
+
+
+def getmany(uris, *args, **kwds):
+    '''
+
+    >>> chks = [put(data="many%d" % i + myid, priority=1, realtime=True)
+    ...         for i in range(3)]
+    >>> results = dict(getmany(chks, concurrency=2, priority=1, realtime=True))
+    >>> sorted([results[chk][1][:5] for chk in chks])
+    ['many0', 'many1', 'many2']
+    >>> statuses = []
+    >>> results = list(getmany(chks, callback=lambda s, v: statuses.append(s)))
+    >>> statuses.count('successful')
+    3
+
+    A get which times out is removed from the node, which then doesn't
+    send its data after all:
+
+    >>> slow = fcp.StubNode(latency=2)
+    >>> n = fcp.FCPNode(host=fcpHost, port=slow.start(), verbosity=fcp.FATAL)
+    >>> chk = slow.insert("CHK@", "late" + myid)
+    >>> [result.__class__.__name__
+    ...  for uri, result in n.getmany([chk], timeout=0.5)]
+    ['FCPNodeTimeout']
+    >>> time.sleep(2)
+    >>> slow.getStats()['sent'].get('AllData')
+    >>> n.get(chk)[1] == "late" + myid
+    True
+    >>> n.shutdown()
+    >>> slow.shutdown()
+    '''
+    return node.getmany(uris, *args, **kwds)
+
+
+def coalescedget(uri, *args, **kwds):
+    '''
+
+    >>> chk = put(data="coalesced" + myid, priority=1, realtime=True)
+    >>> before = node.coalescedGets
+    >>> jobs = [coalescedget(chk, async=True, priority=1) for i in range(3)]
+    >>> [job.wait()[1][:9] for job in jobs]
+    ['coalesced', 'coalesced', 'coalesced']
+    >>> node.coalescedGets - before
+    2
+    '''
+    return node.get(uri, coalesce=True, *args, **kwds)
+
+
+def putmany(items, *args, **kwds):
+    '''
+
+    >>> items = [("CHK@", "putmany%d" % i + myid, "text/plain") for i in range(3)]
+    >>> events = list(putmany(items, concurrency=2, priority=1, realtime=True))
+    >>> generated = dict((item[1], uri) for item, status, uri in events
+    ...                  if status == 'generated')
+    >>> done = dict((item[1], uri) for item, status, uri in events
+    ...             if status == 'successful')
+    >>> generated == done and len(done)
+    3
+    >>> statuses = []
+    >>> events = list(putmany(items, callback=lambda s, v: statuses.append(s),
+    ...                       chkonly=True))
+    >>> statuses.count('successful')
+    3
+    '''
+    return node.putmany(items, *args, **kwds)
+
 
 def putdir(*args, **kwds):
     '''
@@ -142,7 +276,31 @@ def getconfig(*args, **kwds):
 def invertprivate(*args, **kwds):
     '''
 
-    >>> # invertprivate() 
+    The node is only asked about each private key once, whatever follows
+    it, and once ever with a keyCache:
+
+    >>> public, private = genkey()
+    >>> invertprivate(private + "a") == public + "a"
+    True
+    >>> uskPublic = invertprivate("U" + private[1:] + "site/3")
+    >>> uskPublic == "U" + public[1:] + "site/3"
+    True
+    >>> keys = fcp.KeyCache(os.path.join(workdir, "keycache"))
+    >>> n = fcp.FCPNode(host=fcpHost, port=fcpPort, verbosity=fcp.FATAL,
+    ...                 keyCache=keys)
+    >>> first = n.invertprivate(private)
+    >>> n.invertprivate(private + "b") == first + "b"
+    True
+    >>> n.shutdown()
+    >>> private[4:20] in open(os.path.join(workdir, "keycache")).read()
+    False
+    >>> n = fcp.FCPNode(host=fcpHost, port=fcpPort, verbosity=fcp.FATAL,
+    ...                 keyCache=fcp.KeyCache(os.path.join(workdir, "keycache")))
+    >>> n.invertprivate(private) == first
+    True
+    >>> n.keyCache.getStats()['hits'], n.keyCache.getStats()['misses']
+    (1, 0)
+    >>> n.shutdown()
     
     '''
     return node.invertprivate(*args, **kwds)
@@ -203,7 +361,19 @@ def refstats(*args, **kwds):
 def testDDA(*args, **kwds):
     '''
 
-    >>> # testDDA() 
+    Once the node has allowed a directory, asking again on the same
+    connection needs no handshake:
+
+    >>> n = fcp.FCPNode(host=fcpHost, port=fcpPort, verbosity=fcp.FATAL)
+    >>> first = n.testDDA(Directory=workdir, WantReadDirectory=True,
+    ...                   WantWriteDirectory=True)
+    >>> first['ReadDirectoryAllowed'], first['WriteDirectoryAllowed']
+    ('true', 'true')
+    >>> n.testDDA(Directory=workdir, WantWriteDirectory=True) == first
+    True
+    >>> n.getMessageCounts()['TestDDAReply']
+    1
+    >>> n.shutdown()
     
     '''
     return node.testDDA(*args, **kwds)
@@ -344,15 +514,229 @@ def clearGlobalJob(*args, **kwds):
     '''
     return node.clearGlobalJob(*args, **kwds)
 
+def getReconnectStats(*args, **kwds):
+    '''
+
+    With reconnect=True, a request only lasting as long as the
+    connection is sent again when it drops, and a persistent one is
+    picked up where the node has it, not sent twice:
+
+    >>> flaky = fcp.StubNode(latency=1)
+    >>> n = fcp.FCPNode(host=fcpHost, port=flaky.start(), verbosity=fcp.FATAL,
+    ...                 reconnect=True)
+    >>> chk = n.put(data="reconnect" + myid)
+    >>> transient = n.get(chk, async=True)
+    >>> persistent = n.get(chk, persistence="forever", async=True)
+    >>> time.sleep(0.3)
+    >>> n.socket.shutdown(socket.SHUT_RDWR)
+    >>> transient.wait(10)[1] == persistent.wait(10)[1] == "reconnect" + myid
+    True
+    >>> _waitUntil(lambda: n.getReconnectStats()['reconnects'] == 1)
+    True
+    >>> n.getReconnectStats()['connected']
+    True
+    >>> flaky.getStats()['received']['ClientGet']
+    3
+    >>> n.shutdown()
+    >>> flaky.shutdown()
+
+    What other threads send while it's reconnecting is held back till
+    the session is going again:
+
+    >>> flaky = fcp.StubNode(latency=30)
+    >>> port = flaky.start()
+    >>> n = fcp.FCPNode(host=fcpHost, port=port, verbosity=fcp.FATAL,
+    ...                 reconnect=True)
+    >>> job = n.get(chk, persistence="forever", async=True)
+    >>> time.sleep(0.3)
+    >>> flaky.shutdown()
+    >>> _waitUntil(lambda: n.reconnecting)
+    True
+    >>> job.cancel()
+    >>> flaky = fcp.StubNode(port=port)
+    >>> port == flaky.start()
+    True
+    >>> _waitUntil(lambda: n.getReconnectStats()['reconnects'] == 1)
+    True
+    >>> _waitUntil(lambda: flaky.getStats()['received'].get('RemovePersistentRequest') == 1)
+    True
+    >>> n.shutdown()
+    >>> flaky.shutdown()
+    
+    '''
+    return node.getReconnectStats(*args, **kwds)
+
+def getMetrics(*args, **kwds):
+    '''
+
+    With metrics=True, a node counts what it sends and receives, and
+    times its requests, for getMetrics() and Prometheus:
+
+    >>> n = fcp.FCPNode(host=fcpHost, port=fcpPort, verbosity=fcp.FATAL,
+    ...                 metrics=True)
+    >>> chk = n.put(data="metrics" + myid)
+    >>> got = n.get(chk)
+    >>> m = n.getMetrics()
+    >>> m['enabled'], m['messagesSent']['ClientGet']
+    (True, 1)
+    >>> m['latency']['total']['ClientGet']['count']
+    1
+    >>> text = n.getMetricsText()
+    >>> 'fcp_messages_sent_total{header="ClientPut"} 1' in text
+    True
+    >>> 'fcp_job_seconds_bucket{stage="total",cmd="ClientGet",le="+Inf"} 1' in text
+    True
+    >>> n.shutdown()
+    
+    '''
+    return node.getMetrics(*args, **kwds)
+
 def shutdown(*args, **kwds):
     '''
 
-    >>> # shutdown() 
+    A timed wait on a job still running when its node shuts down
+    still times out:
+
+    >>> slow = fcp.StubNode(latency=30)
+    >>> n = fcp.FCPNode(host=fcpHost, port=slow.start(), verbosity=fcp.FATAL)
+    >>> job = n.put(data="slow" + myid, async=True)
+    >>> waiter = threading.Thread(target=_waitQuietly, args=(job, 2))
+    >>> waiter.setDaemon(True)
+    >>> waiter.start()
+    >>> time.sleep(0.5)
+    >>> n.shutdown()
+    >>> waiter.join(10)
+    >>> waiter.isAlive()
+    False
+    >>> slow.shutdown()
     
     '''
     return node.shutdown(*args, **kwds)
 
 
+def asyncnode(*args, **kwds):
+    '''
+
+    An AsyncFCPNode runs its requests on an event loop in our own thread:
+
+    >>> n = asyncnode(host=fcpHost, port=fcpPort, verbosity=fcp.FATAL)
+    >>> chks = [n.put(data="async%d" % i + myid) for i in range(3)]
+    >>> jobs = [n.get(chk, async=True) for chk in chks]
+    >>> n.run(until=lambda: all([job.isComplete() for job in jobs]), timeout=20)
+    True
+    >>> [job.getResult()[1][:6] for job in jobs]
+    ['async0', 'async1', 'async2']
+    >>> n.shutdown()
+    
+    '''
+    return fcp.AsyncFCPNode(*args, **kwds)
+
+def pool(*args, **kwds):
+    '''
+
+    An FCPNodePool spreads requests over its connections, and replaces
+    one found dead. The dead one's manager thread prints how it died:
+
+    >>> p = pool(host=fcpHost, port=fcpPort, size=3, retryInterval=0,
+    ...          verbosity=fcp.FATAL)
+    >>> jobs = [p.put(data="pool%d" % i + myid, async=True) for i in range(6)]
+    >>> len([job.wait() for job in jobs])
+    6
+    >>> len(set([job.node.name for job in jobs]))
+    3
+    >>> import StringIO
+    >>> stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+    >>> p.connections()[1].socket.shutdown(socket.SHUT_RDWR)
+    >>> _waitUntil(lambda: not p.health()[1]['alive'])
+    True
+    >>> crash, sys.stderr = sys.stderr, stderr
+    >>> crash.getvalue().strip().splitlines()[-1]
+    'FCPNodeFailure: FCP socket closed by node'
+    >>> p.genkey()[0].startswith("SSK@")
+    True
+    >>> [(h['alive'], h['reconnects']) for h in p.health()]
+    [(True, 0), (True, 1), (True, 0)]
+    >>> p.shutdown()
+    
+    '''
+    return fcp.FCPNodePool(*args, **kwds)
+
+def tracednode(*args, **kwds):
+    '''
+
+    A node can log through the logging module, at the verbosity of the
+    logger, and trace every message it sends and receives:
+
+    >>> import logging, StringIO
+    >>> out = StringIO.StringIO()
+    >>> logger = logging.getLogger("fcptest" + myid)
+    >>> logger.addHandler(logging.StreamHandler(out))
+    >>> logger.setLevel(logging.INFO)
+    >>> logger.propagate = False
+    >>> events = []
+    >>> n = tracednode(host=fcpHost, port=fcpPort, logger=logger,
+    ...                trace=events.append)
+    >>> n.getVerbosity() == fcp.INFO
+    True
+    >>> chk = n.put(data="traced" + myid)
+    >>> n.shutdown()
+    >>> [(e['direction'], e['header']) for e in events][:2]
+    [('out', 'ClientHello'), ('in', 'NodeHello')]
+    >>> [e['dataLength'] for e in events if e['header'] == 'ClientPut']
+    [38]
+    >>> "ClientPut" in out.getvalue()
+    False
+    
+    '''
+    return fcp.FCPNode(*args, **kwds)
+
+def replaynode(*args, **kwds):
+    '''
+
+    A session recorded with record= plays back through a ReplayNode,
+    with no node, to the same results:
+
+    >>> path = os.path.join(workdir, "session" + myid)
+    >>> n = fcp.FCPNode(host=fcpHost, port=fcpPort, verbosity=fcp.FATAL,
+    ...                 record=path)
+    >>> chk = n.put(data="recorded" + myid)
+    >>> jobs = [n.get(chk, async=True) for i in range(3)]
+    >>> [job.wait()[1] == "recorded" + myid for job in jobs]
+    [True, True, True]
+    >>> import StringIO
+    >>> streamed = n.put(stream=StringIO.StringIO("streamed" + myid))
+    >>> n.shutdown()
+    >>> "streamed" + myid in open(path, "rb").read()
+    True
+    >>> r = replaynode(metrics=True)
+    >>> stats = r.replay(path)
+    >>> stats['messagesOut'] >= 6, r.rxCounts['AllData']
+    (True, 3)
+    >>> [job for job in r.jobs.values() if not job.isComplete()]
+    []
+    >>> r.getMetrics()['latency']['total']['ClientGet']['count']
+    3
+    >>> r.shutdown()
+    
+    '''
+    return fcp.ReplayNode(*args, **kwds)
+
+def _waitQuietly(job, timeout):
+    """Wait for a job, ignoring how it ends."""
+    try:
+        job.wait(timeout)
+    except Exception:
+        pass
+
+
+def _waitUntil(test, timeout=10):
+    """Wait till test() is true, or for timeout seconds, and return test()."""
+    deadline = time.time() + timeout
+    while not test() and time.time() < deadline:
+        time.sleep(0.05)
+    return test()
+
+
 def _base30hex(integer):
     """Turn an integer into a simple lowercase base30hex encoding."""
     base30 = "0123456789abcdefghijklmnopqrst"
@@ -373,3 +757,7 @@ def _test():
 
 if __name__ == "__main__":
     print _test()
+    # before exiting, so no connection of the stub's dies with the interpreter
+    node.shutdown()
+    if os.environ.get("FCP_STUB"):
+        stub.shutdown()